@@ -0,0 +1,428 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Send requests to a camera server from a number of clients at once and
+report how it did.
+
+The server can be one already running, given with -u, or one started 
+here with synthetic cameras, given with -s, in which case its CPU time 
+and memory are measured too.  Results are printed and can be saved as 
+JSON with -o so runs can be compared with -C, e.g.
+
+    python3 LoadGenerator.py -s usb -c 8 -D 30 -o before.json
+    ... change the server ...
+    python3 LoadGenerator.py -s usb -c 8 -D 30 -o after.json
+    python3 LoadGenerator.py -C before.json after.json
+"""
+
+import argparse
+import http.client
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+
+DEBUG = None
+
+SYNTHETIC_CAMERAS = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'SyntheticCameras.py')
+
+DEFAULT_CONCURRENCY = '4'
+DEFAULT_DURATION_IN_SECONDS = '10'
+DEFAULT_PATH = '/'
+DEFAULT_SERVER_PORT = '4999'
+DEFAULT_REQUEST_TIMEOUT_IN_SECONDS = '60'
+# time for a started server to come up
+SERVER_START_TIMEOUT_IN_SECONDS = 30
+# how often the CPU time and memory of a started server are read
+RESOURCE_SAMPLE_INTERVAL_IN_SECONDS = 0.5
+PERCENTILES = (50, 95, 99)
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+# percent change in a result which is reported when comparing runs
+COMPARED_RESULTS = (('requests_per_second', 'higher'),
+                    ('latency_ms.p50', 'lower'),
+                    ('latency_ms.p95', 'lower'),
+                    ('latency_ms.p99', 'lower'),
+                    ('latency_ms.mean', 'lower'),
+                    ('errors', 'lower'),
+                    ('bytes_per_second', 'higher'),
+                    ('server.cpu_percent', 'lower'),
+                    ('server.cpu_seconds_per_request', 'lower'),
+                    ('server.rss_max_bytes', 'lower'))
+
+
+def percentile(ordered, percent):
+    '''
+    return the percent percentile of the sorted list ordered, or None if 
+    it is empty
+    '''
+    if not ordered:
+        return None
+    rank = (len(ordered) - 1) * percent / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def process_tree(pid):
+    '''
+    return pid and the pids of all its descendants
+    '''
+    children = dict()
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open('/proc/{}/stat'.format(name)) as f:
+                stat = f.read()
+        except OSError:
+            continue
+        # the command may hold spaces and brackets, the fields start after the last )
+        parent = int(stat[stat.rindex(')') + 2:].split()[1])
+        children.setdefault(parent, list()).append(int(name))
+    result = [pid]
+    for p in result:
+        result.extend(children.get(p, ()))
+    return result
+
+
+def read_usage(pid):
+    '''
+    return (CPU seconds, resident bytes) of pid and its descendants
+    '''
+    cpu = 0.0
+    rss = 0
+    for p in process_tree(pid):
+        try:
+            with open('/proc/{}/stat'.format(p)) as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open('/proc/{}/statm'.format(p)) as f:
+                rss += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError):
+            continue
+        # utime and stime are fields 14 and 15, the list starts at field 3
+        cpu += (int(fields[11]) + int(fields[12])) / CLOCK_TICKS
+    return cpu, rss
+
+
+class ResourceSampler():
+    '''
+    Read the CPU time and memory of a process and its children while a 
+    run goes on.
+    '''
+    def __init__(self, pid):
+        self.pid = pid
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self.rss_samples = list()
+        self.cpu_start = None
+        self.cpu_end = None
+
+    def start(self):
+        self.cpu_start, rss = read_usage(self.pid)
+        self.rss_samples.append(rss)
+        self.started = time.monotonic()
+        self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(RESOURCE_SAMPLE_INTERVAL_IN_SECONDS):
+            self.rss_samples.append(read_usage(self.pid)[1])
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.cpu_end, rss = read_usage(self.pid)
+        self.rss_samples.append(rss)
+        self.stopped = time.monotonic()
+
+    def results(self, requests):
+        cpu = self.cpu_end - self.cpu_start
+        return {'pid': self.pid,
+                'cpu_seconds': round(cpu, 3),
+                'cpu_percent': round(100.0 * cpu / (self.stopped - self.started), 1),
+                'cpu_seconds_per_request': cpu / requests if requests else None,
+                'rss_max_bytes': max(self.rss_samples),
+                'rss_mean_bytes': int(sum(self.rss_samples) / len(self.rss_samples))}
+
+
+def start_server(server, port, server_args, synthetic_args):
+    '''
+    start server, 'usb' or 'camera', with synthetic cameras and return 
+    the process once it answers on port
+    '''
+    command = ([sys.executable, SYNTHETIC_CAMERAS] + synthetic_args + [server, '--', '-p', str(port)]
+               + server_args)
+    if DEBUG:
+        print('starting {}'.format(command), file=sys.stderr, flush=True)
+    process = subprocess.Popen(command, start_new_session=True)
+    deadline = time.monotonic() + SERVER_START_TIMEOUT_IN_SECONDS
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('server exited with {}'.format(process.returncode))
+        try:
+            socket.create_connection(('localhost', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    stop_server(process)
+    raise RuntimeError('server did not start within {} seconds'.format(SERVER_START_TIMEOUT_IN_SECONDS))
+
+
+def stop_server(process):
+    '''
+    stop a server started by start_server and all its children
+    '''
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.wait()
+    except ProcessLookupError:
+        pass
+
+
+class Client(threading.Thread):
+    '''
+    Send requests one after another until told to stop, keeping the 
+    connection open between them.
+    '''
+    def __init__(self, host, port, paths, offset, stop, timeout):
+        super().__init__(daemon=True)
+        self.host = host
+        self.port = port
+        self.paths = paths
+        self.offset = offset
+        self.stop = stop
+        self.timeout = timeout
+        self.latencies = list()
+        self.statuses = dict()
+        self.errors = 0
+        self.bytes = 0
+
+    def run(self):
+        connection = None
+        count = self.offset
+        while not self.stop.is_set():
+            path = self.paths[count % len(self.paths)]
+            count += 1
+            if connection is None:
+                connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            started = time.monotonic()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as e:
+                if DEBUG:
+                    print('GET {} failed with {}'.format(path, e), file=sys.stderr, flush=True)
+                self.errors += 1
+                connection.close()
+                connection = None
+                continue
+            self.latencies.append(time.monotonic() - started)
+            self.statuses[response.status] = self.statuses.get(response.status, 0) + 1
+            self.bytes += len(body)
+            if response.will_close:
+                connection.close()
+                connection = None
+        if connection is not None:
+            connection.close()
+
+
+def run_load(url, paths, concurrency, duration, timeout, server_pid=None):
+    '''
+    send requests for paths of url from concurrency clients for duration 
+    seconds and return a map of the results
+    '''
+    parsed = urllib.parse.urlsplit(url)
+    host = parsed.hostname or 'localhost'
+    port = parsed.port or 80
+    stop = threading.Event()
+    clients = [Client(host, port, paths, i, stop, timeout) for i in range(concurrency)]
+    sampler = ResourceSampler(server_pid) if server_pid else None
+    if sampler:
+        sampler.start()
+    started = time.monotonic()
+    for c in clients:
+        c.start()
+    time.sleep(duration)
+    stop.set()
+    for c in clients:
+        c.join()
+    elapsed = time.monotonic() - started
+    if sampler:
+        sampler.stop()
+
+    latencies = sorted(l for c in clients for l in c.latencies)
+    statuses = dict()
+    for c in clients:
+        for status, count in c.statuses.items():
+            statuses[str(status)] = statuses.get(str(status), 0) + count
+    result = {'when': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+              'config': {'url': url,
+                         'paths': paths,
+                         'concurrency': concurrency,
+                         'duration_seconds': duration},
+              'elapsed_seconds': round(elapsed, 3),
+              'requests': len(latencies),
+              'errors': sum(c.errors for c in clients),
+              'statuses': statuses,
+              'requests_per_second': round(len(latencies) / elapsed, 2),
+              'bytes_per_second': int(sum(c.bytes for c in clients) / elapsed),
+              'latency_ms': {'mean': round(1000 * sum(latencies) / len(latencies), 2) if latencies else None,
+                             'max': round(1000 * latencies[-1], 2) if latencies else None}}
+    for p in PERCENTILES:
+        value = percentile(latencies, p)
+        result['latency_ms']['p{}'.format(p)] = round(1000 * value, 2) if value is not None else None
+    if sampler:
+        result['server'] = sampler.results(len(latencies))
+    return result
+
+
+def lookup(result, name):
+    '''
+    return the value of the dotted name in result, or None
+    '''
+    for part in name.split('.'):
+        if not isinstance(result, dict):
+            return None
+        result = result.get(part)
+    return result
+
+
+def compare(before, after):
+    '''
+    return lines showing how the results after differ from before
+    '''
+    lines = ['{:36} {:>14} {:>14} {:>9}'.format('', 'before', 'after', 'change')]
+    for name, better in COMPARED_RESULTS:
+        old = lookup(before, name)
+        new = lookup(after, name)
+        if old is None and new is None:
+            continue
+        change = ''
+        if old and new is not None:
+            percent = 100.0 * (new - old) / old
+            improved = (percent > 0) == (better == 'higher')
+            change = '{:+.1f}%{}'.format(percent, '' if percent == 0 else (' +' if improved else ' -'))
+        lines.append('{:36} {:>14} {:>14} {:>9}'.format(name, format_value(old), format_value(new), change))
+    return lines
+
+
+def format_value(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return '{:.4g}'.format(value)
+    return str(value)
+
+
+#
+# main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='measure a camera server under load')
+    parser.add_argument('-d', '--debug', 
+                        help='turn on debugging', 
+                        action='store_true')
+    parser.add_argument('-u', '--url', 
+                        help='URL of a running server, e.g. http://localhost:4000')
+    parser.add_argument('-s', '--server', 
+                        help='start this server with synthetic cameras', 
+                        choices=('usb', 'camera'))
+    parser.add_argument('-p', '--port', 
+                        help='port for a started server', 
+                        default=DEFAULT_SERVER_PORT)
+    parser.add_argument('-a', '--server_args', 
+                        help='more arguments for a started server, e.g. "-m 1"', 
+                        default='')
+    parser.add_argument('-S', '--synthetic_args', 
+                        help='arguments for the synthetic cameras, e.g. "-n 2 -r 0.01"', 
+                        default='')
+    parser.add_argument('-c', '--concurrency', 
+                        help='number of clients sending requests at once', 
+                        default=DEFAULT_CONCURRENCY)
+    parser.add_argument('-D', '--duration', 
+                        help='seconds to send requests for', 
+                        default=DEFAULT_DURATION_IN_SECONDS)
+    parser.add_argument('-P', '--path', 
+                        help='path to request, may be given more than once to use each in turn', 
+                        action='append')
+    parser.add_argument('-t', '--timeout', 
+                        help='seconds to wait for a response', 
+                        default=DEFAULT_REQUEST_TIMEOUT_IN_SECONDS)
+    parser.add_argument('-o', '--output', 
+                        help='file to save the results in as JSON')
+    parser.add_argument('-C', '--compare', 
+                        help='compare the results saved in two files', 
+                        nargs=2, metavar=('BEFORE', 'AFTER'))
+    args = parser.parse_args()
+
+    if (args.debug):
+        DEBUG = 1
+        print('turned on DEBUG from command line.',
+              file=sys.stderr, flush=True)
+
+    if args.compare:
+        results = list()
+        for filename in args.compare:
+            with open(filename) as f:
+                results.append(json.load(f))
+        print('\n'.join(compare(*results)))
+        sys.exit(0)
+
+    if (args.url is None) == (args.server is None):
+        parser.error('give one of -u/--url or -s/--server')
+
+    paths = args.path or [DEFAULT_PATH]
+    process = None
+    url = args.url
+    if args.server:
+        port = int(args.port)
+        process = start_server(args.server, port, args.server_args.split(), args.synthetic_args.split())
+        url = 'http://localhost:{}'.format(port)
+    try:
+        result = run_load(url, paths, int(args.concurrency), float(args.duration), 
+                          float(args.timeout), process.pid if process else None)
+    finally:
+        if process:
+            stop_server(process)
+    if args.server:
+        result['config']['server'] = args.server
+        result['config']['server_args'] = args.server_args
+        result['config']['synthetic_args'] = args.synthetic_args
+
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2)
+            f.write('\n')
@@ -0,0 +1,399 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Stand-in cameras so the servers can be run and measured without a 
+Raspberry Pi or USB cameras.
+
+SyntheticVideoCapture takes the place of cv2.VideoCapture and 
+SyntheticPiCamera the place of picamera.PiCamera.  Frames are made from
+a fixed pattern with a bar which moves each frame.  The time a read 
+takes, the resolution and how often a read fails can be set, so the 
+cameras cost time without using the CPU a real camera would not.
+
+Run a server with the stand-in cameras with
+
+    python3 SyntheticCameras.py -n 2 usb -- -p 4000
+    python3 SyntheticCameras.py camera -- -p 5000 -l /tmp/camera.log
+
+everything after -- is passed to the server.  The server logs to 
+usb-synthetic.log or camera-synthetic.log in the temporary directory 
+unless it is given -l.
+"""
+
+import argparse
+import os
+import random
+import runpy
+import sys
+import tempfile
+import threading
+import time
+import types
+
+import cv2
+
+REPOSITORY_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.append(os.path.join(REPOSITORY_DIR, 'Common'))
+import CaptureBackends
+
+DEBUG = None
+
+SERVERS = {
+    'usb': os.path.join(REPOSITORY_DIR, 'UsbCameraServer', 'UsbCameraServer.py'),
+    'camera': os.path.join(REPOSITORY_DIR, 'CameraServer', 'CameraServer.py'),
+    }
+ICON_FILE_NAMES = {
+    'usb': os.path.join(REPOSITORY_DIR, 'UsbCameraServer', 'favicon.ico'),
+    'camera': os.path.join(REPOSITORY_DIR, 'CameraServer', 'favicon.ico'),
+    }
+
+# the stand-in cameras are set up with these, see configure()
+DEFAULT_DEVICES = '1'
+DEFAULT_WIDTH = '3840'
+DEFAULT_HEIGHT = '2160'
+DEFAULT_READ_LATENCY_IN_SECONDS = '0.033'
+DEFAULT_OPEN_LATENCY_IN_SECONDS = '0.5'
+DEFAULT_FAILURE_RATE = '0'
+settings = {'devices': int(DEFAULT_DEVICES),
+            'width': int(DEFAULT_WIDTH),
+            'height': int(DEFAULT_HEIGHT),
+            'read_latency': float(DEFAULT_READ_LATENCY_IN_SECONDS),
+            'open_latency': float(DEFAULT_OPEN_LATENCY_IN_SECONDS),
+            'failure_rate': float(DEFAULT_FAILURE_RATE)}
+
+# the Raspberry Pi camera V2
+PI_CAMERA_MAX_RESOLUTION = (3280, 2464)
+PI_CAMERA_REVISION = 'imx219'
+# a still capture changes the sensor mode so takes much longer than a frame
+PI_CAMERA_STILL_LATENCY_IN_SECONDS = 0.5
+# JPEG images kept for each size and quality, used in turn
+JPEG_IMAGES_KEPT = 8
+
+_jpegs = dict()
+_jpegs_lock = threading.Lock()
+
+
+def configure(**kwargs):
+    '''
+    change the settings of the stand-in cameras
+    '''
+    for key, value in kwargs.items():
+        if key not in settings:
+            raise ValueError('"{}" is not one of {}'.format(key, sorted(settings)))
+        settings[key] = value
+
+
+def make_jpeg(width, height, count, quality):
+    '''
+    return a JPEG of frame count, only JPEG_IMAGES_KEPT are encoded for
+    each size and quality
+    '''
+    key = (width, height, quality, count % JPEG_IMAGES_KEPT)
+    with _jpegs_lock:
+        image = _jpegs.get(key)
+    if image is None:
+        _, encoded = cv2.imencode('.jpg', CaptureBackends.synthetic_frame(width, height, key[-1]), [cv2.IMWRITE_JPEG_QUALITY, quality])
+        image = encoded.tobytes()
+        with _jpegs_lock:
+            _jpegs[key] = image
+    return image
+
+
+class SyntheticVideoCapture():
+    '''
+    Stand in for cv2.VideoCapture.
+
+    Devices 0 to settings['devices'] - 1 can be opened.  Each grab takes
+    settings['read_latency'] seconds and fails with a chance of 
+    settings['failure_rate'].  The resolution is always that of the
+    settings whatever is asked for, as a camera picks the nearest it has.
+    '''
+    def __init__(self, index, api_preference=None):
+        self.index = index
+        self._opened = isinstance(index, int) and 0 <= index < settings['devices']
+        self.width = settings['width']
+        self.height = settings['height']
+        self._count = 0
+        self._grabbed = False
+        if self._opened:
+            time.sleep(settings['open_latency'])
+
+    def isOpened(self):
+        return self._opened
+
+    def release(self):
+        self._opened = False
+
+    def set(self, prop, value):
+        return self._opened
+
+    def get(self, prop):
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return float(self.width)
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return float(self.height)
+        if prop == cv2.CAP_PROP_FPS:
+            return 1.0 / settings['read_latency'] if settings['read_latency'] > 0 else 0.0
+        return 0.0
+
+    def grab(self):
+        if not self._opened:
+            return False
+        time.sleep(settings['read_latency'])
+        if random.random() < settings['failure_rate']:
+            self._grabbed = False
+            return False
+        self._count += 1
+        self._grabbed = True
+        return True
+
+    def retrieve(self, image=None, flag=None):
+        if not self._opened or not self._grabbed:
+            return False, None
+        return True, CaptureBackends.synthetic_frame(self.width, self.height, self._count, image)
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+
+class SyntheticPiCamera():
+    '''
+    Stand in for picamera.PiCamera.
+
+    A still capture takes PI_CAMERA_STILL_LATENCY_IN_SECONDS, a capture
+    from the video port one frame at the framerate.  JPEG and MJPEG 
+    output is made on the CPU here where the real camera uses the GPU, 
+    but only JPEG_IMAGES_KEPT images are made for each size.
+    '''
+    MAX_RESOLUTION = PI_CAMERA_MAX_RESOLUTION
+
+    def __init__(self, camera_num=0, resolution=None, framerate=None, **kwargs):
+        if random.random() < settings['failure_rate']:
+            raise RuntimeError('synthetic camera failed to open')
+        time.sleep(settings['open_latency'])
+        self.revision = PI_CAMERA_REVISION
+        self.resolution = resolution or (1280, 720)
+        self.framerate = framerate or 30
+        self.led = True
+        self.exposure_mode = 'auto'
+        self.awb_mode = 'auto'
+        self.awb_gains = (1.0, 1.0)
+        self.iso = 0
+        self.shutter_speed = 0
+        self.exposure_speed = 10000
+        self.analog_gain = 1.0
+        self.digital_gain = 1.0
+        self.closed = False
+        self._count = 0
+        self._recordings = dict()   # splitter_port: (thread, stop event)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def close(self):
+        for port in list(self._recordings):
+            self.stop_recording(splitter_port=port)
+        self.closed = True
+
+    def start_preview(self, **kwargs):
+        pass
+
+    def stop_preview(self):
+        pass
+
+    def _check_open(self):
+        if self.closed:
+            raise RuntimeError('camera is closed')
+
+    def _jpeg(self, resize, quality):
+        width, height = resize or self.resolution
+        self._count += 1
+        return make_jpeg(int(width), int(height), self._count, quality)
+
+    def capture(self, output, format='jpeg', use_video_port=False, resize=None, splitter_port=0,
+                quality=85, **kwargs):
+        self._check_open()
+        if use_video_port:
+            time.sleep(1.0 / float(self.framerate))
+        else:
+            time.sleep(PI_CAMERA_STILL_LATENCY_IN_SECONDS)
+        if random.random() < settings['failure_rate']:
+            raise RuntimeError('synthetic camera failed to capture')
+        if format in ('bgr', 'rgb'):
+            # a numpy array of the padded size, as the real camera needs
+            self._count += 1
+            height, width = output.shape[:2]
+            CaptureBackends.synthetic_frame(width, height, self._count, output)
+            return
+        output.write(self._jpeg(resize, quality))
+
+    def capture_continuous(self, output, format='jpeg', use_video_port=False, resize=None,
+                           splitter_port=0, quality=85, **kwargs):
+        while True:
+            self.capture(output, format, use_video_port, resize, splitter_port, quality)
+            yield output
+
+    def start_recording(self, output, format='mjpeg', resize=None, splitter_port=1, quality=85, **kwargs):
+        self._check_open()
+        if splitter_port in self._recordings:
+            raise RuntimeError('already recording on splitter port {}'.format(splitter_port))
+        stop = threading.Event()
+        thread = threading.Thread(target=self._record, args=(output, resize, quality, stop), daemon=True)
+        self._recordings[splitter_port] = (thread, stop)
+        thread.start()
+
+    def _record(self, output, resize, quality, stop):
+        interval = 1.0 / float(self.framerate)
+        while not stop.wait(interval):
+            output.write(self._jpeg(resize, quality))
+
+    def wait_recording(self, timeout=0, splitter_port=1):
+        self._check_open()
+        time.sleep(timeout)
+
+    def stop_recording(self, splitter_port=1):
+        thread, stop = self._recordings.pop(splitter_port)
+        stop.set()
+        thread.join()
+
+
+def install_video_capture():
+    '''
+    make cv2.VideoCapture and the device search of FindCaptureDevices 
+    use SyntheticVideoCapture
+    '''
+    cv2.VideoCapture = SyntheticVideoCapture
+    sys.path.insert(0, os.path.dirname(SERVERS['usb']))
+    import FindCaptureDevices
+
+    def describe_capture_device(dev, probe=True):
+        if not 0 <= dev < settings['devices']:
+            return None
+        return {'device': dev,
+                'path': os.path.join(FindCaptureDevices.DEV_DIR, 'video{}'.format(dev)),
+                'name': 'synthetic camera {}'.format(dev),
+                'resolutions': [[settings['width'], settings['height']]]}
+
+    def describe_capture_devices(open_devices=(), timeout=None):
+        return [describe_capture_device(d) for d in range(settings['devices'])]
+
+    def watch_video_nodes(callback, poll_interval=None):
+        # synthetic cameras are never plugged in or removed
+        return
+
+    FindCaptureDevices.describe_capture_device = describe_capture_device
+    FindCaptureDevices.describe_capture_devices = describe_capture_devices
+    FindCaptureDevices.watch_video_nodes = watch_video_nodes
+
+
+def install_picamera():
+    '''
+    make "from picamera import PiCamera" give SyntheticPiCamera
+    '''
+    module = types.ModuleType('picamera')
+    module.PiCamera = SyntheticPiCamera
+    module.PiCameraError = RuntimeError
+    sys.modules['picamera'] = module
+    # already imported above, when picamera could not be found
+    CaptureBackends.picamera = module
+
+
+def run_server(server, server_args):
+    '''
+    run server, 'usb' or 'camera', as its own main with server_args
+    '''
+    if server == 'usb':
+        install_video_capture()
+    # for CameraServer and UsbCameraServer -B picamera
+    install_picamera()
+    path = SERVERS[server]
+    sys.path.insert(0, os.path.dirname(path))
+    if '-i' not in server_args and '--icon_filename' not in server_args:
+        server_args = ['-i', ICON_FILE_NAMES[server]] + server_args
+    # the servers' own default is a directory which is only on the Pi
+    if '-l' not in server_args and '--log_filename' not in server_args:
+        server_args = ['-l', os.path.join(tempfile.gettempdir(), '{}-synthetic.log'.format(server))] + server_args
+    sys.argv = [path] + server_args
+    runpy.run_path(path, run_name='__main__')
+
+
+#
+# main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='run a camera server with synthetic cameras')
+    parser.add_argument('-d', '--debug', 
+                        help='turn on debugging', 
+                        action='store_true')
+    parser.add_argument('-n', '--devices', 
+                        help='number of USB cameras', 
+                        default=DEFAULT_DEVICES)
+    parser.add_argument('-W', '--width', 
+                        help='width of USB camera frames', 
+                        default=DEFAULT_WIDTH)
+    parser.add_argument('-H', '--height', 
+                        help='height of USB camera frames', 
+                        default=DEFAULT_HEIGHT)
+    parser.add_argument('-r', '--read_latency', 
+                        help='seconds each frame read takes', 
+                        default=DEFAULT_READ_LATENCY_IN_SECONDS)
+    parser.add_argument('-o', '--open_latency', 
+                        help='seconds opening a camera takes', 
+                        default=DEFAULT_OPEN_LATENCY_IN_SECONDS)
+    parser.add_argument('-f', '--failure_rate', 
+                        help='fraction of reads which fail, e.g. 0.01', 
+                        default=DEFAULT_FAILURE_RATE)
+    parser.add_argument('server', 
+                        help='server to run', 
+                        choices=sorted(SERVERS))
+    parser.add_argument('server_args', 
+                        help='arguments for the server, after --', 
+                        nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    if (args.debug):
+        DEBUG = 1
+        print('turned on DEBUG from command line.',
+              file=sys.stderr, flush=True)
+
+    configure(devices=int(args.devices),
+              width=int(args.width),
+              height=int(args.height),
+              read_latency=float(args.read_latency),
+              open_latency=float(args.open_latency),
+              failure_rate=float(args.failure_rate))
+    server_args = args.server_args
+    if server_args and server_args[0] == '--':
+        server_args = server_args[1:]
+    if DEBUG:
+        print('running {} with {} and {}'.format(args.server, settings, server_args),
+              file=sys.stderr, flush=True)
+    run_server(args.server, server_args)
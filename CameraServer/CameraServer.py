@@ -26,29 +26,102 @@ SOFTWARE.
 
 Very simple web server to provide a camera image from the Raspberry Pi camera
 
+The camera is opened once and kept running with the exposure and white
+balance locked, measured again every 10 minutes (-e minutes).
+
+Images captured within the last second (-m max_age, or ?max_age=S) are
+reused and requests which arrive while an image is being captured share it.
+
+?width=W and ?height=H scale the image to fit and ?quality=Q (1 to 100, 
+default 100) sets the JPEG quality.  The GPU scales and encodes the image
+as it is captured and the latest image of each variant is reused like 
+the full size image.
+
+With -V smaller images (-s WxH) are taken from the video port -f times a 
+second and / returns the latest from memory, /still takes a full 
+resolution image.
+
+Images are sent with an ETag and Last-Modified so a client can ask again
+with If-None-Match or If-Modified-Since and get 304 until there is a new
+image.  ?wait_newer_than=<ETag> waits, up to ?timeout=S seconds 
+(default 30), for an image newer than that ETag and returns 304 if none
+is captured in time.
+
+/stream returns a live MJPEG stream encoded by the GPU, the camera only
+records it while someone watches.
+
+/metrics returns counters and latency histograms in Prometheus text format.
+
 By default will accept GET from any address on port 5000
 """
 
 import argparse
-import datetime
-import json
+import atexit
+import collections
+import functools
 import io
+import os
+import queue
 import sys
+import threading
+import time
 from time import sleep
+import urllib.parse
 # use newer, threading version, if available
 if (sys.version_info[0] >= 3 and sys.version_info[1] >= 7):
-    from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+    from http.server import HTTPServer, ThreadingHTTPServer
 else:
-    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from http.server import HTTPServer
 
-from picamera import PiCamera
+# modules shared by the camera servers
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Common'))
+import AsyncHttpServer
+import CameraRequestHandler
+import CaptureBackends
+import HttpCaching
+import JsonLogWriter
+from JsonLogWriter import emit_event
+import ServerMetrics
+import SharedCapture
 
 DEBUG = None
 
 DEFAULT_LISTEN_ADDRESS = '0.0.0.0'    # respond to request from any address
 DEFAULT_LISTEN_PORT = '5000'            # IP port 5000
 
-MINIMUM_PREVIEW_TIME_IN_SECONDS = 0.25
+# time for the automatic gain and white balance to settle before they are locked
+CAMERA_SETTLE_TIME_IN_SECONDS = 2.0
+
+# how often the locked exposure is measured again, 0 leaves it automatic
+DEFAULT_EXPOSURE_REFRESH_IN_MINUTES = '10'
+
+# video mode takes JPEG images of this size from the video port, / serves the
+# latest and /still takes a full resolution image
+DEFAULT_VIDEO_SIZE = '1640x1232'
+DEFAULT_VIDEO_FPS = '2'
+VIDEO_JPEG_QUALITY = 85
+VIDEO_RETRY_TIME_IN_SECONDS = 5
+# longest a request waits for the first video image
+FIRST_VIDEO_IMAGE_TIMEOUT_IN_SECONDS = 30
+video_mode = False
+
+# /stream sends MJPEG made by the GPU, recorded only while someone watches
+DEFAULT_STREAM_SIZE = '1280x960'
+STREAM_SPLITTER_PORT = 2
+JPEG_END_OF_IMAGE = b'\xff\xd9'
+
+# images captured within this many seconds are reused, override with ?max_age=
+max_image_age = float(SharedCapture.DEFAULT_MAX_AGE_IN_SECONDS)
+
+# ?width=, ?height= and ?quality= pick a variant, scaled and encoded by the GPU
+# (width, height, quality), None for full size and DEFAULT_JPEG_QUALITY
+FULL_VARIANT = (None, None, None)
+DEFAULT_JPEG_QUALITY = 100
+MINIMUM_IMAGE_QUALITY = 1
+MAXIMUM_IMAGE_QUALITY = 100
+MAXIMUM_IMAGE_DIMENSION = 10000
+# the latest image of at most this many variants is kept
+MAX_CACHED_VARIANTS = 16
 
 DEFAULT_ICON_FILE_NAME = '/opt/Projects/CameraServer/favicon.ico'
 FAVICON = None
@@ -56,63 +129,500 @@ FAVICON = None
 DEFAULT_LOG_FILE_NAME = '/opt/Projects/logs/CameraServer.log'
 log_file = None
 
+# counters and latency histograms served from /metrics
+metrics = ServerMetrics.camera_server_metrics()
+# the device label used in metrics
+CAMERA_DEVICE = 0
 
-def emit_json_map(output, json_map):
+
+class CameraSession():
     '''
-    generate a time stamp in UTC for use in the output
-    
-    A 'when' entry with the time stamp is added to the json_map.
+    Keep the camera open and warm between requests.
+
+    Opening a PiCamera, setting the resolution and letting the automatic
+    gain and white balance settle takes over a second, so it is done once.
+    The preview keeps the sensor running, then the exposure and white 
+    balance are locked so every image is taken the same way and a capture
+    only costs the capture.  The exposure is measured again every 
+    exposure_refresh seconds so it follows the light, 0 leaves it on 
+    automatic.
+
+    Captures are serialized by a lock.  If one fails the camera is closed
+    and opened again before trying once more.
+
+    The camera is opened with the PiCameraBackend of 
+    ../Common/CaptureBackends.py, also used by UsbCameraServer -B picamera,
+    and its PiCamera is used for the GPU's JPEG and MJPEG encoders.
     '''
-    when = datetime.datetime.now(datetime.timezone.utc)
-    when_str = when.isoformat()
-    json_map['when'] = when_str
-    message = json.dumps(json_map)
-    output.write('{}\n'.format(message))
-    output.flush()
+    def __init__(self, exposure_refresh=0):
+        self.exposure_refresh = exposure_refresh
+        self.lock = threading.Lock()
+        self._backend = None
+        self._camera = None     # the PiCamera of _backend
+        self._exposure_locked_time = None
+
+    def is_open(self):
+        return self._camera is not None
+
+    def open(self):
+        '''
+        open the camera, if needed, set the resolution and start it running
+
+        Call with lock held.
+        '''
+        if self._camera is not None:
+            return
+        backend = CaptureBackends.PiCameraBackend(CAMERA_DEVICE)
+        with metrics.time(ServerMetrics.STAGE_SECONDS, device=CAMERA_DEVICE, stage='open'):
+            backend.open()
+        camera = backend.camera
+        try:
+            if DEBUG:
+                print("camera.revision = {}".format(camera.revision))
+                print("camera.MAX_RESOLUTION = {}".format(camera.MAX_RESOLUTION))
+                print("default camera.resolution = {}".format(camera.resolution))
+            with metrics.time(ServerMetrics.STAGE_SECONDS, device=CAMERA_DEVICE, stage='set_resolution'):
+                backend.set_resolution(*camera.MAX_RESOLUTION)
+            if DEBUG:
+                print("camera.resolution = {}".format(camera.resolution))
+        except:
+            backend.close()
+            raise
+        self._backend = backend
+        self._camera = camera
+        self._exposure_locked_time = None
+        emit_event(log_file, 'opened camera {} at {}'.format(camera.revision, camera.resolution))
+
+    def close(self):
+        '''
+        close the camera, it will be opened again on the next capture
+
+        Call with lock held.
+        '''
+        if self._backend is not None:
+            try:
+                self._backend.close()
+            finally:
+                self._backend = None
+                self._camera = None
+                emit_event(log_file, 'closed camera')
+
+    def _lock_exposure(self):
+        '''
+        let the automatic exposure and white balance settle then fix them
+
+        Call with lock held.
+        '''
+        camera = self._camera
+        with metrics.time(ServerMetrics.STAGE_SECONDS, device=CAMERA_DEVICE, stage='warm_up'):
+            self._backend.lock_exposure(CAMERA_SETTLE_TIME_IN_SECONDS, lock=self.exposure_refresh > 0)
+        self._exposure_locked_time = time.time()
+        if DEBUG:
+            print('exposure set to shutter {} gains {}'.format(camera.exposure_speed, camera.awb_gains),
+                  file=sys.stderr, flush=True)
+
+    def _check_exposure(self):
+        '''
+        set the exposure if it has not been or it is time to measure it again
 
+        Call with lock held.
+        '''
+        if (self._exposure_locked_time is None
+                or (self.exposure_refresh > 0
+                    and time.time() - self._exposure_locked_time > self.exposure_refresh)):
+            self._lock_exposure()
+
+    def _capture_once(self, variant):
+        self.open()
+        self._check_exposure()
+        width, height, quality = variant
+        resize = CaptureBackends.fit_image_size(*self._camera.MAX_RESOLUTION, width, height)
+        if quality is None:
+            quality = DEFAULT_JPEG_QUALITY
+        my_stream = io.BytesIO()
+        # the GPU reads, scales and encodes the JPEG in one step
+        with metrics.time(ServerMetrics.STAGE_SECONDS, device=CAMERA_DEVICE, stage='read'):
+            self._camera.capture(my_stream, 'jpeg', resize=resize, quality=quality)
+        # a view of the stream's buffer, the JPEG is not copied
+        image = my_stream.getbuffer()
+        if DEBUG:
+            print("len(image) = {}".format(len(image)))
+        return image
+
+    def warm_up(self):
+        '''
+        open the camera and set the exposure before the first request
+        '''
+        with self.lock:
+            try:
+                self.open()
+                self._lock_exposure()
+            except Exception as e:
+                emit_event(log_file, 'warming up camera failed with {}'.format(e))
+                self.close()
+
+    def capture(self, variant=FULL_VARIANT):
+        '''
+        return a JPEG image from the camera scaled to fit in the width and 
+        height of variant, None for full size, with its quality
+        '''
+        with metrics.time(ServerMetrics.LOCK_WAIT_SECONDS, device=CAMERA_DEVICE):
+            self.lock.acquire()
+        try:
+            try:
+                return self._capture_once(variant)
+            except Exception as e:
+                emit_event(log_file, 'capture failed with {}, re-opening camera'.format(e))
+                self.close()
+            try:
+                return self._capture_once(variant)
+            except:
+                self.close()
+                raise
+        finally:
+            self.lock.release()
 
-def emit_event(output, event_text):
+    def start_recording(self, output, size, splitter_port):
+        '''
+        start MJPEG of size (width, height) going to output and return the 
+        camera recording it
+        '''
+        with self.lock:
+            self.open()
+            self._check_exposure()
+            self._camera.start_recording(output, format='mjpeg', splitter_port=splitter_port,
+                                         resize=size, quality=CameraRequestHandler.STREAM_JPEG_QUALITY)
+            return self._camera
+
+    def is_current(self, camera):
+        '''
+        return True if camera is still the open camera
+        '''
+        return self._camera is camera
+
+    def stop_recording(self, camera, splitter_port):
+        '''
+        stop the recording started on camera, if it is still open
+        '''
+        with self.lock:
+            if self._camera is camera:
+                camera.stop_recording(splitter_port=splitter_port)
+
+    def run_video(self, size, fps):
+        '''
+        Used to run a thread that takes JPEG images of size (width, height)
+        from the video port fps times a second and makes each the latest 
+        video image.
+
+        The GPU scales and encodes each frame so this takes little CPU.  
+        The lock is only held to open the camera and set the exposure so 
+        still captures can run between frames.  When the camera fails it
+        is opened again.
+        '''
+        interval = 1.0 / fps
+        while True:
+            camera = None
+            try:
+                with self.lock:
+                    self.open()
+                    self._check_exposure()
+                    camera = self._camera
+                emit_event(log_file, 'taking {}x{} video images {} times a second'.format(size[0], size[1], fps))
+                output = DoubleBuffer()
+                next_time = time.time()
+                started = time.time()
+                for _ in camera.capture_continuous(output, 'jpeg', use_video_port=True,
+                                                   resize=size, quality=VIDEO_JPEG_QUALITY):
+                    when = time.time()
+                    metrics.observe(ServerMetrics.STAGE_SECONDS, when - started, device=CAMERA_DEVICE, stage='video')
+                    video_images.set_latest(CapturedImage(output.swap(), when, HttpCaching.next_sequence()))
+                    output.reset()
+                    if self._camera is not camera:
+                        raise RuntimeError('camera was closed by a still capture')
+                    with self.lock:
+                        self._check_exposure()
+                    next_time += interval
+                    delay_time = next_time - time.time()
+                    if 0 < delay_time:
+                        sleep(delay_time)
+                    else:
+                        next_time = time.time()
+                    started = time.time()
+            except Exception as e:
+                emit_event(log_file, 'video capture failed with {}, re-opening camera'.format(e))
+                with self.lock:
+                    if self._camera is camera:
+                        self.close()
+                sleep(VIDEO_RETRY_TIME_IN_SECONDS)
+
+class DoubleBuffer():
     '''
-    send a line with an event to the output with a time stamp
+    Output for capture_continuous() which fills one stream while the 
+    image in the other is served.
+
+    The streams are used again so a new buffer is not made for every 
+    image, unless a slow client is still sending the older image.
     '''
-    item = {'event':event_text}
-    emit_json_map(output, item)
+    def __init__(self):
+        self._streams = [io.BytesIO(), io.BytesIO()]
+        self._back = 0
+
+    def write(self, data):
+        return self._streams[self._back].write(data)
 
+    def flush(self):
+        pass
 
-def capture_image():
+    def swap(self):
+        '''
+        return a view of the image just written and write the next image
+        to the other stream
+        '''
+        front = self._streams[self._back].getbuffer()
+        self._back = 1 - self._back
+        return front
+
+    def reset(self):
+        '''
+        empty the stream the next image is written to, call once the image
+        it held is no longer the latest
+        '''
+        stream = self._streams[self._back]
+        try:
+            stream.seek(0)
+            stream.truncate()
+        except BufferError:
+            # the image in it is still being sent
+            self._streams[self._back] = io.BytesIO()
+
+class StreamBroadcaster():
     '''
-    create in memory image
+    Output for the MJPEG recorder which hands each JPEG image to every 
+    attached stream client.
+
+    The GPU encodes the stream once however many clients watch.  Images
+    are passed on at most fps times a second.  Each client has a short 
+    queue of its own and when it falls behind the oldest image in its 
+    queue is dropped, so it never holds up the camera or the other 
+    clients.  The camera records only while a client is attached.
     '''
-    my_stream = io.BytesIO()
-    with PiCamera() as camera:
-        if DEBUG:
-            print("camera.revision = {}".format(camera.revision))
-            print("camera.MAX_RESOLUTION = {}".format(camera.MAX_RESOLUTION))
-            print("default camera.resolution = {}".format(camera.resolution))
-        # disable LED on camera
-        camera.led = False
-        camera.resolution = camera.MAX_RESOLUTION
-        if DEBUG:
-            print("camera.resolution = {}".format(camera.resolution))
-        camera.start_preview()
-        # Camera warm-up time
-        sleep(MINIMUM_PREVIEW_TIME_IN_SECONDS)
-        camera.capture(my_stream, 'jpeg', quality=100)
-        camera.stop_preview()
-        # get the data
-        image = bytearray(my_stream.getvalue())
-        if DEBUG:
-            print("len(image) = {}".format(len(image)))
+    def __init__(self, session, size, fps):
+        self.session = session
+        self.size = size
+        self.interval = 1.0 / fps
+        # serializes starting and stopping the recording
+        self._control_lock = threading.Lock()
+        # guards _clients, taken by the recorder's thread in write()
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._camera = None
+        self._parts = list()
+        self._next_time = 0
+
+    def attach(self):
+        '''
+        return a queue which will receive JPEG images, starting the 
+        recording if needed
+        '''
+        client = queue.Queue(maxsize=CameraRequestHandler.STREAM_CLIENT_QUEUE_FRAMES)
+        with self._control_lock:
+            if self._camera is not None and not self.session.is_current(self._camera):
+                # the camera was closed and opened again since it started
+                self._camera = None
+            if self._camera is None:
+                self._parts = list()
+                self._camera = self.session.start_recording(self, self.size, STREAM_SPLITTER_PORT)
+                emit_event(log_file, 'started recording {}x{} stream'.format(self.size[0], self.size[1]))
+            with self._lock:
+                self._clients.add(client)
+        return client
+
+    def detach(self, client):
+        '''
+        stop sending images to client, stopping the recording after the 
+        last client
+        '''
+        with self._control_lock:
+            with self._lock:
+                self._clients.discard(client)
+                is_last = not self._clients
+            if is_last and self._camera is not None:
+                camera = self._camera
+                self._camera = None
+                self.session.stop_recording(camera, STREAM_SPLITTER_PORT)
+                emit_event(log_file, 'stopped recording stream')
+
+    def write(self, data):
+        '''
+        called by the recorder with the next part of the MJPEG stream
+        '''
+        part = bytes(data)
+        self._parts.append(part)
+        if not part.endswith(JPEG_END_OF_IMAGE):
+            return len(part)
+        image = b''.join(self._parts)
+        self._parts = list()
+        now = time.time()
+        if now < self._next_time:
+            return len(part)
+        self._next_time = max(self._next_time + self.interval, now)
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.put_nowait(image)
+            except queue.Full:
+                # slow client, replace its oldest image
+                try:
+                    client.get_nowait()
+                except queue.Empty:
+                    pass
+                client.put_nowait(image)
+        return len(part)
+
+    def flush(self):
+        pass
+
+stream_broadcaster = None
 
-        return bytearray(image)
+
+camera_session = None
+
+def capture_image(variant=FULL_VARIANT):
+    '''
+    create in memory image of variant, (width, height, quality)
+    '''
+    return camera_session.capture(variant)
+
+
+def choose_variant(query):
+    '''
+    return the (width, height, quality) asked for by ?width=, ?height= and
+    ?quality=, each None if not given
+
+    Raise ValueError for a bad value.
+    '''
+    width = int(query['width'][0]) if 'width' in query else None
+    height = int(query['height'][0]) if 'height' in query else None
+    quality = int(query['quality'][0]) if 'quality' in query else None
+    for name, value in (('width', width), ('height', height)):
+        if value is not None and (value < 1 or value > MAXIMUM_IMAGE_DIMENSION):
+            raise ValueError('{} of {} is not between 1 and {}'.format(name, value, MAXIMUM_IMAGE_DIMENSION))
+    if quality is not None and (quality < MINIMUM_IMAGE_QUALITY or quality > MAXIMUM_IMAGE_QUALITY):
+        raise ValueError('quality of {} is not between {} and {}'.format(quality,
+                                                                         MINIMUM_IMAGE_QUALITY,
+                                                                         MAXIMUM_IMAGE_QUALITY))
+    return (width, height, quality)
+
+def parse_size(text):
+    '''
+    return (width, height) from text of WIDTHxHEIGHT, e.g. 1280x960
+
+    Raise ValueError if text is not a size.
+    '''
+    size = tuple(int(v) for v in text.lower().split('x'))
+    if len(size) != 2 or min(size) <= 0:
+        raise ValueError('"{}" is not WIDTHxHEIGHT'.format(text))
+    return size
+
+
+class CapturedImage():
+    '''
+    A JPEG image from the camera and when it was taken.
+    '''
+    def __init__(self, image, when, sequence):
+        self.image = image
+        self.when = when
+        # an image never changes once taken
+        self.modified = when
+        self.sequence = sequence
+        self.etag = HttpCaching.make_etag(sequence)
+
+def capture_variant(variant):
+    '''
+    return a new CapturedImage of variant
+    '''
+    return CapturedImage(capture_image(variant), time.time(), HttpCaching.next_sequence())
+
+# a SharedCapture of each variant asked for, latest asked for last
+_variant_captures = collections.OrderedDict()
+_variant_captures_lock = threading.Lock()
+# images from the video port when video mode is on
+video_images = SharedCapture.SharedCapture()
+
+def get_variant_capture(variant):
+    '''
+    return the SharedCapture of variant, (width, height, quality)
+    '''
+    with _variant_captures_lock:
+        shared = _variant_captures.get(variant)
+        if shared is None:
+            shared = SharedCapture.SharedCapture(functools.partial(capture_variant, variant),
+                                                 metrics, CAMERA_DEVICE)
+            _variant_captures[variant] = shared
+            if len(_variant_captures) > MAX_CACHED_VARIANTS:
+                # forget the variant asked for longest ago
+                _variant_captures.popitem(last=False)
+        else:
+            _variant_captures.move_to_end(variant)
+        return shared
+
+def get_image(max_age=0, variant=FULL_VARIANT):
+    '''
+    return a CapturedImage of variant, (width, height, quality), taken no 
+    more than max_age seconds ago
+
+    Only one capture of each variant runs at a time, the camera takes one
+    image at a time anyway, and requests which arrive while it runs share
+    its image, or the error it failed with.
+    '''
+    return get_variant_capture(variant).get(max_age)
+
+def get_video_image(timeout):
+    '''
+    return the latest CapturedImage from the video port, waiting up to 
+    timeout seconds for the first
+    '''
+    captured = video_images.wait_for_newer(0, timeout)
+    if captured is None:
+        raise RuntimeError('no video image within {} seconds'.format(timeout))
+    return captured
+
+def wait_for_newer_image(sequence, max_age, timeout, variant=FULL_VARIANT):
+    '''
+    return a CapturedImage of variant newer than the image with sequence, 
+    or None if there is none within timeout seconds
+    '''
+    return get_variant_capture(variant).wait_for_newer(sequence, timeout, max_age)
 
     
-class Camera_HTTPServer_RequestHandler(BaseHTTPRequestHandler):
+class Camera_HTTPServer_RequestHandler(CameraRequestHandler.CameraRequestHandler):
     '''
     A subclass of BaseHTTPRequestHandler to provide camera output.
     '''
+    metrics = metrics
+
+    @staticmethod
+    def is_long_running(path):
+        '''
+        return True if the request for path may run for a long time, the
+        asyncio front end runs these outside its pool of workers
+        '''
+        parts = urllib.parse.urlsplit(path)
+        return (parts.path == '/stream'
+                or 'wait_newer_than' in urllib.parse.parse_qs(parts.query))
 
     def do_GET(self):
+        '''
+        handle the HTTP GET request, counting it while it is in flight
+        '''
+        metrics.inc(ServerMetrics.REQUESTS_IN_FLIGHT)
+        try:
+            self.handle_get()
+        finally:
+            metrics.inc(ServerMetrics.REQUESTS_IN_FLIGHT, -1)
+
+    def handle_get(self):
         '''
         handle the HTTP GET request
         '''
@@ -125,22 +635,82 @@ class Camera_HTTPServer_RequestHandler(BaseHTTPRequestHandler):
         
         emit_event(log_file, 'request of "{}," from {}'.format(self.path,
                                                                self.client_address))
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+
         # deal with site ICON 
-        if self.path == '/favicon.ico':
+        if path == '/favicon.ico':
             self.send_response(200)
             self.send_header('Content-type','image/x-icon')
+            self.send_header('Content-Length', len(FAVICON))
             self.end_headers()
-            self.wfile.write(FAVICON)
+            self.write_body(FAVICON)
             emit_event(log_file, 'done sending favicon.ico of length {}'.format(len(FAVICON)))
             return
+
+        # counters and latency histograms
+        if path == '/metrics':
+            text = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-type', ServerMetrics.CONTENT_TYPE)
+            self.send_header('Content-Length', len(text))
+            self.end_headers()
+            self.write_body(text)
+            return
         
+        # live MJPEG stream
+        if path == '/stream':
+            self.send_stream(stream_broadcaster, CAMERA_DEVICE)
+            return
+
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            max_age = float(query['max_age'][0]) if 'max_age' in query else max_image_age
+            variant = choose_variant(query)
+            newer_than = None
+            if 'wait_newer_than' in query:
+                newer_than = HttpCaching.parse_etag(query['wait_newer_than'][0])
+            timeout = HttpCaching.long_poll_timeout(query)
+        except ValueError as e:
+            self.send_text(400, '400 BAD REQUEST: {}'.format(e))
+            return
+
+        if video_mode and path != '/still' and variant == FULL_VARIANT:
+            # served from memory, max_age does not apply
+            if newer_than is None:
+                try:
+                    captured = get_video_image(FIRST_VIDEO_IMAGE_TIMEOUT_IN_SECONDS)
+                except RuntimeError as e:
+                    self.send_text(503, '503 SERVICE UNAVAILABLE: {}'.format(e))
+                    return
+            else:
+                captured = video_images.wait_for_newer(newer_than, timeout)
+        else:
+            try:
+                if newer_than is None:
+                    captured = get_image(max_age, variant)
+                else:
+                    captured = wait_for_newer_image(newer_than, max_age, timeout, variant)
+            except Exception as e:
+                # the camera failed twice, capture() opened it again in between
+                self.send_text(503, '503 SERVICE UNAVAILABLE: unable to capture image, {}'.format(e))
+                return
+        if captured is None:
+            self.send_not_modified(None)
+            return
+        if HttpCaching.is_not_modified(self.headers, captured.etag, captured.modified):
+            self.send_not_modified(captured)
+            return
+
         # Send response status code
         self.send_response(200)
         # Send headers
+        image=captured.image
         self.send_header('Content-type','image/jpeg')
+        self.send_header('Content-Length', len(image))
+        self.send_cache_headers(captured)
         self.end_headers()
-        image=capture_image()
-        self.wfile.write(image)
+        self.write_body(image, CAMERA_DEVICE)
         emit_event(log_file, 'done sending image of length {}'.format(len(image)))
         return
     
@@ -166,29 +736,110 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port', 
                         help='port number for web server', 
                         default=DEFAULT_LISTEN_PORT)
+    parser.add_argument('-m', '--max_age', 
+                        help='seconds an image is reused for other requests', 
+                        default=SharedCapture.DEFAULT_MAX_AGE_IN_SECONDS)
+    parser.add_argument('-e', '--exposure_refresh', 
+                        help='minutes between measuring the locked exposure again, 0 for automatic exposure', 
+                        default=DEFAULT_EXPOSURE_REFRESH_IN_MINUTES)
+    parser.add_argument('-V', '--video', 
+                        help='take images from the video port all the time and serve the latest at /, full resolution at /still', 
+                        action='store_true')
+    parser.add_argument('-s', '--video_size', 
+                        help='size of video images, WIDTHxHEIGHT', 
+                        default=DEFAULT_VIDEO_SIZE)
+    parser.add_argument('-f', '--video_fps', 
+                        help='video images taken each second', 
+                        default=DEFAULT_VIDEO_FPS)
+    parser.add_argument('-S', '--stream_size', 
+                        help='size of /stream images, WIDTHxHEIGHT', 
+                        default=DEFAULT_STREAM_SIZE)
+    parser.add_argument('-F', '--stream_fps', 
+                        help='most /stream images sent each second', 
+                        default=CameraRequestHandler.DEFAULT_STREAM_FPS)
+    parser.add_argument('-n', '--max_streams', 
+                        help='most streams sent at one time, more get a 503', 
+                        default=CameraRequestHandler.DEFAULT_MAX_STREAMS)
     parser.add_argument("-l", "--log_filename", 
                         help="file to log data, create or append", 
                         default=DEFAULT_LOG_FILE_NAME)
+    parser.add_argument("-i", "--icon_filename", 
+                        help="favicon.ico file to serve", 
+                        default=DEFAULT_ICON_FILE_NAME)
+    JsonLogWriter.add_rotation_arguments(parser)
+    parser.add_argument('-A', '--asyncio', 
+                        help='serve with asyncio, HTTP/1.1 keep-alive and a bounded thread pool', 
+                        action='store_true')
+    parser.add_argument('-w', '--workers', 
+                        help='threads running requests when using asyncio', 
+                        default=AsyncHttpServer.DEFAULT_MAX_WORKERS)
+    parser.add_argument('-r', '--max_requests', 
+                        help='requests accepted at one time when using asyncio, more get a 503', 
+                        default=AsyncHttpServer.DEFAULT_MAX_IN_FLIGHT)
     args = parser.parse_args()
 
+    if CaptureBackends.picamera is None:
+        parser.error('the picamera module is needed to use the Raspberry Pi camera')
+
     if (args.debug):
         DEBUG = 1
         print('turned on DEBUG from command line.',
               file=sys.stderr, flush=True)
 
     log_filename = args.log_filename
+    try:
+        log_rotation = JsonLogWriter.rotation_settings(args)
+    except ValueError as e:
+        parser.error('log rotation: {}'.format(e))
     given_address = args.address
     given_port = int(args.port)
+    use_asyncio = args.asyncio
+    max_workers = int(args.workers)
+    max_in_flight = int(args.max_requests)
+    max_image_age = float(args.max_age)
+    exposure_refresh = float(args.exposure_refresh) * 60
+    video_mode = args.video
+    try:
+        video_size = parse_size(args.video_size)
+    except ValueError:
+        parser.error('video_size must be WIDTHxHEIGHT, e.g. {}'.format(DEFAULT_VIDEO_SIZE))
+    video_fps = float(args.video_fps)
+    if video_fps <= 0:
+        parser.error('video_fps must be more than 0')
+    try:
+        stream_size = parse_size(args.stream_size)
+    except ValueError:
+        parser.error('stream_size must be WIDTHxHEIGHT, e.g. {}'.format(DEFAULT_STREAM_SIZE))
+    stream_fps = float(args.stream_fps)
+    if stream_fps <= 0:
+        parser.error('stream_fps must be more than 0')
+    if use_asyncio and int(args.max_streams) >= max_in_flight:
+        parser.error('max_streams must be less than max_requests so other requests can be served')
+    Camera_HTTPServer_RequestHandler.stream_slots = threading.BoundedSemaphore(int(args.max_streams))
 
     server_address = (given_address, given_port)
     
-    # open file to log pressure over time
-    log_file = open(log_filename, 'a')
+    # log is written by a background thread
+    log_file = JsonLogWriter.JsonLogWriter(log_filename,
+                                           **log_rotation)
+    Camera_HTTPServer_RequestHandler.log_file = log_file
     emit_event(log_file, 'STARTING CameraServer')
     emit_event(log_file, 'address: {}'.format(server_address))
+    emit_event(log_file, 'exposure_refresh: {} seconds'.format(exposure_refresh))
+
+    camera_session = CameraSession(exposure_refresh)
+    atexit.register(camera_session.close)
+    stream_broadcaster = StreamBroadcaster(camera_session, stream_size, stream_fps)
+    emit_event(log_file, 'stream_size: {}  stream_fps: {}  max_streams: {}'.format(stream_size, stream_fps,
+                                                                                   args.max_streams))
+    if video_mode:
+        emit_event(log_file, 'video_size: {}  video_fps: {}'.format(video_size, video_fps))
+        threading.Thread(target=camera_session.run_video, args=(video_size, video_fps), daemon=True).start()
+    else:
+        threading.Thread(target=camera_session.warm_up, daemon=True).start()
     
-    with open(DEFAULT_ICON_FILE_NAME, 'rb') as icon_file:
-        FAVICON = bytearray(icon_file.read())
+    with open(args.icon_filename, 'rb') as icon_file:
+        FAVICON = icon_file.read()
     emit_event(log_file, 'read icon file of length = {}'.format(len(FAVICON)))
     if DEBUG:
         print('read icon file of length = {}'.format(len(FAVICON)),
@@ -198,8 +849,14 @@ if __name__ == '__main__':
         print('server_address = {}'.format(server_address),
               file=sys.stderr, flush=True)
 
+    if use_asyncio:
+        httpd_server = AsyncHttpServer.AsyncHTTPServer(server_address,
+                                                       Camera_HTTPServer_RequestHandler,
+                                                       max_workers=max_workers,
+                                                       max_in_flight=max_in_flight)
+        emit_event(log_file, 'using asyncio with {} workers and at most {} requests in flight'.format(max_workers, max_in_flight))
     # use newer, threading version, if available
-    if (sys.version_info[0] >= 3 and sys.version_info[1] >= 7):
+    elif (sys.version_info[0] >= 3 and sys.version_info[1] >= 7):
         httpd_server = ThreadingHTTPServer(server_address,
                                            Camera_HTTPServer_RequestHandler)
     else:
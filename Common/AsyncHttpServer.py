@@ -0,0 +1,337 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+asyncio front end for the camera servers.
+
+AsyncHTTPServer takes the place of ThreadingHTTPServer and drives the same
+BaseHTTPRequestHandler subclass, so the URLs a server provides do not 
+change.  Connections are held by the event loop and use HTTP/1.1 
+keep-alive.  Each request is run by the handler on a bounded pool of 
+worker threads, since capture and encode block, and requests over the
+in-flight limit, or beyond the few which may wait for a worker, get a 503
+with Retry-After instead of another thread.
+
+Requests which run for a long time, such as streams and long-polls, would
+hold a worker for all that time.  If the handler class has a static 
+is_long_running(path) method the requests it picks are given their own 
+thread instead, they still count toward the in-flight limit.
+
+When the handler does not send a Content-Length the body is sent with
+chunked transfer encoding so the connection can be kept open.
+"""
+
+import asyncio
+import concurrent.futures
+import http.client
+import io
+import sys
+
+DEFAULT_MAX_WORKERS = '8'
+DEFAULT_MAX_IN_FLIGHT = '32'
+KEEP_ALIVE_TIMEOUT_IN_SECONDS = 15
+MAX_REQUEST_LINE_LENGTH = 65536
+MAX_HEADER_LINES = 100
+OVERLOAD_RETRY_AFTER_IN_SECONDS = 1
+
+# status codes which never have a body
+NO_BODY_STATUS_CODES = (204, 304)
+
+
+class _ResponseWriter():
+    '''
+    File like object used as the wfile of a request handler.
+
+    The handler runs in a worker thread.  Each write is handed to the event
+    loop and waits for the connection to drain, so a slow client only slows
+    its own handler.  The header block is checked on its way through to 
+    decide on chunked encoding and whether the connection stays open.
+    '''
+    def __init__(self, loop, writer, request_version, keep_alive):
+        self._loop = loop
+        self._writer = writer
+        self._request_version = request_version
+        self.keep_alive = keep_alive
+        self._head = b''
+        self._head_sent = False
+        self._chunked = False
+
+    def _send(self, *parts):
+        asyncio.run_coroutine_threadsafe(self._write(parts), self._loop).result()
+
+    async def _write(self, parts):
+        self._writer.writelines(parts)
+        await self._writer.drain()
+
+    def _prepare_head(self, head):
+        '''
+        return the header block, adding headers needed for keep-alive
+        '''
+        lines = head[:-4].split(b'\r\n')
+        status_fields = lines[0].split()
+        code = int(status_fields[1]) if len(status_fields) > 1 else 200
+        names = dict()
+        for line in lines[1:]:
+            name, _, value = line.partition(b':')
+            names[name.strip().lower()] = value.strip().lower()
+        if names.get(b'connection') == b'close':
+            self.keep_alive = False
+        if (b'content-length' in names) or (code in NO_BODY_STATUS_CODES) or (code < 200):
+            pass
+        elif self._request_version == 'HTTP/1.1':
+            lines.append(b'Transfer-Encoding: chunked')
+            self._chunked = True
+        else:
+            # an HTTP/1.0 client finds the end of the body when the connection closes
+            self.keep_alive = False
+        if self.keep_alive and self._request_version != 'HTTP/1.1':
+            lines.append(b'Connection: keep-alive')
+        elif not self.keep_alive and b'connection' not in names:
+            lines.append(b'Connection: close')
+        return b'\r\n'.join(lines) + b'\r\n\r\n'
+
+    def write(self, data):
+        if not self._head_sent:
+            self._head += bytes(data)
+            end = self._head.find(b'\r\n\r\n')
+            if end < 0:
+                return len(data)
+            self._send(self._prepare_head(self._head[:end+4]))
+            self._head_sent = True
+            data = self._head[end+4:]
+            self._head = b''
+        if len(data) == 0:
+            return 0
+        if self._chunked:
+            self._send(b'%x\r\n' % len(data), data, b'\r\n')
+        else:
+            self._send(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        '''
+        end the response
+        '''
+        if not self._head_sent:
+            # nothing usable was sent so the connection can not be reused
+            self.keep_alive = False
+        elif self._chunked:
+            self._send(b'0\r\n\r\n')
+
+
+class AsyncHTTPServer():
+    '''
+    Serve handler_class from an asyncio event loop.
+
+    server_address and handler_class are the same as for HTTPServer.  
+    max_workers threads run handlers, at most max_queued requests (by 
+    default max_workers) wait for one of them and at most max_in_flight 
+    requests are accepted at one time.
+    '''
+    def __init__(self, server_address, handler_class, 
+                 max_workers=int(DEFAULT_MAX_WORKERS),
+                 max_in_flight=int(DEFAULT_MAX_IN_FLIGHT),
+                 max_queued=None):
+        self.server_address = server_address
+        self.RequestHandlerClass = handler_class
+        self.max_workers = max_workers
+        self.max_in_flight = max_in_flight
+        self.max_queued = max_workers if max_queued is None else max_queued
+        self.in_flight = 0
+        # requests waiting for a worker
+        self.queued = 0
+        self._is_long_running = getattr(handler_class, 'is_long_running', None)
+        self._executor = None
+        self._long_running_executor = None
+        self._loop = None
+
+    def serve_forever(self):
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+        # long running requests are limited by max_in_flight instead
+        self._long_running_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_in_flight)
+        try:
+            server = await asyncio.start_server(self._handle_connection,
+                                                self.server_address[0],
+                                                self.server_address[1],
+                                                limit=MAX_REQUEST_LINE_LENGTH)
+            self.server_address = server.sockets[0].getsockname()[:2]
+            async with server:
+                await server.serve_forever()
+        finally:
+            self._executor.shutdown(wait=False)
+            self._long_running_executor.shutdown(wait=False)
+
+    async def _read_request(self, reader):
+        '''
+        return (request_line, header_bytes) or None when the client is done
+        '''
+        try:
+            request_line = await asyncio.wait_for(reader.readline(),
+                                                  KEEP_ALIVE_TIMEOUT_IN_SECONDS)
+        except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            return None
+        if not request_line:
+            return None
+        header_lines = list()
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(),
+                                              KEEP_ALIVE_TIMEOUT_IN_SECONDS)
+            except (asyncio.TimeoutError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+                return None
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line)
+            if len(header_lines) > MAX_HEADER_LINES:
+                return None
+        return request_line, b''.join(header_lines)
+
+    async def _send_simple(self, writer, version, code, reason, text, keep_alive, extra_headers=()):
+        body = text.encode('utf-8')
+        lines = ['{} {} {}'.format(version, code, reason),
+                 'Content-type: text/text',
+                 'Content-Length: {}'.format(len(body))]
+        lines.extend(extra_headers)
+        if not keep_alive:
+            lines.append('Connection: close')
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8') + body)
+        await writer.drain()
+
+    async def _handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        try:
+            while True:
+                request = await self._read_request(reader)
+                if request is None:
+                    break
+                request_line, header_bytes = request
+                words = request_line.decode('iso-8859-1').split()
+                if len(words) != 3 or not words[2].startswith('HTTP/'):
+                    await self._send_simple(writer, 'HTTP/1.1', 400, 'Bad Request',
+                                            '400 BAD REQUEST: request line not understood', False)
+                    break
+                command, path, version = words
+                headers = http.client.parse_headers(io.BytesIO(header_bytes))
+                connection = headers.get('Connection', '').lower()
+                if version == 'HTTP/1.1':
+                    keep_alive = connection != 'close'
+                else:
+                    keep_alive = connection == 'keep-alive'
+                try:
+                    length = int(headers.get('Content-Length', 0) or 0)
+                    if length < 0:
+                        raise ValueError('Content-Length of {} is negative'.format(length))
+                except ValueError as e:
+                    await self._send_simple(writer, 'HTTP/1.1', 400, 'Bad Request',
+                                            '400 BAD REQUEST: {}'.format(e), False)
+                    break
+                body = await reader.readexactly(length) if length > 0 else b''
+
+                long_running = (self._is_long_running is not None) and self._is_long_running(path)
+                if (self.in_flight >= self.max_in_flight 
+                    or (not long_running and self.queued >= self.max_queued)):
+                    await self._send_simple(writer, 'HTTP/1.1', 503, 'Service Unavailable',
+                                            '503 SERVICE UNAVAILABLE: too many requests', keep_alive,
+                                            ['Retry-After: {}'.format(OVERLOAD_RETRY_AFTER_IN_SECONDS)])
+                    if not keep_alive:
+                        break
+                    continue
+
+                self.in_flight += 1
+                try:
+                    if long_running:
+                        keep_alive = await self._loop.run_in_executor(self._long_running_executor, 
+                                                                      self._run_handler,
+                                                                      writer, client_address, request_line,
+                                                                      command, path, version, headers,
+                                                                      body, keep_alive)
+                    else:
+                        self.queued += 1
+                        keep_alive = await self._loop.run_in_executor(self._executor, self._run_queued,
+                                                                      writer, client_address, request_line,
+                                                                      command, path, version, headers,
+                                                                      body, keep_alive)
+                finally:
+                    self.in_flight -= 1
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _dequeue(self):
+        self.queued -= 1
+
+    def _run_queued(self, *args):
+        '''
+        run the request handler once a worker has taken the request
+        '''
+        self._loop.call_soon_threadsafe(self._dequeue)
+        return self._run_handler(*args)
+
+    def _run_handler(self, writer, client_address, request_line, command, path, version, 
+                     headers, body, keep_alive):
+        '''
+        run the request handler in a worker thread, return True if the 
+        connection can be used for another request
+        '''
+        wfile = _ResponseWriter(self._loop, writer, version, keep_alive)
+        # build the handler by hand since the request is already parsed
+        handler = self.RequestHandlerClass.__new__(self.RequestHandlerClass)
+        handler.server = self
+        handler.client_address = client_address
+        handler.request = None
+        handler.rfile = io.BytesIO(body)
+        handler.wfile = wfile
+        handler.raw_requestline = request_line
+        handler.requestline = request_line.decode('iso-8859-1').rstrip('\r\n')
+        handler.command = command
+        handler.path = path
+        handler.request_version = version
+        handler.protocol_version = 'HTTP/1.1'
+        handler.headers = headers
+        handler.close_connection = not keep_alive
+        try:
+            method = getattr(handler, 'do_' + command, None)
+            if method is None:
+                handler.send_error(501, 'Unsupported method ({})'.format(command))
+            else:
+                method()
+            wfile.finish()
+        except ConnectionError:
+            # the client went away
+            return False
+        except Exception as e:
+            print('request "{}" from {} failed with {}'.format(handler.requestline, client_address, e),
+                  file=sys.stderr, flush=True)
+            return False
+        return wfile.keep_alive and not handler.close_connection
@@ -0,0 +1,182 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Request handler parts shared by the camera servers.
+
+CameraRequestHandler is the BaseHTTPRequestHandler each server's handler
+is made from.  It counts responses and bytes in the server's metrics,
+sends short text responses, the ETag and Last-Modified headers of an
+image, 304 responses and MJPEG streams, logging them to the server's log.
+"""
+
+from http.server import BaseHTTPRequestHandler
+import queue
+import threading
+import time
+
+import HttpCaching
+import ServerMetrics
+from JsonLogWriter import emit_event
+
+# MJPEG streams, the default rate and number of streams of each server
+DEFAULT_STREAM_FPS = '5'
+DEFAULT_MAX_STREAMS = '4'
+STREAM_JPEG_QUALITY = 80
+# images waiting to be sent to each stream client, older ones are dropped
+STREAM_CLIENT_QUEUE_FRAMES = 2
+STREAM_BOUNDARY = 'jpeg-frame'
+STREAM_FRAME_TIMEOUT_IN_SECONDS = 10
+STREAM_BUSY_RETRY_AFTER_IN_SECONDS = 10
+
+
+class CameraRequestHandler(BaseHTTPRequestHandler):
+    '''
+    A subclass of BaseHTTPRequestHandler with the responses the camera
+    servers have in common.
+
+    A server sets these on its own subclass:
+
+        metrics         its ServerMetrics
+        log_file        its JsonLogWriter, once it is made
+        stream_slots    a semaphore with a slot for each stream allowed
+    '''
+    metrics = None
+    log_file = None
+    stream_slots = threading.BoundedSemaphore(int(DEFAULT_MAX_STREAMS))
+
+    def send_response(self, code, message=None):
+        '''
+        count the response by status code then send it
+        '''
+        self.metrics.inc(ServerMetrics.REQUESTS, code=code)
+        super().send_response(code, message)
+
+    def write_body(self, data, video_device=None):
+        '''
+        write data to the client, counting the bytes sent and timing the
+        write when it is an image from video_device
+        '''
+        if video_device is None:
+            self.wfile.write(data)
+        else:
+            with self.metrics.time(ServerMetrics.STAGE_SECONDS, device=video_device, stage='write'):
+                self.wfile.write(data)
+        self.metrics.inc(ServerMetrics.RESPONSE_BYTES, len(data))
+
+    def send_text(self, code, text):
+        '''
+        send a short text response and log it
+        '''
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-type','text/text')
+        self.send_header('Content-Length', len(body))
+        self.end_headers()
+        self.write_body(body)
+        emit_event(self.log_file, text)
+
+    def send_cache_headers(self, captured):
+        '''
+        send the headers that let a client ask if it has this image already,
+        captured has the etag and modified time of the image
+        '''
+        self.send_header('ETag', captured.etag)
+        self.send_header('Last-Modified', HttpCaching.http_date(captured.modified))
+        self.send_header('Cache-Control', 'no-cache')
+
+    def send_not_modified(self, captured):
+        '''
+        tell the client the image it has is still current
+        '''
+        self.send_response(304)
+        if captured is not None:
+            self.send_cache_headers(captured)
+        self.end_headers()
+        emit_event(self.log_file, '304 NOT MODIFIED')
+
+    def send_stream(self, source, video_device, fps=None):
+        '''
+        send a multipart/x-mixed-replace stream of the JPEG images from
+        source until the client goes away, at most fps images a second
+        when fps is given
+
+        source has attach(), which returns a queue the images are put on,
+        and detach(queue).  A None on the queue ends the stream.
+        '''
+        if not self.stream_slots.acquire(blocking=False):
+            self.send_response(503)
+            self.send_header('Content-type','text/text')
+            self.send_header('Retry-After', str(STREAM_BUSY_RETRY_AFTER_IN_SECONDS))
+            self.end_headers()
+            self.write_body('503 SERVICE UNAVAILABLE: too many streams'.encode('utf-8'))
+            emit_event(self.log_file, '503 SERVICE UNAVAILABLE: too many streams')
+            return
+        try:
+            try:
+                client = source.attach()
+            except Exception as e:
+                self.send_text(503, '503 SERVICE UNAVAILABLE: unable to start stream, {}'.format(e))
+                return
+            frame_count = 0
+            try:
+                self.send_response(200)
+                self.send_header('Content-type',
+                                 'multipart/x-mixed-replace; boundary={}'.format(STREAM_BOUNDARY))
+                self.send_header('Cache-Control', 'no-cache')
+                self.end_headers()
+                next_frame_time = time.time()
+                while True:
+                    image = client.get(timeout=STREAM_FRAME_TIMEOUT_IN_SECONDS)
+                    # send only the newest image if this client is behind
+                    while image is not None and not client.empty():
+                        image = client.get_nowait()
+                    if image is None:
+                        self.write_body('--{}--\r\n'.format(STREAM_BOUNDARY).encode('utf-8'))
+                        emit_event(self.log_file, 'stream of device {} ended by its source'.format(video_device))
+                        break
+                    part_header = '--{}\r\nContent-type: image/jpeg\r\nContent-Length: {}\r\n\r\n'.format(STREAM_BOUNDARY,
+                                                                                                    len(image))
+                    self.write_body(part_header.encode('utf-8'))
+                    self.write_body(image, video_device)
+                    self.write_body(b'\r\n')
+                    frame_count += 1
+                    if fps is None:
+                        continue
+                    next_frame_time += 1.0 / fps
+                    delay_time = next_frame_time - time.time()
+                    if 0 < delay_time:
+                        time.sleep(delay_time)
+                    else:
+                        next_frame_time = time.time()
+            except queue.Empty:
+                emit_event(self.log_file, 'stream of device {} stopped, no images'.format(video_device))
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+            finally:
+                source.detach(client)
+            emit_event(self.log_file, 'done sending stream of {} images from device {}'.format(frame_count,
+                                                                                               video_device))
+        finally:
+            self.stream_slots.release()
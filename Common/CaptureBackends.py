@@ -0,0 +1,384 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Sources of frames for the camera servers.
+
+Each backend gives BGR frames, as numpy arrays, from one device through 
+the same methods so the caching, encoding, streaming and metrics of a 
+server work with any camera:
+
+    open()              open the device, call before the others
+    set_resolution(w, h)  ask for frames of w x h, the device picks the nearest
+    is_open()
+    grab()              take a frame, return False if that failed
+    retrieve(image=None)  return (ok, frame) for the grabbed frame, read
+                        into image when it is an array of the right shape
+    read(image=None)    grab() and retrieve()
+    close()
+
+OpenCvBackend reads USB and other V4L2 cameras with cv2.VideoCapture,
+PiCameraBackend reads the Raspberry Pi camera with picamera and 
+SyntheticBackend makes moving test frames so a server can run with no 
+camera at all.  make_backend() picks one by name.
+"""
+
+import abc
+import threading
+import time
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None      # only the picamera backend can be used
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import picamera
+except ImportError:
+    picamera = None     # not a Raspberry Pi
+
+BACKENDS = ('opencv', 'picamera', 'synthetic')
+DEFAULT_BACKEND = 'opencv'
+
+# the Raspberry Pi camera's GPU pads raw frames to these multiples
+PICAMERA_WIDTH_ALIGNMENT = 32
+PICAMERA_HEIGHT_ALIGNMENT = 16
+PICAMERA_SETTLE_TIME_IN_SECONDS = 2.0
+
+# synthetic devices
+SYNTHETIC_DEVICES = 2
+SYNTHETIC_MAX_RESOLUTION = (3840, 2160)
+SYNTHETIC_FPS = 30
+SYNTHETIC_BAR_WIDTH_FRACTION = 0.05
+
+_patterns = dict()
+_patterns_lock = threading.Lock()
+
+
+def fit_image_size(frame_width, frame_height, width=None, height=None):
+    '''
+    return the (width, height) to scale a frame to so it fits in width and
+    height, or None if the frame should not be scaled
+
+    Frames are never scaled up.
+    '''
+    scale = 1.0
+    if width is not None:
+        scale = min(scale, width / frame_width)
+    if height is not None:
+        scale = min(scale, height / frame_height)
+    if scale >= 1.0:
+        return None
+    return (max(1, round(frame_width * scale)), max(1, round(frame_height * scale)))
+
+
+def limit_resolution(width, height, max_width, max_height):
+    '''
+    return (width, height) scaled down, keeping its shape, to fit in 
+    max_width x max_height
+    '''
+    return fit_image_size(width, height, max_width, max_height) or (width, height)
+
+
+def synthetic_pattern(width, height):
+    '''
+    return the fixed pattern synthetic frames are made from, made once 
+    for each size
+    '''
+    with _patterns_lock:
+        frame = _patterns.get((width, height))
+        if frame is None:
+            rows = numpy.arange(height, dtype=numpy.uint32)[:, None]
+            columns = numpy.arange(width, dtype=numpy.uint32)[None, :]
+            frame = numpy.empty((height, width, 3), numpy.uint8)
+            frame[..., 0] = (rows * 255 // max(height - 1, 1)).astype(numpy.uint8)
+            frame[..., 1] = (columns * 255 // max(width - 1, 1)).astype(numpy.uint8)
+            frame[..., 2] = ((rows + columns) // 8 % 256).astype(numpy.uint8)
+            frame.flags.writeable = False
+            _patterns[(width, height)] = frame
+        return frame
+
+
+def synthetic_frame(width, height, count, image=None):
+    '''
+    return synthetic frame number count, a pattern with a bar which moves
+    each frame, in image if it is given and the right shape
+    '''
+    base = synthetic_pattern(width, height)
+    if image is None or image.shape != base.shape or image.dtype != base.dtype:
+        image = numpy.empty_like(base)
+    image[...] = base
+    bar = max(1, int(width * SYNTHETIC_BAR_WIDTH_FRACTION))
+    left = (count * bar) % max(width - bar, 1)
+    image[:, left:left + bar] = 255
+    return image
+
+
+class CaptureBackend(abc.ABC):
+    '''
+    A device frames are read from, see the module description for the 
+    methods a backend provides.
+
+    A backend is not thread safe, the server holds a lock around its use.
+    queues_frames is True for a device which keeps frames taken while 
+    nobody reads, so they are stale by the time they are read.
+    '''
+    name = None
+    queues_frames = False
+
+    def __init__(self, device):
+        self.device = device
+
+    @abc.abstractmethod
+    def open(self):
+        pass
+
+    def set_resolution(self, width, height):
+        pass
+
+    @abc.abstractmethod
+    def is_open(self):
+        pass
+
+    @abc.abstractmethod
+    def grab(self):
+        pass
+
+    @abc.abstractmethod
+    def retrieve(self, image=None):
+        pass
+
+    def read(self, image=None):
+        if not self.grab():
+            return False, None
+        return self.retrieve(image)
+
+    def close(self):
+        pass
+
+
+class OpenCvBackend(CaptureBackend):
+    '''
+    A USB, or other V4L2, camera read with cv2.VideoCapture.
+    '''
+    name = 'opencv'
+    queues_frames = True
+
+    def __init__(self, device):
+        if cv2 is None:
+            raise RuntimeError('the opencv backend needs the cv2 module')
+        super().__init__(device)
+        self._cap = None
+
+    def open(self):
+        cap = cv2.VideoCapture(self.device)
+        if not cap.isOpened():
+            cap.release()
+            raise RuntimeError('unable to open capture device {}'.format(self.device))
+        self._cap = cap
+
+    def set_resolution(self, width, height):
+        self._cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        self._cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+
+    def is_open(self):
+        return self._cap is not None
+
+    def grab(self):
+        return self._cap.grab()
+
+    def retrieve(self, image=None):
+        return self._cap.retrieve(image=image)
+
+    def read(self, image=None):
+        return self._cap.read(image=image)
+
+    def close(self):
+        if self._cap is not None:
+            self._cap.release()
+            self._cap = None
+
+
+class PiCameraBackend(CaptureBackend):
+    '''
+    The Raspberry Pi camera read with picamera.
+
+    The camera is left running with the preview on so frames are taken 
+    from the video port without waiting for the sensor.  The camera 
+    attribute is the PiCamera, for a server which wants the GPU to encode
+    JPEG or MJPEG itself.
+    '''
+    name = 'picamera'
+
+    def __init__(self, device=0):
+        if picamera is None:
+            raise RuntimeError('the picamera backend needs the picamera module')
+        super().__init__(device)
+        self.camera = None
+        self._padded = None     # frame as the GPU writes it, padded
+        self._frame = None      # the grabbed frame, a view of _padded
+
+    def open(self):
+        camera = picamera.PiCamera(camera_num=self.device)
+        # disable LED on camera
+        camera.led = False
+        self.camera = camera
+
+    def set_resolution(self, width, height):
+        '''
+        set the resolution, scaled down to fit the sensor if it is larger,
+        and start the camera running
+        '''
+        self.camera.resolution = limit_resolution(width, height, *self.camera.MAX_RESOLUTION)
+        self.camera.start_preview()
+
+    def lock_exposure(self, settle_time=PICAMERA_SETTLE_TIME_IN_SECONDS, lock=True):
+        '''
+        let the automatic exposure and white balance settle for settle_time
+        seconds then, when lock is True, fix them so each image is taken 
+        the same way
+        '''
+        camera = self.camera
+        camera.shutter_speed = 0
+        camera.exposure_mode = 'auto'
+        camera.awb_mode = 'auto'
+        time.sleep(settle_time)
+        if lock:
+            camera.shutter_speed = camera.exposure_speed
+            camera.exposure_mode = 'off'
+            gains = camera.awb_gains
+            camera.awb_mode = 'off'
+            camera.awb_gains = gains
+
+    def is_open(self):
+        return self.camera is not None
+
+    def grab(self):
+        width, height = self.camera.resolution
+        # the GPU writes whole blocks so the rows and columns are padded
+        shape = (-(-height // PICAMERA_HEIGHT_ALIGNMENT) * PICAMERA_HEIGHT_ALIGNMENT,
+                 -(-width // PICAMERA_WIDTH_ALIGNMENT) * PICAMERA_WIDTH_ALIGNMENT, 3)
+        if self._padded is None or self._padded.shape != shape:
+            self._padded = numpy.empty(shape, numpy.uint8)
+        self.camera.capture(self._padded, 'bgr', use_video_port=True)
+        self._frame = self._padded[:height, :width]
+        return True
+
+    def retrieve(self, image=None):
+        frame = self._frame
+        if frame is None:
+            return False, None
+        self._frame = None
+        # the next grab writes to image, a frame from an earlier retrieve 
+        # the caller has finished with, instead of a new buffer
+        if image is not None and getattr(image.base, 'shape', None) == self._padded.shape:
+            self._padded = image.base
+        else:
+            self._padded = None
+        return True, frame
+
+    def close(self):
+        if self.camera is not None:
+            try:
+                self.camera.close()
+            finally:
+                self.camera = None
+                self._padded = None
+                self._frame = None
+
+
+class SyntheticBackend(CaptureBackend):
+    '''
+    Test frames made in memory at the rate of a camera, a pattern with a
+    bar which moves each frame.
+    '''
+    name = 'synthetic'
+
+    def __init__(self, device, fps=SYNTHETIC_FPS):
+        if numpy is None:
+            raise RuntimeError('the synthetic backend needs the numpy module')
+        if not 0 <= device < SYNTHETIC_DEVICES:
+            raise RuntimeError('unable to open capture device {}'.format(device))
+        super().__init__(device)
+        self.interval = 1.0 / fps
+        self.resolution = SYNTHETIC_MAX_RESOLUTION
+        self._open = False
+        self._count = 0
+        self._next_time = 0
+
+    def open(self):
+        self._open = True
+        self._next_time = time.time()
+
+    def set_resolution(self, width, height):
+        self.resolution = limit_resolution(width, height, *SYNTHETIC_MAX_RESOLUTION)
+
+    def is_open(self):
+        return self._open
+
+    def grab(self):
+        # frames come at the rate of a camera
+        delay_time = self._next_time - time.time()
+        if 0 < delay_time:
+            time.sleep(delay_time)
+        self._next_time = max(self._next_time + self.interval, time.time())
+        self._count += 1
+        return self._open
+
+    def retrieve(self, image=None):
+        width, height = self.resolution
+        return True, synthetic_frame(width, height, self._count, image)
+
+    def close(self):
+        self._open = False
+
+
+def make_backend(name, device):
+    '''
+    return a new, not yet opened, backend called name for device
+    '''
+    if name == 'opencv':
+        return OpenCvBackend(device)
+    if name == 'picamera':
+        return PiCameraBackend(device)
+    if name == 'synthetic':
+        return SyntheticBackend(device)
+    raise ValueError('backend "{}" is not one of {}'.format(name, BACKENDS))
+
+
+def describe_devices(name):
+    '''
+    return a list of maps describing the devices of backend name, for the
+    backends which do not look for devices in /dev
+    '''
+    if name == 'picamera':
+        return [{'device': 0, 'name': 'Raspberry Pi camera', 'backend': name}]
+    if name == 'synthetic':
+        return [{'device': d, 'name': 'synthetic camera {}'.format(d), 'backend': name,
+                 'resolutions': [list(SYNTHETIC_MAX_RESOLUTION)]}
+                for d in range(SYNTHETIC_DEVICES)]
+    raise ValueError('backend "{}" finds its devices in /dev'.format(name))
@@ -0,0 +1,120 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Conditional GET support shared by the camera servers.
+
+Every frame a server captures gets a sequence number.  The ETag of an 
+image is made from the sequence number and a tag for this run of the 
+server so a restarted server never matches an old ETag.  ETags are weak
+since the same frame can be sent in different formats and sizes.
+"""
+
+import email.utils
+import itertools
+import time
+
+# different for each run of the server
+SERVER_INSTANCE = '{:x}'.format(int(time.time() * 1000))
+
+# time a long-poll waits for a newer frame before answering 304
+DEFAULT_LONG_POLL_TIMEOUT_IN_SECONDS = 30
+MAXIMUM_LONG_POLL_TIMEOUT_IN_SECONDS = 300
+
+_sequence_numbers = itertools.count(1)
+
+
+def next_sequence():
+    '''
+    return a new frame sequence number
+    '''
+    return next(_sequence_numbers)
+
+
+def make_etag(sequence):
+    '''
+    return the ETag for the frame with sequence
+    '''
+    return 'W/"{}-{}"'.format(SERVER_INSTANCE, sequence)
+
+
+def _opaque_tag(etag):
+    etag = etag.strip()
+    if etag.startswith('W/'):
+        etag = etag[2:]
+    return etag.strip('"')
+
+
+def parse_etag(etag):
+    '''
+    return the sequence from an ETag made by make_etag, 0 when the ETag is 
+    from another run of the server so every current frame is newer
+
+    Raise ValueError if the ETag can not be understood.
+    '''
+    instance, _, sequence = _opaque_tag(etag).rpartition('-')
+    sequence = int(sequence)
+    if instance != SERVER_INSTANCE:
+        return 0
+    return sequence
+
+
+def http_date(when):
+    '''
+    return when, in seconds since the epoch, as an HTTP date
+    '''
+    return email.utils.formatdate(when, usegmt=True)
+
+
+def is_not_modified(headers, etag, when):
+    '''
+    return True if the If-None-Match or If-Modified-Since in headers 
+    shows the client already has the image with etag captured at when
+
+    If-None-Match is used when both are given.
+    '''
+    if_none_match = headers.get('If-None-Match')
+    if if_none_match is not None:
+        tags = [_opaque_tag(t) for t in if_none_match.split(',')]
+        return '*' in tags or _opaque_tag(etag) in tags
+    if_modified_since = headers.get('If-Modified-Since')
+    if if_modified_since is not None:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates only have whole seconds
+        return int(when) <= since
+    return False
+
+
+def long_poll_timeout(query):
+    '''
+    return the seconds a ?wait_newer_than= request may wait, from ?timeout=
+
+    Raise ValueError if the timeout is not a number.
+    '''
+    if 'timeout' not in query:
+        return DEFAULT_LONG_POLL_TIMEOUT_IN_SECONDS
+    return min(max(float(query['timeout'][0]), 0), MAXIMUM_LONG_POLL_TIMEOUT_IN_SECONDS)
@@ -0,0 +1,322 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Background writer for the JSON lines logs of the camera servers and 
+monitors.
+
+emit() only puts the record on a bounded queue, the time stamp is taken
+then but formatting, writing and flushing are done by a writer thread so
+the caller never waits for the file system.  Records are written in 
+groups, the file is flushed once a group reaches a number of records or
+has waited long enough.  When the queue is full records are dropped, and
+a count of them logged later, or the caller waits, as chosen when the 
+writer is made.  Queued records are written when the writer is closed,
+including at exit.
+
+emit_json_map() and emit_event() are the helpers the programs log with.
+add_rotation_arguments() gives a program the -R and -H options and 
+rotation_settings() turns them into the rotate_bytes and rotate_seconds 
+of the writer.
+
+The log can be rotated once it reaches a size or an age.  Rotated logs
+are compressed and indexed by another thread, see LogArchive.py, and can
+be searched with QueryLogs.py.
+"""
+
+import atexit
+import datetime
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import LogArchive
+
+DEFAULT_MAX_QUEUED_RECORDS = 10000
+# a group of records is written once it has this many records or its
+# first record has waited this long
+DEFAULT_FLUSH_RECORDS = 100
+DEFAULT_FLUSH_INTERVAL_IN_SECONDS = 0.25
+# longest time flush() waits for the writer
+FLUSH_TIMEOUT_IN_SECONDS = 5
+
+# the log is rotated once it is this large or this old, 0 to never rotate
+DEFAULT_ROTATE_SIZE = '16M'
+DEFAULT_ROTATE_HOURS = '24'
+
+# what emit() does when the queue is full
+OVERFLOW_DROP = 'drop'      # drop the record, the number dropped is logged later
+OVERFLOW_BLOCK = 'block'    # wait for room in the queue
+OVERFLOW_POLICIES = (OVERFLOW_DROP, OVERFLOW_BLOCK)
+
+# queued to stop the writer thread
+_CLOSE = object()
+
+
+class JsonLogWriter():
+    '''
+    Append JSON lines, each with a UTC time stamp, to a file from a 
+    background thread.
+
+    time_key is the name of the time stamp entry added to each record.
+    The file is rotated once it has rotate_bytes or has been written for
+    rotate_seconds, 0 turns either off.  With echo each record is also 
+    printed to stderr when it is emitted, for debugging.
+    '''
+    def __init__(self, filename, time_key='when',
+                 max_queued=DEFAULT_MAX_QUEUED_RECORDS,
+                 flush_records=DEFAULT_FLUSH_RECORDS,
+                 flush_interval=DEFAULT_FLUSH_INTERVAL_IN_SECONDS,
+                 overflow=OVERFLOW_DROP,
+                 rotate_bytes=0, rotate_seconds=0, echo=False):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('overflow of "{}" is not one of {}'.format(overflow, OVERFLOW_POLICIES))
+        self.filename = filename
+        self.time_key = time_key
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.rotate_bytes = rotate_bytes
+        self.rotate_seconds = rotate_seconds
+        self.echo = echo
+        self._output = open(filename, 'a')
+        self._opened_time = time.time()
+        # threads compressing rotated files
+        self._compressors = []
+        # finish logs rotated before the last exit
+        rotated, _ = LogArchive.list_archive(filename)
+        for name in rotated:
+            self._compress(name)
+        self._queue = queue.Queue(max_queued)
+        self._dropped = 0
+        self._dropped_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='JsonLogWriter', daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def emit(self, json_map):
+        '''
+        queue json_map to be written with a time stamp of now
+
+        The writer thread adds the time stamp to json_map so it must not
+        be changed after this call.
+        '''
+        if self._closed:
+            return
+        if self.echo:
+            print('LOG: "{}"'.format(json_map),
+                  file=sys.stderr, flush=True)
+        item = (time.time(), json_map)
+        if self.overflow == OVERFLOW_BLOCK:
+            self._queue.put(item)
+            return
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            with self._dropped_lock:
+                self._dropped += 1
+
+    def flush(self):
+        '''
+        wait until the records queued so far are written and flushed
+        '''
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait(FLUSH_TIMEOUT_IN_SECONDS)
+
+    def close(self):
+        '''
+        write the queued records, stop the writer thread and close the file
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_CLOSE)
+        self._thread.join()
+        self._output.close()
+        for compressor in self._compressors:
+            compressor.join()
+
+    def _format(self, when, json_map):
+        json_map[self.time_key] = datetime.datetime.fromtimestamp(when, datetime.timezone.utc).isoformat()
+        return '{}\n'.format(json.dumps(json_map))
+
+    def _take_dropped(self):
+        with self._dropped_lock:
+            dropped = self._dropped
+            self._dropped = 0
+        return dropped
+
+    def _write(self, lines):
+        dropped = self._take_dropped()
+        if dropped:
+            lines.append(self._format(time.time(), {'event': 'log queue full, dropped {} records'.format(dropped)}))
+        if not lines:
+            return
+        try:
+            self._output.write(''.join(lines))
+            self._output.flush()
+        except Exception as e:
+            # there is nowhere else to log this
+            print('unable to write {} log records to {}: {}'.format(len(lines), self.filename, e),
+                  file=sys.stderr, flush=True)
+            return
+        if self._should_rotate():
+            try:
+                self._rotate()
+            except Exception as e:
+                print('unable to rotate {}: {}'.format(self.filename, e),
+                      file=sys.stderr, flush=True)
+
+    def _should_rotate(self):
+        if self.rotate_bytes and self._output.tell() >= self.rotate_bytes:
+            return True
+        if self.rotate_seconds and time.time() - self._opened_time >= self.rotate_seconds:
+            return self._output.tell() > 0
+        return False
+
+    def _rotate(self):
+        '''
+        rename the log, start a new one and compress the old one
+
+        If the rename fails the log is opened again, so records are never
+        written to a closed file, and the rotation is tried again after the
+        next write.
+        '''
+        rotated = LogArchive.rotated_filename(self.filename, time.time())
+        # closed first, an open file can not be renamed on Windows
+        self._output.close()
+        try:
+            os.rename(self.filename, rotated)
+        except OSError as e:
+            print('unable to rotate {} to {}: {}'.format(self.filename, rotated, e),
+                  file=sys.stderr, flush=True)
+            rotated = None
+        self._output = open(self.filename, 'a')
+        if rotated is None:
+            return
+        self._opened_time = time.time()
+        self._compress(rotated)
+
+    def _compress(self, rotated):
+        self._compressors = [c for c in self._compressors if c.is_alive()]
+        compressor = threading.Thread(target=self._compress_rotated, args=(rotated,),
+                                      name='LogArchive', daemon=True)
+        compressor.start()
+        self._compressors.append(compressor)
+
+    def _compress_rotated(self, rotated):
+        try:
+            LogArchive.compress_rotated(rotated)
+        except Exception as e:
+            # left as it is, it is compressed the next time the writer starts
+            print('unable to compress {}: {}'.format(rotated, e),
+                  file=sys.stderr, flush=True)
+
+    def _run(self):
+        '''
+        write queued records in groups until _CLOSE is queued
+        '''
+        while True:
+            item = self._queue.get()
+            lines = []
+            waiting = []
+            deadline = time.time() + self.flush_interval
+            while True:
+                if item is _CLOSE:
+                    self._write(lines)
+                    for done in waiting:
+                        done.set()
+                    return
+                if isinstance(item, threading.Event):
+                    # flush() is waiting for everything before it
+                    waiting.append(item)
+                    break
+                lines.append(self._format(*item))
+                if len(lines) >= self.flush_records:
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+            self._write(lines)
+            for done in waiting:
+                done.set()
+
+
+def emit_json_map(output, json_map):
+    '''
+    queue json_map to be written to the output with a time stamp in UTC
+    
+    The time stamp entry is added to the json_map by the writer thread of
+    output, a JsonLogWriter.
+    '''
+    output.emit(json_map)
+
+
+def emit_event(output, event_text):
+    '''
+    send a line with an event to the output with a time stamp
+    '''
+    item = {'event':event_text}
+    emit_json_map(output, item)
+
+
+def add_rotation_arguments(parser):
+    '''
+    add the -R (--log_rotate_size) and -H (--log_rotate_hours) options to 
+    an argparse parser
+    '''
+    parser.add_argument("-R", "--log_rotate_size", 
+                        help="rotate and compress the log at this size, e.g. 16M, 0 for never", 
+                        default=DEFAULT_ROTATE_SIZE)
+    parser.add_argument("-H", "--log_rotate_hours", 
+                        help="rotate and compress the log after this many hours, 0 for never", 
+                        default=DEFAULT_ROTATE_HOURS)
+
+
+def rotation_settings(args):
+    '''
+    return a dict with the rotate_bytes and rotate_seconds of a 
+    JsonLogWriter from the args of a parser given add_rotation_arguments()
+
+    Raise ValueError if a setting is not understood.
+    '''
+    return {'rotate_bytes': LogArchive.parse_size(args.log_rotate_size),
+            'rotate_seconds': float(args.log_rotate_hours) * 60 * 60}
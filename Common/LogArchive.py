@@ -0,0 +1,209 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Compressed, indexed archive of rotated JSON lines logs.
+
+When a log is rotated the file is renamed to <log>.<UTC time> and then
+compressed to <log>.<UTC time>.gz as a series of gzip members of about
+DEFAULT_MEMBER_RECORDS records each.  The file is still a normal gzip 
+file, zcat works, but a member can be read on its own.  The sidecar 
+index <log>.<UTC time>.gz.idx has a JSON line for each member with its
+offset and length in the .gz file, the first and last time stamp of its
+records, in seconds since the epoch, and the keys used by its records so
+a query only has to decompress the members which can match.
+"""
+
+import datetime
+import gzip
+import json
+import os
+import re
+
+ROTATED_TIME_FORMAT = '%Y%m%dT%H%M%SZ'
+SEGMENT_SUFFIX = '.gz'
+INDEX_SUFFIX = '.idx'
+TEMPORARY_SUFFIX = '.tmp'
+
+# a member is closed once it has this many records or bytes of records
+DEFAULT_MEMBER_RECORDS = 1000
+DEFAULT_MEMBER_BYTES = 1024 * 1024
+
+# names used for the time stamp of a record
+TIME_KEYS = ('when', 'time')
+
+SIZE_MULTIPLIERS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+def parse_size(text):
+    '''
+    return the number of bytes in text such as 4096, 512K, 16M or 1G
+
+    Raise ValueError if text is not a size.
+    '''
+    match = re.fullmatch(r'\s*(\d+)\s*([KMG]?)B?\s*', text.upper())
+    if match is None:
+        raise ValueError('size of "{}" is not a number of bytes with an optional K, M or G'.format(text))
+    return int(match.group(1)) * SIZE_MULTIPLIERS[match.group(2)]
+
+
+def rotated_filename(filename, when):
+    '''
+    return an unused name for filename rotated at when, seconds since the epoch
+    '''
+    stamp = datetime.datetime.fromtimestamp(when, datetime.timezone.utc).strftime(ROTATED_TIME_FORMAT)
+    rotated = '{}.{}'.format(filename, stamp)
+    count = 1
+    while os.path.exists(rotated) or os.path.exists(rotated + SEGMENT_SUFFIX):
+        rotated = '{}.{}-{}'.format(filename, stamp, count)
+        count += 1
+    return rotated
+
+
+def list_archive(filename):
+    '''
+    return (rotated, segments), sorted lists of the rotated files not yet
+    compressed and of the compressed segments of the log filename
+    '''
+    directory = os.path.dirname(filename) or '.'
+    pattern = re.compile(re.escape(os.path.basename(filename))
+                         + r'\.(\d{8}T\d{6}Z(?:-\d+)?)(' + re.escape(SEGMENT_SUFFIX) + ')?$')
+    rotated = []
+    segments = []
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return rotated, segments
+    for name in names:
+        match = pattern.match(name)
+        if match is None:
+            continue
+        path = os.path.join(directory, name)
+        if match.group(2):
+            segments.append((match.group(1), path))
+        else:
+            rotated.append((match.group(1), path))
+    return [p for _, p in sorted(rotated)], [p for _, p in sorted(segments)]
+
+
+def record_time(record):
+    '''
+    return the time stamp of a record in seconds since the epoch, or None
+    '''
+    for key in TIME_KEYS:
+        text = record.get(key)
+        if isinstance(text, str):
+            try:
+                when = datetime.datetime.fromisoformat(text)
+            except ValueError:
+                continue
+            if when.tzinfo is None:
+                when = when.replace(tzinfo=datetime.timezone.utc)
+            return when.timestamp()
+    return None
+
+
+def _member_entry(offset, length, lines):
+    first = None
+    last = None
+    keys = set()
+    for line in lines:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if not isinstance(record, dict):
+            continue
+        keys.update(record)
+        when = record_time(record)
+        if when is not None:
+            first = when if first is None else min(first, when)
+            last = when if last is None else max(last, when)
+    return {'offset': offset, 'length': length, 'first': first, 'last': last,
+            'records': len(lines), 'keys': sorted(keys)}
+
+
+def compress_rotated(rotated, member_records=DEFAULT_MEMBER_RECORDS, member_bytes=DEFAULT_MEMBER_BYTES):
+    '''
+    compress the rotated log file to a segment and its index then remove it
+
+    Both are written to temporary files and renamed, the index last, so 
+    a segment with an index is always complete.  Return the segment name.
+    '''
+    segment = rotated + SEGMENT_SUFFIX
+    index = segment + INDEX_SUFFIX
+    if os.path.exists(index):
+        # compressed before the rotated file could be removed
+        os.remove(rotated)
+        return segment
+    with open(rotated, 'rb') as source, \
+         open(segment + TEMPORARY_SUFFIX, 'wb') as output, \
+         open(index + TEMPORARY_SUFFIX, 'w') as index_output:
+        lines = []
+        size = 0
+        for line in source:
+            lines.append(line)
+            size += len(line)
+            if len(lines) >= member_records or size >= member_bytes:
+                _write_member(output, index_output, lines)
+                lines = []
+                size = 0
+        if lines:
+            _write_member(output, index_output, lines)
+        output.flush()
+        os.fsync(output.fileno())
+        index_output.flush()
+        os.fsync(index_output.fileno())
+    os.replace(segment + TEMPORARY_SUFFIX, segment)
+    os.replace(index + TEMPORARY_SUFFIX, index)
+    os.remove(rotated)
+    return segment
+
+
+def _write_member(output, index_output, lines):
+    offset = output.tell()
+    member = gzip.compress(b''.join(lines))
+    output.write(member)
+    entry = _member_entry(offset, len(member), lines)
+    index_output.write('{}\n'.format(json.dumps(entry)))
+
+
+def read_index(segment):
+    '''
+    return the list of member entries of a segment, None if it has no index
+    '''
+    try:
+        with open(segment + INDEX_SUFFIX) as index_input:
+            return [json.loads(line) for line in index_input if line.strip()]
+    except FileNotFoundError:
+        return None
+
+
+def read_member(segment_file, entry):
+    '''
+    return the lines, as bytes, of the member of the open segment_file 
+    described by the index entry
+    '''
+    segment_file.seek(entry['offset'])
+    return gzip.decompress(segment_file.read(entry['length'])).splitlines(keepends=True)
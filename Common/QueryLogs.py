@@ -0,0 +1,186 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Print the records of a JSON lines log, and of its compressed archive, 
+which are in a time range and/or have a key or event text.
+
+The programs which log with JsonLogWriter.py rotate their log once it 
+reaches 16MB (-R size, e.g. -R 64M) or has been written for 24 hours 
+(-H hours), 0 turns either off.  The old log is renamed with the time, 
+e.g. CameraServer.log.20210303T000000Z, and compressed in the background
+to a .gz file with a small .gz.idx index of the times and keys in each 
+part of it.  The .gz files can be read with zcat.
+
+Only the members of the compressed segments whose index shows they can
+match are decompressed.  Rotated files which are not yet compressed and
+the live log are read in full.
+
+-k key picks records with that key and -g text picks events containing
+text.  Times are UTC unless a zone is given.  For example, all the 
+visitor records of March 3rd:
+
+    QueryLogs.py -s 2021-03-03 -e 2021-03-04 -k visitor_count /opt/Projects/logs/MightyMuleMonitor.log
+"""
+
+import argparse
+import datetime
+import json
+import sys
+import LogArchive
+
+DEBUG = None
+
+
+def parse_time(text):
+    '''
+    return an ISO 8601 date or time, UTC if no zone is given, in seconds 
+    since the epoch
+    '''
+    when = datetime.datetime.fromisoformat(text.strip().replace('Z', '+00:00'))
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=datetime.timezone.utc)
+    return when.timestamp()
+
+
+def member_may_match(entry, start, end, key):
+    '''
+    return True if the member described by an index entry can hold a 
+    record in [start, end) with key
+    '''
+    if key is not None and key not in entry['keys']:
+        return False
+    if entry['first'] is None:
+        # no time stamps so only a key can rule it out
+        return True
+    if start is not None and entry['last'] < start:
+        return False
+    if end is not None and entry['first'] >= end:
+        return False
+    return True
+
+
+def record_matches(line, start, end, key, text):
+    '''
+    return True if the JSON line is in [start, end), has key and has an 
+    event containing text
+    '''
+    try:
+        record = json.loads(line)
+    except ValueError:
+        return False
+    if not isinstance(record, dict):
+        return False
+    if key is not None and key not in record:
+        return False
+    if text is not None and text not in str(record.get('event', '')):
+        return False
+    if start is not None or end is not None:
+        when = LogArchive.record_time(record)
+        if when is None:
+            return False
+        if start is not None and when < start:
+            return False
+        if end is not None and when >= end:
+            return False
+    return True
+
+
+def query_log(filename, start=None, end=None, key=None, text=None):
+    '''
+    yield the lines, as bytes, of the log filename and its archive which
+    match, oldest first
+    '''
+    rotated, segments = LogArchive.list_archive(filename)
+    for segment in segments:
+        index = LogArchive.read_index(segment)
+        if index is None:
+            # still being written
+            continue
+        members = [entry for entry in index if member_may_match(entry, start, end, key)]
+        if DEBUG:
+            print('{}: reading {} of {} members'.format(segment, len(members), len(index)),
+                  file=sys.stderr, flush=True)
+        if not members:
+            continue
+        with open(segment, 'rb') as segment_file:
+            for entry in members:
+                for line in LogArchive.read_member(segment_file, entry):
+                    if record_matches(line, start, end, key, text):
+                        yield line
+    for name in rotated + [filename]:
+        try:
+            with open(name, 'rb') as log_input:
+                for line in log_input:
+                    if record_matches(line, start, end, key, text):
+                        yield line
+        except FileNotFoundError:
+            # compressed since it was listed, or no live log
+            continue
+
+
+#
+# main
+#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='print matching records from a JSON lines log and its archive')
+    parser.add_argument('-d', '--debug', 
+                        help='turn on debugging', 
+                        action='store_true')
+    parser.add_argument('-s', '--start', 
+                        help='first time to include, ISO 8601, UTC if no zone', 
+                        default=None)
+    parser.add_argument('-e', '--end', 
+                        help='time to stop before, ISO 8601, UTC if no zone', 
+                        default=None)
+    parser.add_argument('-k', '--key', 
+                        help='only records with this key, e.g. visitor_count', 
+                        default=None)
+    parser.add_argument('-g', '--grep', 
+                        help='only records with an event containing this text', 
+                        default=None)
+    parser.add_argument('log_filename', 
+                        help='the live log, e.g. /opt/Projects/logs/UsbCameraServer.log')
+    args = parser.parse_args()
+
+    if (args.debug):
+        DEBUG = 1
+        print('turned on DEBUG from command line.',
+              file=sys.stderr, flush=True)
+
+    try:
+        start = parse_time(args.start) if args.start else None
+        end = parse_time(args.end) if args.end else None
+    except ValueError as e:
+        print('bad time: {}'.format(e), file=sys.stderr, flush=True)
+        exit(1)
+
+    output = sys.stdout.buffer
+    try:
+        for line in query_log(args.log_filename, start, end, args.key, args.grep):
+            output.write(line)
+        output.flush()
+    except BrokenPipeError:
+        # e.g. piped to head
+        pass
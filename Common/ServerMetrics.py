@@ -0,0 +1,229 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Counters and latency histograms for the camera servers, served from 
+/metrics in the Prometheus text format.
+
+Each thread records into its own shard of preallocated counts so the hot
+path takes no lock.  The shards are added up when /metrics is read and
+the shards of threads which have finished are folded into one total.
+"""
+
+import bisect
+import threading
+import time
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# upper bounds of the histogram buckets
+DEFAULT_BUCKETS_IN_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                              0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# metrics recorded by the camera servers
+STAGE_SECONDS = 'camera_stage_seconds'
+LOCK_WAIT_SECONDS = 'camera_lock_wait_seconds'
+REQUESTS = 'camera_http_requests_total'
+RESPONSE_BYTES = 'camera_http_response_bytes_total'
+REQUESTS_IN_FLIGHT = 'camera_http_requests_in_flight'
+
+
+class _Timer():
+    '''
+    context manager adding the time it was entered to a histogram
+    '''
+    __slots__ = ('_metrics', '_name', '_labels', '_start')
+
+    def __init__(self, metrics, name, labels):
+        self._metrics = metrics
+        self._name = name
+        self._labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._metrics.observe(self._name, time.perf_counter() - self._start, **self._labels)
+        return False
+
+
+class ServerMetrics():
+    '''
+    A set of counters, gauges and histograms, each with optional labels.
+
+    A value is a list of counts.  Counters and gauges have one entry, 
+    histograms have one per bucket, one for +Inf, then the sum and count.
+    '''
+    def __init__(self, buckets=DEFAULT_BUCKETS_IN_SECONDS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        # (thread, values) for each thread which has recorded something
+        self._shards = []
+        # values of threads which have finished
+        self._retired = dict()
+        # only taken when a thread records for the first time and on a scrape
+        self._shards_lock = threading.Lock()
+        self._descriptions = dict()   # name: (type, help)
+
+    def describe(self, name, metric_type, text):
+        '''
+        set the type, counter, gauge or histogram, and help text of name
+        '''
+        self._descriptions[name] = (metric_type, text)
+
+    def _values(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = dict()
+            self._local.values = values
+            with self._shards_lock:
+                self._fold_finished_shards()
+                self._shards.append((threading.current_thread(), values))
+            return values
+
+    def inc(self, name, amount=1, **labels):
+        '''
+        add amount to the counter or gauge name
+        '''
+        values = self._values()
+        key = (name, tuple(sorted(labels.items())))
+        value = values.get(key)
+        if value is None:
+            values[key] = [amount]
+        else:
+            value[0] += amount
+
+    def observe(self, name, seconds, **labels):
+        '''
+        add seconds to the histogram name
+        '''
+        values = self._values()
+        key = (name, tuple(sorted(labels.items())))
+        value = values.get(key)
+        if value is None:
+            value = [0] * (len(self.buckets) + 3)
+            values[key] = value
+        value[bisect.bisect_left(self.buckets, seconds)] += 1
+        value[-2] += seconds
+        value[-1] += 1
+
+    def time(self, name, **labels):
+        '''
+        return a context manager which adds the time spent in it to the 
+        histogram name
+        '''
+        return _Timer(self, name, labels)
+
+    @staticmethod
+    def _add(totals, values):
+        for key, value in values.items():
+            total = totals.get(key)
+            if total is None:
+                totals[key] = list(value)
+            else:
+                for i, count in enumerate(value):
+                    total[i] += count
+
+    def _fold_finished_shards(self):
+        '''
+        add the values of finished threads to _retired
+
+        Call with _shards_lock held.
+        '''
+        live = []
+        for thread, values in self._shards:
+            if thread.is_alive():
+                live.append((thread, values))
+            else:
+                self._add(self._retired, values)
+        self._shards = live
+
+    def totals(self):
+        '''
+        return a dict of (name, labels): counts added up over all threads
+        '''
+        with self._shards_lock:
+            self._fold_finished_shards()
+            totals = dict()
+            self._add(totals, self._retired)
+            for _, values in self._shards:
+                # copy is atomic so the owning thread can keep recording
+                self._add(totals, values.copy())
+        return totals
+
+    def render(self):
+        '''
+        return all of the metrics in the Prometheus text format
+        '''
+        by_name = dict()
+        for (name, labels), value in self.totals().items():
+            by_name.setdefault(name, []).append((labels, value))
+        lines = []
+        for name in sorted(by_name):
+            series = sorted(by_name[name], key=lambda item: str(item[0]))
+            is_histogram = len(series[0][1]) > 1
+            metric_type, text = self._descriptions.get(name, ('histogram' if is_histogram else 'untyped', None))
+            if text is not None:
+                lines.append('# HELP {} {}'.format(name, text))
+            lines.append('# TYPE {} {}'.format(name, metric_type))
+            for labels, value in series:
+                if not is_histogram:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value[0]))
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float('inf'),), value):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append('{}_bucket{} {}'.format(name, format_labels(labels + (('le', le),)), cumulative))
+                lines.append('{}_sum{} {}'.format(name, format_labels(labels), value[-2]))
+                lines.append('{}_count{} {}'.format(name, format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    '''
+    return labels, a tuple of (name, value), as {name="value",...}
+    '''
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                          for k, v in labels) + '}'
+
+
+def camera_server_metrics():
+    '''
+    return a ServerMetrics with the metrics the camera servers record
+    '''
+    metrics = ServerMetrics()
+    metrics.describe(STAGE_SECONDS, 'histogram',
+                     'seconds spent in each stage of a capture, by device and stage')
+    metrics.describe(LOCK_WAIT_SECONDS, 'histogram',
+                     'seconds waited for the lock of a capture device')
+    metrics.describe(REQUESTS, 'counter', 'HTTP responses sent, by status code')
+    metrics.describe(RESPONSE_BYTES, 'counter', 'bytes of HTTP response bodies sent')
+    metrics.describe(REQUESTS_IN_FLIGHT, 'gauge', 'HTTP requests being handled')
+    return metrics
@@ -0,0 +1,155 @@
+"""
+MIT License
+
+Copyright (c) 2020 Paul G Crumley
+
+Permission is hereby granted, free of charge, to any person obtaining a copy
+of this software and associated documentation files (the "Software"), to deal
+in the Software without restriction, including without limitation the rights
+to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+copies of the Software, and to permit persons to whom the Software is
+furnished to do so, subject to the following conditions:
+
+The above copyright notice and this permission notice shall be included in all
+copies or substantial portions of the Software.
+
+THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+SOFTWARE.
+
+@author: pgcrumley@gmail.com
+
+Images shared by the requests of a camera server.
+
+A SharedCapture holds the latest image of one kind, the frames of a USB
+camera or one size of the Raspberry Pi camera's stills.  Requests which 
+arrive while an image is being captured wait for that capture and share
+its image, or the error it failed with, and a long-poll waits for an 
+image newer than the one its client has.
+"""
+
+import threading
+import time
+
+import ServerMetrics
+
+# images captured within this many seconds are reused, override with ?max_age=
+DEFAULT_MAX_AGE_IN_SECONDS = '1.0'
+
+# shortest time a ?wait_newer_than= request waits before looking again
+MINIMUM_WAIT_IN_SECONDS = 0.01
+
+
+class _PendingCapture():
+    '''
+    A capture which other requests wait for, holding its image or the 
+    error it failed with once done.
+    '''
+    def __init__(self):
+        self.done = False
+        self.captured = None
+        self.error = None
+
+class SharedCapture():
+    '''
+    The latest image of one kind and the capture running to replace it.
+
+    capture() returns a new image, any object with when, the time it was 
+    captured, and sequence, from HttpCaching.next_sequence().  Only one 
+    capture runs at a time.  Without capture the images only come from 
+    set_latest().  When metrics is given the time a request waits for a 
+    capture another request started is the shared_wait stage of device.
+    '''
+    def __init__(self, capture=None, metrics=None, device=None):
+        self._capture = capture
+        self.metrics = metrics
+        self.device = device
+        # guards latest and _pending, notified when there is a new image
+        self._condition = threading.Condition()
+        self.latest = None
+        self._pending = None
+
+    def set_latest(self, captured):
+        '''
+        make captured, made outside of get(), the latest image if it is 
+        newer than the one on hand
+        '''
+        with self._condition:
+            if self.latest is None or self.latest.sequence < captured.sequence:
+                self.latest = captured
+                self._condition.notify_all()
+
+    def _wait_for_pending(self, pending):
+        '''
+        wait for a capture another request started, call with _condition held
+        '''
+        if self.metrics is None:
+            self._condition.wait_for(lambda: pending.done)
+            return
+        # not lock wait, the capture takes the device lock itself
+        with self.metrics.time(ServerMetrics.STAGE_SECONDS, device=self.device, stage='shared_wait'):
+            self._condition.wait_for(lambda: pending.done)
+
+    def get(self, max_age=0):
+        '''
+        return an image captured no more than max_age seconds ago
+
+        When a capture is already running the caller waits for it and 
+        shares its image, or its error, instead of starting another.
+        '''
+        with self._condition:
+            latest = self.latest
+            if latest is not None and time.time() - latest.when <= max_age:
+                return latest
+            pending = self._pending
+            if pending is not None:
+                self._wait_for_pending(pending)
+                if pending.error is not None:
+                    raise pending.error
+                return pending.captured
+            pending = _PendingCapture()
+            self._pending = pending
+        try:
+            pending.captured = self._capture()
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self._condition:
+                pending.done = True
+                self._pending = None
+                if pending.captured is not None:
+                    self.latest = pending.captured
+                self._condition.notify_all()
+        return pending.captured
+
+    def wait_for_newer(self, sequence, timeout, max_age=None):
+        '''
+        return the latest image once its sequence is greater than sequence,
+        or None if that does not happen within timeout seconds
+
+        With max_age a new image is captured whenever the one on hand is 
+        older than that so a lone client does not have to wait for other 
+        requests, otherwise new images come from get() and set_latest().
+        '''
+        deadline = time.time() + timeout
+        while True:
+            if max_age is None:
+                wait = deadline - time.time()
+            else:
+                captured = self.get(max_age)
+                if captured.sequence > sequence:
+                    return captured
+                wait = min(deadline - time.time(),
+                           max(captured.when + max_age - time.time(), MINIMUM_WAIT_IN_SECONDS))
+            with self._condition:
+                if self._condition.wait_for(lambda: (self.latest is not None 
+                                                     and self.latest.sequence > sequence),
+                                            max(wait, 0)):
+                    return self.latest
+            if time.time() >= deadline:
+                return None
@@ -33,11 +33,15 @@ when the LOW_BATTERY LED changes state.
 """
 
 import argparse
-import datetime
 import json
+import os
 import serial
 import sys
 import time
+# modules shared with the camera servers
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Common'))
+import JsonLogWriter
+from JsonLogWriter import emit_event, emit_json_map
 
 DEBUG = 0
 
@@ -53,27 +57,6 @@ DEFAULT_SAMPLE_INTERVAL_IN_SECONDS = 15
 DEFAULT_LOG_FILE_NAME = '/opt/Projects/logs/MightyMuleMonitor.log'
 
 
-def emit_json_map(output, json_map):
-    '''
-    generate a time stamp in UTC for use in the output
-    
-    A 'time' entry with the time stamp is added to the json_map.
-    '''
-    when = datetime.datetime.now(datetime.timezone.utc)
-    when_str = when.isoformat()
-    json_map['time'] = when_str
-    output.write('{}\n'.format(json.dumps(json_map)))
-    output.flush()
-
-
-def emit_event(output, event_text):
-    '''
-    send a line with an event to the output with a time stamp
-    '''
-    item = {'event':event_text}
-    emit_json_map(output, item)
-
-    
 def emit_sample(output, controller_name, data_map):
     '''
     send a line with data_map to the output with a time stamp
@@ -93,6 +76,7 @@ if __name__ == "__main__":
     parser.add_argument("-l", "--log_filename", 
                         help="file to log data, create or append", 
                         default=DEFAULT_LOG_FILE_NAME)
+    JsonLogWriter.add_rotation_arguments(parser)
     parser.add_argument("-p", "--port", 
                         help="port to which Arduino is connected", 
                         default=None)
@@ -107,6 +91,10 @@ if __name__ == "__main__":
               file=sys.stderr, flush=True)
 
     log_filename = args.log_filename
+    try:
+        log_rotation = JsonLogWriter.rotation_settings(args)
+    except ValueError as e:
+        parser.error('log rotation: {}'.format(e))
     sample_interval = int(args.interval)
     given_port = args.port
     
@@ -132,8 +120,10 @@ if __name__ == "__main__":
     # holds connection to controller
     controller = None
     
-    # open file to log pressure over time
-    with open(log_filename, 'a') as output_file:
+    # open file to log pressure over time, records are few so never drop one
+    with JsonLogWriter.JsonLogWriter(log_filename, time_key='time',
+                                     overflow=JsonLogWriter.OVERFLOW_BLOCK,
+                                     **log_rotation) as output_file:
 
         emit_event(output_file, 'STARTING MightyMuleMonitor')
 
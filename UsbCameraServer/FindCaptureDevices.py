@@ -24,36 +24,298 @@ SOFTWARE.
 
 @author: pgcrumley@gmail.com
 
-look for cameras in the range of 0-99
+List the video capture devices with their names and resolutions.
+
+On Linux the devices are found from /sys/class/video4linux and each node 
+is asked for its capabilities so metadata and output nodes are skipped
+without being opened by OpenCV.  The remaining nodes are opened in 
+parallel, each with a time limit.  Where there is no sysfs the device 
+numbers 0-99 are tried, also in parallel.
 
 Run with root authority.
 """
 
 import os
 os.environ['OPENCV_VIDEOIO_PRIORITY_MSMF'] = '0'  # work around for OpenCV warning issue
+import concurrent.futures
+import ctypes
+import ctypes.util
 import cv2
+import json
+import re
+import struct
+import time
+try:
+    import fcntl
+except ImportError:
+    fcntl = None    # not Linux, devices are only found by opening them
 
 LAST_DEVICE_TO_TRY = 99
 
-def find_capture_devices():
+V4L2_SYSFS_DIR = '/sys/class/video4linux'
+DEV_DIR = '/dev'
+VIDEO_NODE_PATTERN = re.compile(r'^video(\d+)$')
+
+# time allowed for each device to be opened
+DEFAULT_PROBE_TIMEOUT_IN_SECONDS = 2.0
+
+# parts of linux/videodev2.h
+def _IOC(direction, number, size):
+    return (direction << 30) | (size << 16) | (ord('V') << 8) | number
+_IOC_READ = 2
+_IOC_READ_WRITE = 3
+
+V4L2_CAPABILITY = struct.Struct('16s32s32sIII12x')
+V4L2_FMTDESC = struct.Struct('III32sII12x')
+V4L2_FRMSIZEENUM = struct.Struct('IIIIIIIII8x')
+VIDIOC_QUERYCAP = _IOC(_IOC_READ, 0, V4L2_CAPABILITY.size)
+VIDIOC_ENUM_FMT = _IOC(_IOC_READ_WRITE, 2, V4L2_FMTDESC.size)
+VIDIOC_ENUM_FRAMESIZES = _IOC(_IOC_READ_WRITE, 74, V4L2_FRMSIZEENUM.size)
+
+V4L2_CAP_VIDEO_CAPTURE = 0x00000001
+V4L2_CAP_VIDEO_CAPTURE_MPLANE = 0x00001000
+V4L2_CAP_DEVICE_CAPS = 0x80000000
+V4L2_BUF_TYPE_VIDEO_CAPTURE = 1
+V4L2_FRMSIZE_TYPE_DISCRETE = 1
+
+# parts of linux/inotify.h
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+INOTIFY_READ_SIZE = 4096
+
+# how often /dev is checked when inotify can not be used
+DEFAULT_POLL_INTERVAL_IN_SECONDS = 5
+
+
+def list_video_nodes():
     '''
-    return a list of the available capture devices
+    return a sorted list of the device numbers of the video4linux nodes, or
+    None if the system does not have video4linux
+    '''
+    for directory in (V4L2_SYSFS_DIR, DEV_DIR):
+        if os.path.isdir(directory):
+            result = list()
+            for name in os.listdir(directory):
+                match = VIDEO_NODE_PATTERN.match(name)
+                if match:
+                    result.append(int(match.group(1)))
+            if result or directory == V4L2_SYSFS_DIR:
+                return sorted(result)
+    return None
+
+
+def _decode(raw):
+    return raw.split(b'\0', 1)[0].decode('utf-8', 'replace')
+
+
+def query_capabilities(dev):
+    '''
+    return a map with the driver, card and capabilities of /dev/videoN, or
+    None if the device can not be asked
     '''
-    result = list()
-    for dev in range(0,LAST_DEVICE_TO_TRY+1):
+    if fcntl is None:
+        return None
+    try:
+        fd = os.open(os.path.join(DEV_DIR, 'video{}'.format(dev)), os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        return None
+    try:
+        buf = bytearray(V4L2_CAPABILITY.size)
+        fcntl.ioctl(fd, VIDIOC_QUERYCAP, buf)
+        driver, card, bus_info, _, capabilities, device_caps = V4L2_CAPABILITY.unpack(buf)
+        if capabilities & V4L2_CAP_DEVICE_CAPS:
+            capabilities = device_caps
+        return {'driver': _decode(driver),
+                'card': _decode(card),
+                'bus_info': _decode(bus_info),
+                'capabilities': capabilities,
+                'resolutions': _list_resolutions(fd)}
+    except OSError:
+        return None
+    finally:
+        os.close(fd)
+
+
+def _list_resolutions(fd):
+    '''
+    return a sorted list of [width, height] for every discrete frame size
+    of every capture format, the largest sizes of other types are included
+    '''
+    sizes = set()
+    format_index = 0
+    while True:
+        buf = bytearray(V4L2_FMTDESC.pack(format_index, V4L2_BUF_TYPE_VIDEO_CAPTURE, 0, b'', 0, 0))
         try:
-            cap = cv2.VideoCapture(dev)
-            if cap.isOpened():
-                result.append(dev)
-        finally:
-            cap.release()
-    return result        
-        
+            fcntl.ioctl(fd, VIDIOC_ENUM_FMT, buf)
+        except OSError:
+            break
+        pixel_format = V4L2_FMTDESC.unpack(buf)[4]
+        size_index = 0
+        while True:
+            buf = bytearray(V4L2_FRMSIZEENUM.pack(size_index, pixel_format, 0, 0, 0, 0, 0, 0, 0))
+            try:
+                fcntl.ioctl(fd, VIDIOC_ENUM_FRAMESIZES, buf)
+            except OSError:
+                break
+            fields = V4L2_FRMSIZEENUM.unpack(buf)
+            if fields[2] == V4L2_FRMSIZE_TYPE_DISCRETE:
+                sizes.add((fields[3], fields[4]))
+            else:
+                # stepwise or continuous, fields are min_w, max_w, step_w, min_h, max_h
+                sizes.add((fields[4], fields[7]))
+                break
+            size_index += 1
+        format_index += 1
+    return [list(s) for s in sorted(sizes)]
+
+
+def read_device_name(dev):
+    '''
+    return the name sysfs gives /dev/videoN, or None
+    '''
+    try:
+        with open(os.path.join(V4L2_SYSFS_DIR, 'video{}'.format(dev), 'name')) as name_file:
+            return name_file.read().strip()
+    except OSError:
+        return None
+
+
+def probe_capture_device(dev):
+    '''
+    return True if dev can be opened as a capture device
+    '''
+    cap = cv2.VideoCapture(dev)
+    try:
+        return cap.isOpened()
+    finally:
+        cap.release()
+
+
+def describe_capture_device(dev, probe=True):
+    '''
+    return a map describing capture device dev, or None if it is not a
+    capture device
+
+    When probe is False the device is not opened with OpenCV, used for 
+    devices already known to work.
+    '''
+    result = {'device': dev,
+              'path': os.path.join(DEV_DIR, 'video{}'.format(dev)),
+              'name': read_device_name(dev),
+              'resolutions': list()}
+    caps = query_capabilities(dev)
+    if caps is not None:
+        if not caps['capabilities'] & (V4L2_CAP_VIDEO_CAPTURE | V4L2_CAP_VIDEO_CAPTURE_MPLANE):
+            return None
+        result['name'] = result['name'] or caps['card']
+        result['driver'] = caps['driver']
+        result['bus_info'] = caps['bus_info']
+        result['resolutions'] = caps['resolutions']
+    if probe and not probe_capture_device(dev):
+        return None
+    return result
+
+
+def describe_capture_devices(open_devices=(), timeout=DEFAULT_PROBE_TIMEOUT_IN_SECONDS):
+    '''
+    return a list of maps describing the available capture devices
+
+    All devices are checked at the same time.  A device which takes more
+    than timeout seconds is left out.  Devices in open_devices are already
+    in use by the caller so are not opened again.
+    '''
+    candidates = list_video_nodes()
+    if candidates is None:
+        candidates = range(0, LAST_DEVICE_TO_TRY+1)
+    if not candidates:
+        return list()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(candidates))
+    try:
+        futures = [executor.submit(describe_capture_device, dev, dev not in open_devices)
+                   for dev in candidates]
+        concurrent.futures.wait(futures, timeout=timeout)
+        result = list()
+        for future in futures:
+            if future.done() and future.exception() is None and future.result() is not None:
+                result.append(future.result())
+        return result
+    finally:
+        # do not wait for devices which did not answer in time
+        executor.shutdown(wait=False)
+
+
+def find_capture_devices(open_devices=(), timeout=DEFAULT_PROBE_TIMEOUT_IN_SECONDS):
+    '''
+    return a list of the available capture devices
+    '''
+    return [d['device'] for d in describe_capture_devices(open_devices, timeout)]
+
+
+def _open_inotify(directory):
+    '''
+    return an inotify file descriptor watching directory for nodes coming
+    and going, or None if inotify can not be used
+    '''
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError, TypeError):
+        return None
+    if fd < 0:
+        return None
+    mask = IN_CREATE | IN_DELETE | IN_ATTRIB | IN_MOVED_TO | IN_MOVED_FROM
+    if libc.inotify_add_watch(fd, directory.encode('utf-8'), mask) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def watch_video_nodes(callback, poll_interval=DEFAULT_POLL_INTERVAL_IN_SECONDS):
+    '''
+    call callback(dev, present) each time /dev/videoN is added, removed or 
+    has its permissions changed
+
+    This does not return so run it in a thread.  inotify is used when it
+    is available, otherwise /dev is checked every poll_interval seconds.
+    '''
+    fd = _open_inotify(DEV_DIR)
+    if fd is None:
+        known = set(list_video_nodes() or ())
+        while True:
+            time.sleep(poll_interval)
+            current = set(list_video_nodes() or ())
+            for dev in sorted(current - known):
+                callback(dev, True)
+            for dev in sorted(known - current):
+                callback(dev, False)
+            known = current
+
+    while True:
+        data = os.read(fd, INOTIFY_READ_SIZE)
+        offset = 0
+        while offset + INOTIFY_EVENT.size <= len(data):
+            _, mask, _, name_length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = _decode(data[offset:offset+name_length])
+            offset += name_length
+            match = VIDEO_NODE_PATTERN.match(name)
+            if match:
+                present = not mask & (IN_DELETE | IN_MOVED_FROM)
+                callback(int(match.group(1)), present)
+
+
 #
 # main
 #
 if __name__ == '__main__':
     print('Searching for capture devices...')
-    available_devices = find_capture_devices()
-    print('Available devices: {}'.format(available_devices))
-    
\ No newline at end of file
+    available_devices = describe_capture_devices()
+    for d in available_devices:
+        print('{}: {} ({})'.format(d['device'], d['name'], d['path']))
+        print('    resolutions: {}'.format(', '.join('{}x{}'.format(w, h) for w, h in d['resolutions'])))
+    print('Available devices: {}'.format(json.dumps([d['device'] for d in available_devices])))
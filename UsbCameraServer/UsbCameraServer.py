@@ -28,30 +28,81 @@ Very simple web server to provide a PNG image from a USB camera
 
 /                    return PNG image for default device
 /capture-devices/N   return PNG image if N is a valid device
+/capture-devices/N/stream  return MJPEG stream (multipart/x-mixed-replace) if N is a valid device
+/capture-devices/N/events  return JSON motion events after ?since=<id>, waiting for one (-M)
+/capture-devices/all return images from all devices grabbed at the same moment, 
+                     ?layout=tile (default) for one tiled image or ?layout=multipart
 /capture-devices     return JSON list of URLs for valid capture-device/N (note, no trailing /)
 /favicon.ico         return image in ICO format
+/metrics             return counters and latency histograms in Prometheus text format
 /kill                exit the process so system controller can restart it (deferred)
 
+Image URLs accept ?max_age=S to allow an image captured up to S seconds ago
+to be returned.  Requests that arrive while a capture is running share it.
+
+Image URLs accept ?format=png|jpeg|webp and ?quality=1..100, or pick the
+format from the Accept header.  PNG is returned when nothing else is asked for.
+
+Image URLs accept ?width=W and ?height=H, or ?size=thumb|small|medium|full, 
+to get an image scaled down to fit.  Each scaled image is made once per frame.
+
+When frames are kept in memory (-n) image URLs accept ?at=<ISO 8601 time> or
+?ago=5s to return the kept frame closest to that time.
+
+Images are sent with an ETag and Last-Modified so a client can ask again
+with If-None-Match or If-Modified-Since and get 304 until there is a new
+frame.  ?wait_newer_than=<ETag> waits, up to ?timeout=S seconds 
+(default 30), for a frame newer than that ETag and returns 304 if none 
+is captured in time.
+
 By default will accept GET from any address on port 4000
 
-TODO:
--- Figure out a way to dynamically detect addition / removal of capture devices
+Capture devices which are plugged in or removed while the server runs are
+found by watching /dev.
+
+-B picamera serves the Raspberry Pi camera and -B synthetic serves moving
+test frames from two devices, with no camera, through the same caching,
+encoding, streaming and metrics.
 
 """
 import os
 os.environ['OPENCV_VIDEOIO_PRIORITY_MSMF']='0'  # work around for OpenCV issue
 import argparse
+import atexit
+import collections
+import concurrent.futures
 import cv2
 import datetime
 import json
+import math
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy
+import queue
+import re
+import shutil
 import sys
 import threading
 import time
+import urllib.parse
+import weakref
+import FindCaptureDevices
+# modules shared by the camera servers
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'Common'))
+import AsyncHttpServer
+import CameraRequestHandler
+import CaptureBackends
+import HttpCaching
+import JsonLogWriter
+from JsonLogWriter import emit_event, emit_json_map
+import LogArchive
+import ServerMetrics
+import SharedCapture
 # use newer, threading version, if available
 if (sys.version_info[0] >= 3 and sys.version_info[1] >= 7):
-    from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+    from http.server import HTTPServer, ThreadingHTTPServer
 else:
-    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from http.server import HTTPServer
 
 DEBUG = None
 
@@ -61,92 +112,1557 @@ DEFAULT_LISTEN_PORT = '4000'            # IP port
 DEFAULT_VIDEO_DEVICE = 0
 video_device=DEFAULT_VIDEO_DEVICE
 
+# where frames come from, one of CaptureBackends.BACKENDS, set with -B
+capture_backend = CaptureBackends.DEFAULT_BACKEND
+
 PERIODIC_CAPTURE_SAMPLE_INTERVAL_IN_SECONDS = 60 * 1 # every minute
 
+# images captured within this many seconds are reused, override with ?max_age=
+max_frame_age = float(SharedCapture.DEFAULT_MAX_AGE_IN_SECONDS)
+
 DEFAULT_ICON_FILE_NAME = '/opt/Projects/UsbCameraServer/favicon.ico'
 FAVICON = None
 
 DEFAULT_LOG_FILE_NAME = '/opt/Projects/logs/UsbCameraServer.log'
 log_file = None
 
+# counters and latency histograms served from /metrics
+metrics = ServerMetrics.camera_server_metrics()
+
+# image formats which can be asked for with ?format= or the Accept header
+# name: (extension for cv2.imencode, Content-type, quality parameter, default quality)
+IMAGE_FORMATS = {
+    'png': ('.png', 'image/png', None, None),
+    'jpeg': ('.jpg', 'image/jpeg', cv2.IMWRITE_JPEG_QUALITY, 85),
+    'webp': ('.webp', 'image/webp', cv2.IMWRITE_WEBP_QUALITY, 80),
+    }
+IMAGE_FORMAT_ALIASES = {'jpg': 'jpeg'}
+CONTENT_TYPE_FORMATS = {v[1]: k for k, v in IMAGE_FORMATS.items()}
+DEFAULT_IMAGE_FORMAT = 'png'
+MINIMUM_IMAGE_QUALITY = 1
+MAXIMUM_IMAGE_QUALITY = 100
+
+# named sizes for ?size=, (width, height) the image is scaled down to fit in
+IMAGE_SIZES = {
+    'thumb': (640, 640),
+    'small': (1280, 1280),
+    'medium': (1920, 1920),
+    'full': (None, None),
+    }
+MAXIMUM_IMAGE_DIMENSION = 8192
+
+# frames kept in memory for ?at= and ?ago=, a number of frames or a number
+# of seconds such as 60s, 0 for none
+DEFAULT_RING_FRAMES = '0'
+ring_frames = 0
+DEFAULT_RING_INTERVAL_IN_SECONDS = '1.0'
+ring_interval = float(DEFAULT_RING_INTERVAL_IN_SECONDS)
+
+# fraction of pixels which must change for motion, 0 turns motion detection off
+DEFAULT_MOTION_THRESHOLD = '0'
+motion_threshold = float(DEFAULT_MOTION_THRESHOLD)
+MOTION_SAMPLE_INTERVAL_IN_SECONDS = 0.5
+MOTION_FRAME_WIDTH = 160                # frames are compared at this width
+MOTION_BLUR_SIZE = (5, 5)
+MOTION_PIXEL_DELTA = 25                 # a pixel changed if it differs by more
+MOTION_END_DELAY_IN_SECONDS = 5         # quiet time before motion_end
+# a frame with fewer changed pixels than this, compared with the last frame 
+# which was kept, is taken to be that frame and shares its images
+MOTION_UNCHANGED_FRACTION = 0.002
+MOTION_EVENTS_KEPT = 100
+
+# timelapse, a frame from each device saved every interval seconds, off
+# when there is no directory
+DEFAULT_TIMELAPSE_DIRECTORY = ''
+DEFAULT_TIMELAPSE_INTERVAL_IN_SECONDS = '60'
+DEFAULT_TIMELAPSE_BUDGET = '1G'         # oldest files are removed past this
+# once past the budget the oldest files are removed down to this fraction 
+# of it, so each day's index is rewritten once for many removed files
+TIMELAPSE_TRIM_FRACTION = 0.9
+TIMELAPSE_FORMAT = 'jpeg'
+TIMELAPSE_QUALITY = 90
+TIMELAPSE_QUEUE_FRAMES = 4              # frames waiting to be encoded and written
+TIMELAPSE_INDEX_FILE_NAME = 'index.jsonl'
+TIMELAPSE_DAY_FORMAT = '%Y-%m-%d'
+TIMELAPSE_DAY_PATTERN = re.compile(r'\d{4}-\d{2}-\d{2}$')
+_timelapse_recorder = None
+
+# processes used to encode images, 0 encodes in the request thread
+DEFAULT_ENCODE_PROCESSES = '0'
+_encode_pool = None
+
+# MJPEG streams, override the rate with ?fps=
+stream_fps = float(CameraRequestHandler.DEFAULT_STREAM_FPS)
+STREAM_RETRY_DELAY_IN_SECONDS = 1
+MINIMUM_STREAM_FPS = 0.1
+
+# /capture-devices/all, frames from every device grabbed at the same time
+SNAPSHOT_LAYOUTS = ('tile', 'multipart')
+SNAPSHOT_BOUNDARY = 'capture-device-frame'
+# longest time a device waits for the others to be ready to grab
+SNAPSHOT_BARRIER_TIMEOUT_IN_SECONDS = 5
+
 # enables the URL of '/kill' to kill the server
 ALLOW_REMOTE_KILL = False
 
 AVAILABLE_CAPTURE_DEVICES = list()
+# device number: map with name, path and resolutions
+CAPTURE_DEVICE_DETAILS = dict()
+# held while AVAILABLE_CAPTURE_DEVICES and CAPTURE_DEVICE_DETAILS are changed
+_capture_devices_lock = threading.Lock()
+
+# time for udev to finish with a new video node before it is opened
+DEVICE_SETTLE_TIME_IN_SECONDS = 1.0
+
+# resolution requested when a capture device is opened
+CAPTURE_WIDTH = 3840
+CAPTURE_HEIGHT = 2160
 
+# the driver queues frames while nobody is reading so after an idle period
+# a few frames are dropped to get a current image
+IDLE_TIME_BEFORE_FLUSH_IN_SECONDS = 1.0
+STALE_FRAMES_TO_DISCARD = 2
 
-def emit_json_map(output, json_map):
+# free frame buffers each capture device keeps to read the next frames into
+FRAME_BUFFERS_KEPT = 2
+# free shared memory segments kept for each frame size to copy frames into
+# for the encode processes
+SHARED_FRAMES_KEPT = 4
+
+class FramePool():
     '''
-    generate a time stamp in UTC for use in the output
-    
-    A 'when' entry with the time stamp is added to the json_map.
+    Frame buffers a capture device reads into again once no frame uses 
+    them.
+
+    A 4K frame is 24MB, reading each one into a new array keeps the 
+    allocator getting and giving back that much memory for every frame.
+    '''
+    def __init__(self, size=FRAME_BUFFERS_KEPT):
+        self.size = size
+        self._lock = threading.Lock()
+        self._free = list()
+
+    def get(self):
+        '''
+        return a free buffer, or None to have the read make a new one
+        '''
+        with self._lock:
+            return self._free.pop() if self._free else None
+
+    def put(self, frame):
+        '''
+        keep frame, which nothing uses now, for a later read
+        '''
+        if frame is None:
+            return
+        with self._lock:
+            if len(self._free) < self.size:
+                self._free.append(frame)
+
+class SharedFramePool():
     '''
-    when = datetime.datetime.now(datetime.timezone.utc)
-    when_str = when.isoformat()
-    json_map['when'] = when_str
-    message = json.dumps(json_map)
-    output.write('{}\n'.format(message))
-    output.flush()
+    SharedMemory segments frames are copied into for the encode processes,
+    used again once no frame uses them.
 
-def emit_event(output, event_text):
+    Like the frame buffers, making and removing a 24MB segment for each 4K
+    frame keeps the system getting and giving back that much memory.  A 
+    few free segments are kept for each frame size.
     '''
-    send a line with an event to the output with a time stamp
+    def __init__(self, size=SHARED_FRAMES_KEPT):
+        self.size = size
+        self._lock = threading.Lock()
+        self._free = dict()     # bytes in the frame: list of free segments
+        self._closed = False
+        atexit.register(self.close)
+
+    def get(self, nbytes):
+        '''
+        return a free segment which holds nbytes, making one if needed
+        '''
+        with self._lock:
+            free = self._free.get(nbytes)
+            if free:
+                return free.pop()
+        return shared_memory.SharedMemory(create=True, size=nbytes)
+
+    def put(self, shared, nbytes):
+        '''
+        keep shared, of a frame with nbytes which nothing uses now, for a 
+        later frame or remove it
+        '''
+        with self._lock:
+            free = self._free.setdefault(nbytes, list())
+            if not self._closed and len(free) < self.size:
+                free.append(shared)
+                return
+        release_shared_memory(shared)
+
+    def close(self):
+        '''
+        remove the free segments, those in use are removed once freed
+        '''
+        with self._lock:
+            self._closed = True
+            free = [shared for segments in self._free.values() for shared in segments]
+            self._free.clear()
+        for shared in free:
+            release_shared_memory(shared)
+
+_shared_frames = SharedFramePool()
+
+class PooledFrame():
     '''
-    item = {'event':event_text}
-    if DEBUG:
-        print('LOG: "{}"'.format(item),
-              file=sys.stderr, flush=True)
-    emit_json_map(output, item)
+    Owner of a frame buffer from a FramePool.  The buffer goes back to the
+    pool once the last CapturedFrame holding this is freed.
+    '''
+    def __init__(self, frame, pool):
+        self.frame = frame
+        weakref.finalize(self, pool.put, frame)
 
-_capture_lock = threading.Lock()
-def capture_image(video_device=0):
+class CaptureSession():
     '''
-    create in memory image from first USB camera
+    Keep a capture device open between requests.
+
+    Opening a camera and negotiating the resolution takes a long time so 
+    the device is opened once and reused.  If a read fails the device is
+    released and opened again.  The device is read through a backend from
+    ../Common/CaptureBackends.py, chosen with -B.
+
+    Each session has its own lock so a slow device does not hold up the
+    other devices.
     '''
-    with _capture_lock:
+    def __init__(self, video_device):
+        self.video_device = video_device
+        self.lock = threading.Lock()
+        self._cap = None    # the CaptureBackend while the device is open
+        self._last_read_time = 0
+        # buffers for frames from this device which are no longer used
+        self.frames = FramePool()
+        # most recent frame, shared by the requests which want one
+        self._latest = SharedCapture.SharedCapture(self._capture, metrics, video_device)
+        # FrameRingBuffer holding recent frames, if recording is on
+        self.ring = FrameRingBuffer(video_device, ring_frames) if ring_frames > 0 else None
+        # MotionDetector looking at each frame, if motion detection is on
+        self.motion = MotionDetector(video_device, motion_threshold) if motion_threshold > 0 else None
+
+    def is_open(self):
+        return self._cap is not None
+
+    def open(self):
+        '''
+        open the device, if needed, and set the resolution
+
+        Call with lock held.
+        '''
+        if self._cap is not None:
+            return
         try:
-            cap = cv2.VideoCapture(video_device)
-            cap.set(cv2.CAP_PROP_FRAME_WIDTH, 3840)
-            cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 2160)
-            # take a couple samples to give the camera a chance to adjust
-            _, frame = cap.read()
-            _, im_buf_arr = cv2.imencode('.png', frame)
-            result = im_buf_arr.tobytes()
+            cap = CaptureBackends.make_backend(capture_backend, self.video_device)
+            with metrics.time(ServerMetrics.STAGE_SECONDS, device=self.video_device, stage='open'):
+                cap.open()
+        except:
+            # the next request starts over with a new session
+            discard_capture_session(self)
+            raise
+        try:
+            with metrics.time(ServerMetrics.STAGE_SECONDS, device=self.video_device, stage='set_resolution'):
+                cap.set_resolution(CAPTURE_WIDTH, CAPTURE_HEIGHT)
+        except:
+            cap.close()
+            raise
+        self._cap = cap
+        if DEBUG:
+            print('opened capture device {}'.format(self.video_device),
+                  file=sys.stderr, flush=True)
+
+    def close(self):
+        '''
+        release the device, it will be opened again on the next read
+
+        Call with lock held.
+        '''
+        if self._cap is not None:
+            self._cap.close()
+            self._cap = None
             if DEBUG:
-                print('captured image of length {}'.format(len(result)),
+                print('closed capture device {}'.format(self.video_device),
                       file=sys.stderr, flush=True)
-            return bytearray(result)
+
+    def _flush_if_idle(self):
+        if (self._cap.queues_frames
+                and time.time() - self._last_read_time > IDLE_TIME_BEFORE_FLUSH_IN_SECONDS):
+            for _ in range(STALE_FRAMES_TO_DISCARD):
+                self._cap.grab()
+
+    def _read_once(self):
+        self.open()
+        with metrics.time(ServerMetrics.STAGE_SECONDS, device=self.video_device, stage='read'):
+            self._flush_if_idle()
+            buffer = self.frames.get()
+            ok, frame = self._cap.read(image=buffer)
+        if not ok or frame is None:
+            self.frames.put(buffer)
+            raise RuntimeError('unable to read from capture device {}'.format(self.video_device))
+        self._last_read_time = time.time()
+        return frame
+
+    def read(self):
+        '''
+        return a frame from the device
+
+        A failed read closes the device and tries once more with a newly
+        opened device before giving up.
+        '''
+        with metrics.time(ServerMetrics.LOCK_WAIT_SECONDS, device=self.video_device):
+            self.lock.acquire()
+        try:
+            try:
+                return self._read_once()
+            except Exception as e:
+                if DEBUG:
+                    print('read from capture device {} failed with {}, re-opening'.format(self.video_device, e),
+                          file=sys.stderr, flush=True)
+                self.close()
+            try:
+                return self._read_once()
+            except:
+                self.close()
+                raise
         finally:
-            cap.release()
+            self.lock.release()
+
+    def synchronized_read(self, ready, grabbed):
+        '''
+        return (frame, when) read from the device in step with the other 
+        devices of a snapshot
+
+        The device is opened and flushed, then once every device is at the
+        ready barrier they all grab() and, once all are at the grabbed 
+        barrier, retrieve() the frames they grabbed.  A device which fails
+        still goes through both barriers so it does not hold up the others,
+        and a barrier which times out is passed so a slow device only adds
+        to the skew.
+        '''
+        with metrics.time(ServerMetrics.LOCK_WAIT_SECONDS, device=self.video_device):
+            self.lock.acquire()
+        try:
+            error = None
+            frame = None
+            when = None
+            try:
+                self.open()
+                self._flush_if_idle()
+            except Exception as e:
+                error = e
+            pass_barrier(ready)
+            if error is None:
+                with metrics.time(ServerMetrics.STAGE_SECONDS, device=self.video_device, stage='grab'):
+                    ok = self._cap.grab()
+                when = time.time()
+                if not ok:
+                    error = RuntimeError('unable to grab from capture device {}'.format(self.video_device))
+            pass_barrier(grabbed)
+            if error is None:
+                with metrics.time(ServerMetrics.STAGE_SECONDS, device=self.video_device, stage='retrieve'):
+                    buffer = self.frames.get()
+                    ok, frame = self._cap.retrieve(image=buffer)
+                if not ok or frame is None:
+                    self.frames.put(buffer)
+                    error = RuntimeError('unable to retrieve from capture device {}'.format(self.video_device))
+            if error is not None:
+                self.close()
+                raise error
+            self._last_read_time = time.time()
+            return frame, when
+        finally:
+            self.lock.release()
+
+    def set_latest_frame(self, captured):
+        '''
+        make captured, read outside of get_frame(), the latest frame if it
+        is newer than the one on hand
+        '''
+        self._latest.set_latest(captured)
+        if self.ring is not None:
+            self.ring.append(captured)
+
+    def _capture(self):
+        '''
+        return a new CapturedFrame read from the device
+        '''
+        captured = CapturedFrame(self.video_device, self.read(), time.time(),
+                                 HttpCaching.next_sequence(), self.frames)
+        if self.motion is not None:
+            self.motion.analyze(captured)
+        if self.ring is not None:
+            self.ring.append(captured)
+        return captured
+
+    def get_frame(self, max_age=0):
+        '''
+        return a CapturedFrame taken no more than max_age seconds ago
+
+        When a capture is already running the caller waits for it and
+        shares the result instead of starting another capture.
+        '''
+        return self._latest.get(max_age)
+
+    def wait_for_newer_frame(self, sequence, max_age, timeout):
+        '''
+        return a CapturedFrame newer than the frame with sequence, or None 
+        if there is none within timeout seconds
+
+        A new frame is captured whenever the one on hand is older than 
+        max_age so a lone client does not have to wait for other requests.
+        '''
+        return self._latest.wait_for_newer(sequence, timeout, max_age)
+
+class CapturedFrame():
+    '''
+    A frame read from a capture device and the images encoded from it.
+
+    Each resize and each encoding is done the first time it is asked for 
+    and kept so every request served from this frame shares one encode.
+    Different encodings of the same frame can run at the same time.
+    When the frame was read into a buffer from pool the buffer is read 
+    into again once this and any frame sharing it are freed.
+
+    when is the time the frame was read and modified the time the image 
+    with its ETag was first read, earlier for a frame the same as an 
+    earlier one.
+    '''
+    def __init__(self, video_device, frame, when, sequence, pool=None, modified=None):
+        self.video_device = video_device
+        self.frame = frame
+        self._owner = PooledFrame(frame, pool) if pool is not None else None
+        self.when = when
+        self.modified = when if modified is None else modified
+        self.sequence = sequence
+        self.etag = HttpCaching.make_etag(sequence)
+        self._lock = threading.Lock()
+        self._resized = dict()
+        self._images = dict()   # key: Future for the encoded image
+        self._shared = None
+
+    def same_as(self, other):
+        '''
+        take this frame to be other, an earlier frame with no change
+
+        The pixels, sequence, ETag, modified time and images of other are
+        shared so an image which other already has is never encoded again
+        and the ETag and Last-Modified of this frame agree.  Call before
+        this frame is used by other threads.
+        '''
+        self.frame = other.frame
+        self._owner = other._owner
+        self.sequence = other.sequence
+        self.etag = other.etag
+        self.modified = other.modified
+        self._lock = other._lock
+        self._resized = other._resized
+        self._images = other._images
+
+    def resized(self, size=None):
+        '''
+        return the frame scaled to size of (width, height), None for full size
+        '''
+        if size is None:
+            return self.frame
+        with self._lock:
+            frame = self._resized.get(size)
+        if frame is None:
+            with metrics.time(ServerMetrics.STAGE_SECONDS, device=self.video_device, stage='resize'):
+                frame = cv2.resize(self.frame, size, interpolation=cv2.INTER_AREA)
+            with self._lock:
+                frame = self._resized.setdefault(size, frame)
+        return frame
+
+    def shared_frame(self):
+        '''
+        return the SharedMemory holding a copy of the frame for the encode
+        processes, it goes back to the pool when this CapturedFrame is freed
+        '''
+        with self._lock:
+            if self._shared is None:
+                shared = _shared_frames.get(self.frame.nbytes)
+                numpy.ndarray(self.frame.shape, self.frame.dtype, buffer=shared.buf)[...] = self.frame
+                weakref.finalize(self, _shared_frames.put, shared, self.frame.nbytes)
+                self._shared = shared
+            return self._shared
+
+    def _encode(self, ext, params, size):
+        with metrics.time(ServerMetrics.STAGE_SECONDS, device=self.video_device, stage='encode'):
+            return self._encode_image(ext, params, size)
+
+    def _encode_image(self, ext, params, size):
+        if _encode_pool is not None:
+            shared = self.shared_frame()
+            try:
+                return _encode_pool.submit(encode_shared_frame, shared.name, self.frame.shape,
+                                           self.frame.dtype.str, ext, params, size).result()
+            except concurrent.futures.process.BrokenProcessPool as e:
+                emit_event(log_file, 'encode process failed with {}, encoding in thread'.format(e))
+        _, im_buf_arr = cv2.imencode(ext, self.resized(size), list(params))
+        # a view of the encoded bytes, they are never changed so need no copy
+        return im_buf_arr.reshape(-1).data
+
+    def encode(self, ext, params=(), size=None):
+        '''
+        return the frame, scaled to size, encoded by cv2.imencode with ext 
+        and params
+        '''
+        key = (ext, tuple(params), size)
+        with self._lock:
+            future = self._images.get(key)
+            is_first = future is None
+            if is_first:
+                future = concurrent.futures.Future()
+                self._images[key] = future
+        if is_first:
+            try:
+                image = self._encode(ext, tuple(params), size)
+                future.set_result(image)
+                if DEBUG:
+                    print('encoded {} image of size {} and length {} from device {}'.format(ext, size, len(image),
+                                                                                            self.video_device),
+                          file=sys.stderr, flush=True)
+            except Exception as e:
+                # let a later request try again
+                with self._lock:
+                    del self._images[key]
+                future.set_exception(e)
+        return future.result()
+
+    def image(self, image_format=DEFAULT_IMAGE_FORMAT, quality=None, width=None, height=None):
+        '''
+        return the frame as an image in one of the IMAGE_FORMATS
+
+        The image is scaled down to fit in width and height, keeping the 
+        shape of the frame.  quality is ignored for PNG.
+        '''
+        frame_height, frame_width = self.frame.shape[:2]
+        size = CaptureBackends.fit_image_size(frame_width, frame_height, width, height)
+        ext, _, quality_param, default_quality = IMAGE_FORMATS[image_format]
+        if quality_param is None:
+            return self.encode(ext, size=size)
+        if quality is None:
+            quality = default_quality
+        return self.encode(ext, (quality_param, quality), size)
+
+    def jpeg(self, quality=CameraRequestHandler.STREAM_JPEG_QUALITY):
+        '''
+        return the frame as a JPEG image
+        '''
+        return self.image('jpeg', quality)
+
+class MotionDetector():
+    '''
+    Look for motion in the frames read from a capture device.
+
+    Each frame is scaled down to MOTION_FRAME_WIDTH, made grayscale and 
+    blurred, then compared with the frame before it.  When at least 
+    threshold of the pixels changed by more than MOTION_PIXEL_DELTA a 
+    motion_start event is logged, and motion_end once there has been no
+    motion for MOTION_END_DELAY_IN_SECONDS.  Events are kept so clients 
+    can wait for them.
+
+    A frame which has hardly changed from the last frame kept for its 
+    images takes the place of that frame so it is never encoded.
+    '''
+    def __init__(self, video_device, threshold):
+        self.video_device = video_device
+        self.threshold = threshold
+        self.in_motion = False
+        self._last_motion_time = 0
+        self._previous = None       # small frame of the last frame
+        self._kept = None           # weakref to the CapturedFrame frames may share
+        self._kept_small = None
+        # guards the state above and the events, notified on each new event
+        self._condition = threading.Condition()
+        self._events = collections.deque(maxlen=MOTION_EVENTS_KEPT)
+        self._next_event_id = 1
+
+    @staticmethod
+    def small_frame(frame):
+        '''
+        return frame scaled down, grayscale and blurred for comparison
+        '''
+        size = CaptureBackends.fit_image_size(frame.shape[1], frame.shape[0], MOTION_FRAME_WIDTH, None)
+        if size is not None:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        if frame.ndim == 3:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        return cv2.GaussianBlur(frame, MOTION_BLUR_SIZE, 0)
+
+    @staticmethod
+    def changed_fraction(a, b):
+        '''
+        return the fraction of pixels which differ by more than MOTION_PIXEL_DELTA
+        '''
+        if a.shape != b.shape:
+            return 1.0
+        return numpy.count_nonzero(cv2.absdiff(a, b) > MOTION_PIXEL_DELTA) / a.size
+
+    def analyze(self, captured):
+        '''
+        look for motion in a newly read CapturedFrame, making it the same
+        as the kept frame if it has not changed
+        '''
+        with metrics.time(ServerMetrics.STAGE_SECONDS, device=self.video_device, stage='motion'):
+            small = self.small_frame(captured.frame)
+        with self._condition:
+            if self._previous is not None:
+                changed = self.changed_fraction(small, self._previous)
+                if changed >= self.threshold:
+                    self._last_motion_time = captured.when
+                    if not self.in_motion:
+                        self.in_motion = True
+                        self._add_event('motion_start', captured.when, changed)
+                elif self.in_motion and captured.when - self._last_motion_time >= MOTION_END_DELAY_IN_SECONDS:
+                    self.in_motion = False
+                    self._add_event('motion_end', captured.when, changed)
+            self._previous = small
+            kept = self._kept() if self._kept is not None else None
+            if kept is not None and self.changed_fraction(small, self._kept_small) < MOTION_UNCHANGED_FRACTION:
+                captured.same_as(kept)
+            else:
+                self._kept_small = small
+            # the newest frame holding the kept images, older ones may be freed
+            self._kept = weakref.ref(captured)
+
+    def _add_event(self, kind, when, changed):
+        '''
+        keep and log an event, call with _condition held
+        '''
+        event = {'id': self._next_event_id,
+                 'event': kind,
+                 'when': datetime.datetime.fromtimestamp(when, datetime.timezone.utc).isoformat(),
+                 'changed': round(changed, 4)}
+        self._next_event_id += 1
+        self._events.append(event)
+        self._condition.notify_all()
+        emit_json_map(log_file, {kind: self.video_device, 'changed': event['changed']})
+
+    def events_after(self, event_id, timeout):
+        '''
+        return (events, in_motion), the kept events with an id greater 
+        than event_id, waiting up to timeout seconds for one if there are
+        none yet
+        '''
+        deadline = time.time() + timeout
+        with self._condition:
+            while True:
+                events = [e for e in self._events if e['id'] > event_id]
+                remaining = deadline - time.time()
+                if events or remaining <= 0:
+                    return events, self.in_motion
+                self._condition.wait(remaining)
+
+def run_per_device(interval, read, description):
+    '''
+    Used to run a thread that makes sure each available device has a 
+    thread calling read(video_device) every interval seconds, even when
+    there are no requests.  description, such as 'recording frames', is 
+    used in the log.
+    '''
+    threads = dict()
+    while True:
+        for d in AVAILABLE_CAPTURE_DEVICES:
+            if d not in threads or not threads[d].is_alive():
+                threads[d] = threading.Thread(target=read_device, args=(d, interval, read, description), 
+                                              daemon=True)
+                threads[d].start()
+                emit_event(log_file, '{} from device {} every {} seconds'.format(description, d, interval))
+        time.sleep(DEVICE_SETTLE_TIME_IN_SECONDS)
+
+def read_device(video_device, interval, read, description):
+    '''
+    call read(video_device) every interval seconds until the device is 
+    removed, see run_per_device()
+    '''
+    next_sample_time = time.time()
+    while video_device in AVAILABLE_CAPTURE_DEVICES:
+        try:
+            read(video_device)
+        except Exception as e:
+            emit_event(log_file, '{} from device {} failed with {}'.format(description, video_device, e))
+        next_sample_time += interval
+        delay_time = next_sample_time - time.time()
+        if 0 < delay_time:
+            time.sleep(delay_time)
+        else:
+            next_sample_time = time.time()
+    emit_event(log_file, 'stopped {} from device {}'.format(description, video_device))
+
+def read_for_motion(video_device):
+    '''
+    read a frame so the MotionDetector of video_device sees frames when 
+    there are no requests
+    '''
+    get_capture_session(video_device).get_frame(MOTION_SAMPLE_INTERVAL_IN_SECONDS / 2)
+
+def release_shared_memory(shared):
+    shared.close()
+    shared.unlink()
+
+def encode_shared_frame(name, shape, dtype, ext, params, size):
+    '''
+    run in an encode process, return the encoded image of the frame in
+    SharedMemory name, scaled to size
+    '''
+    if sys.version_info >= (3, 13):
+        shared = shared_memory.SharedMemory(name=name, track=False)
+    else:
+        shared = shared_memory.SharedMemory(name=name)
+    try:
+        frame = numpy.ndarray(shape, numpy.dtype(dtype), buffer=shared.buf)
+        if size is not None:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        _, im_buf_arr = cv2.imencode(ext, frame, list(params))
+        del frame
+        return im_buf_arr.tobytes()
+    finally:
+        shared.close()
+
+def start_encode_pool(processes):
+    '''
+    return a ProcessPoolExecutor with processes encode processes
+
+    The processes are started by a fork server so they do not inherit the
+    threads and locks of this process.
+    '''
+    try:
+        context = multiprocessing.get_context('forkserver')
+    except ValueError:
+        context = None
+    return concurrent.futures.ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+class FrameRingBuffer():
+    '''
+    The last frames read from a capture device along with their times.
+
+    The space for the frames is allocated once, when the first frame
+    arrives, and reused so memory use stays fixed.  Frames are kept as 
+    they were read and only encoded when asked for.
+    '''
+    def __init__(self, video_device, size):
+        self.video_device = video_device
+        self.size = size
+        self._lock = threading.Lock()
+        self._frames = None
+        self._times = None
+        self._modified = None
+        self._sequences = None
+        self._count = 0
+        self._next = 0
+        # frames taken out of the buffer, shared while anyone uses them
+        self._captured = weakref.WeakValueDictionary()
+
+    def append(self, captured):
+        '''
+        copy the frame of a CapturedFrame into the buffer, replacing the 
+        oldest frame
+        '''
+        frame = captured.frame
+        with self._lock:
+            if self._frames is None or self._frames.shape[1:] != frame.shape or self._frames.dtype != frame.dtype:
+                # first frame or the device changed resolution
+                self._frames = numpy.empty((self.size,) + frame.shape, frame.dtype)
+                self._times = numpy.zeros(self.size)
+                self._modified = numpy.zeros(self.size)
+                self._sequences = numpy.zeros(self.size, numpy.int64)
+                self._count = 0
+                self._next = 0
+            numpy.copyto(self._frames[self._next], frame)
+            self._times[self._next] = captured.when
+            self._modified[self._next] = captured.modified
+            self._sequences[self._next] = captured.sequence
+            self._next = (self._next + 1) % self.size
+            self._count = min(self._count + 1, self.size)
+
+    def nearest(self, when):
+        '''
+        return a CapturedFrame for the recorded frame closest to when
+
+        Raise LookupError if nothing has been recorded.
+        '''
+        with self._lock:
+            if self._count == 0:
+                raise LookupError('no recorded frames for device {}'.format(self.video_device))
+            times = self._times[:self._count]
+            index = int(numpy.argmin(numpy.abs(times - when)))
+            sequence = int(self._sequences[index])
+            # frames the same as an earlier one share its sequence but not its time
+            key = (sequence, float(times[index]))
+            captured = self._captured.get(key)
+            if captured is None:
+                captured = CapturedFrame(self.video_device, self._frames[index].copy(), 
+                                         key[1], sequence, modified=float(self._modified[index]))
+                self._captured[key] = captured
+            return captured
+
+def record_frame(video_device):
+    '''
+    read a frame so the FrameRingBuffer of video_device is filled when 
+    there are no requests, frames read for requests are recorded too
+    '''
+    get_capture_session(video_device).get_frame(ring_interval / 2)
+
+def parse_frame_time(query):
+    '''
+    return the time asked for by ?at=<ISO 8601 time> or ?ago=<N>[ms|s|m],
+    or None when neither is given
+
+    Raise ValueError if the time can not be understood.
+    '''
+    if 'at' in query:
+        text = query['at'][0].strip().replace('Z', '+00:00')
+        # a + in a URL becomes a space unless it is escaped
+        text = re.sub(r' (\d\d:?\d\d)$', r'+\1', text)
+        when = datetime.datetime.fromisoformat(text)
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=datetime.timezone.utc)
+        return when.timestamp()
+    if 'ago' in query:
+        text = query['ago'][0].strip().lower()
+        for suffix, scale in (('ms', 0.001), ('s', 1), ('m', 60)):
+            if text.endswith(suffix):
+                return time.time() - float(text[:-len(suffix)]) * scale
+        return time.time() - float(text)
+    return None
+
+_capture_sessions = dict()
+_capture_sessions_lock = threading.Lock()
+def get_capture_session(video_device):
+    '''
+    return the CaptureSession for video_device, creating it if needed
+
+    Raise LookupError if video_device is not one of the available capture
+    devices so a request for any number does not leave a session behind.
+    '''
+    with _capture_sessions_lock:
+        session = _capture_sessions.get(video_device)
+        if session is None:
+            if video_device not in AVAILABLE_CAPTURE_DEVICES:
+                raise LookupError('no device {}'.format(video_device))
+            session = CaptureSession(video_device)
+            _capture_sessions[video_device] = session
+        return session
+
+def discard_capture_session(session):
+    '''
+    forget session, if it is still the CaptureSession of its device, 
+    without closing it
+    '''
+    with _capture_sessions_lock:
+        if _capture_sessions.get(session.video_device) is session:
+            del _capture_sessions[session.video_device]
+
+def pass_barrier(barrier):
+    '''
+    wait at barrier, carry on if it times out or is broken
+    '''
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+
+# held while a snapshot is taken, two snapshots each holding the lock of
+# some devices while waiting at the barrier for the others would deadlock
+_snapshot_lock = threading.Lock()
+def capture_snapshot(video_devices):
+    '''
+    return (frames, errors), a CapturedFrame from each of video_devices 
+    all grabbed at the same moment and a dict of device: exception for 
+    the devices which failed
+    '''
+    frames = list()
+    errors = dict()
+    sessions = list()
+    for d in video_devices:
+        try:
+            sessions.append(get_capture_session(d))
+        except LookupError as e:
+            # removed since the list was made
+            errors[d] = e
+    if not sessions:
+        return frames, errors
+    with _snapshot_lock:
+        ready = threading.Barrier(len(sessions), timeout=SNAPSHOT_BARRIER_TIMEOUT_IN_SECONDS)
+        grabbed = threading.Barrier(len(sessions), timeout=SNAPSHOT_BARRIER_TIMEOUT_IN_SECONDS)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(sessions)) as executor:
+            futures = [executor.submit(session.synchronized_read, ready, grabbed) for session in sessions]
+    for session, future in zip(sessions, futures):
+        try:
+            frame, when = future.result()
+        except Exception as e:
+            errors[session.video_device] = e
+            continue
+        captured = CapturedFrame(session.video_device, frame, when, HttpCaching.next_sequence(),
+                                 session.frames)
+        session.set_latest_frame(captured)
+        frames.append(captured)
+    return frames, errors
+
+def tile_frames(frames):
+    '''
+    return one frame with frames laid out in a grid
+
+    Each cell is the size of the smallest frame and each frame is scaled
+    down to fit in its cell, keeping its shape.
+    '''
+    cell_width = min(frame.shape[1] for frame in frames)
+    cell_height = min(frame.shape[0] for frame in frames)
+    columns = math.ceil(math.sqrt(len(frames)))
+    rows = math.ceil(len(frames) / columns)
+    tiled = numpy.zeros((rows * cell_height, columns * cell_width) + frames[0].shape[2:], frames[0].dtype)
+    for i, frame in enumerate(frames):
+        size = CaptureBackends.fit_image_size(frame.shape[1], frame.shape[0], cell_width, cell_height)
+        if size is not None:
+            frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+        row, column = divmod(i, columns)
+        top = row * cell_height + (cell_height - frame.shape[0]) // 2
+        left = column * cell_width + (cell_width - frame.shape[1]) // 2
+        tiled[top:top + frame.shape[0], left:left + frame.shape[1]] = frame
+    return tiled
+
+def get_captured_frame(video_device=0, max_age=0, at=None):
+    '''
+    return a CapturedFrame from a USB camera
+
+    A frame captured no more than max_age seconds ago may be returned.  If
+    at is given the recorded frame closest to that time is returned 
+    instead, LookupError is raised if there is none.
+    '''
+    session = get_capture_session(video_device)
+    if at is None:
+        return session.get_frame(max_age)
+    if session.ring is None:
+        raise LookupError('frames are not being recorded')
+    return session.ring.nearest(at)
+
+def capture_image(video_device=0, max_age=0, image_format=DEFAULT_IMAGE_FORMAT, quality=None,
+                  width=None, height=None, at=None):
+    '''
+    create in memory image from a USB camera
+
+    An image captured no more than max_age seconds ago may be returned.
+    The device lock is only held for the read so the device can be read
+    again while this image is encoded.
+    '''
+    captured = get_captured_frame(video_device, max_age, at)
+    return captured.image(image_format, quality, width, height)
+
+def choose_image_format(query, accept):
+    '''
+    return the (image_format, quality) asked for by a request
+
+    ?format= and ?quality= take precedence over the Accept header.  When 
+    neither picks a supported format DEFAULT_IMAGE_FORMAT is used.
+    Raise ValueError for an unknown format or a bad quality.
+    '''
+    image_format = None
+    if 'format' in query:
+        name = query['format'][0].lower()
+        image_format = IMAGE_FORMAT_ALIASES.get(name, name)
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError('format of "{}" is not one of {}'.format(name, sorted(IMAGE_FORMATS)))
+    elif accept:
+        # pick the supported type with the highest q value, wildcards 
+        # get the default format
+        best_q = 0
+        for item in accept.split(','):
+            fields = item.strip().split(';')
+            media_type = fields[0].strip().lower()
+            q = 1.0
+            for param in fields[1:]:
+                name, _, value = param.strip().partition('=')
+                if name.strip() == 'q':
+                    try:
+                        q = float(value)
+                    except ValueError:
+                        q = 0
+            if media_type in ('image/*', '*/*'):
+                candidate = DEFAULT_IMAGE_FORMAT
+            else:
+                candidate = CONTENT_TYPE_FORMATS.get(media_type)
+            if candidate is not None and q > best_q:
+                image_format = candidate
+                best_q = q
+    if image_format is None:
+        image_format = DEFAULT_IMAGE_FORMAT
+
+    quality = None
+    if 'quality' in query:
+        quality = int(query['quality'][0])
+        if quality < MINIMUM_IMAGE_QUALITY or quality > MAXIMUM_IMAGE_QUALITY:
+            raise ValueError('quality of {} is not between {} and {}'.format(quality,
+                                                                             MINIMUM_IMAGE_QUALITY,
+                                                                             MAXIMUM_IMAGE_QUALITY))
+    return image_format, quality
+
+def choose_image_size(query):
+    '''
+    return the (width, height) asked for by ?size=, ?width= and ?height=
+
+    Either may be None.  Raise ValueError for an unknown size or a bad 
+    width or height.
+    '''
+    width = None
+    height = None
+    if 'size' in query:
+        name = query['size'][0].lower()
+        if name not in IMAGE_SIZES:
+            raise ValueError('size of "{}" is not one of {}'.format(name, sorted(IMAGE_SIZES)))
+        width, height = IMAGE_SIZES[name]
+    if 'width' in query:
+        width = int(query['width'][0])
+    if 'height' in query:
+        height = int(query['height'][0])
+    for name, value in (('width', width), ('height', height)):
+        if value is not None and (value < 1 or value > MAXIMUM_IMAGE_DIMENSION):
+            raise ValueError('{} of {} is not between 1 and {}'.format(name, value, MAXIMUM_IMAGE_DIMENSION))
+    return width, height
+
+class TimelapseRecorder():
+    '''
+    Save a frame from each capture device every interval seconds.
+
+    Images are saved as <directory>/device-N/<UTC day>/<HHMMSSmmm>.jpg
+    and each day has an index.jsonl with a line for each image giving its
+    file, time and length, so the images for a time can be found without
+    listing the directory.
+
+    A thread for each device reads frames, sharing them with requests, 
+    and hands them through a short queue to one writer thread which 
+    encodes them and writes each to a temporary file which is renamed 
+    into place.  If the writer falls behind frames are dropped.  Once the
+    images use more than budget bytes the oldest are removed, down to 
+    TIMELAPSE_TRIM_FRACTION of the budget.
+    '''
+    def __init__(self, directory, interval, budget):
+        self.directory = directory
+        self.interval = interval
+        self.budget = budget
+        self._queue = queue.Queue(TIMELAPSE_QUEUE_FRAMES)
+        # (day directory, path, length) of every image, oldest first
+        self._files = collections.deque()
+        self._used = 0
+
+    def start(self):
+        '''
+        find the images already saved and start the threads
+        '''
+        self._scan()
+        emit_event(log_file, 'timelapse in {} has {} images using {} bytes'.format(self.directory, len(self._files),
+                                                                                   self._used))
+        threading.Thread(target=self._write_frames, daemon=True).start()
+        threading.Thread(target=run_per_device, args=(self.interval, self._read_frame, 'saving timelapse frames'), 
+                         daemon=True).start()
+
+    def _scan(self):
+        found = []
+        os.makedirs(self.directory, exist_ok=True)
+        for device_name in os.listdir(self.directory):
+            device_path = os.path.join(self.directory, device_name)
+            if not device_name.startswith('device-') or not os.path.isdir(device_path):
+                continue
+            for day in os.listdir(device_path):
+                day_path = os.path.join(device_path, day)
+                if not TIMELAPSE_DAY_PATTERN.match(day) or not os.path.isdir(day_path):
+                    continue
+                for name in os.listdir(day_path):
+                    path = os.path.join(day_path, name)
+                    if name.endswith('.tmp'):
+                        # left by a write which did not finish
+                        os.remove(path)
+                    elif name != TIMELAPSE_INDEX_FILE_NAME:
+                        found.append(((day, name), day_path, path, os.path.getsize(path)))
+        for _, day_path, path, length in sorted(found):
+            self._files.append((day_path, path, length))
+            self._used += length
+        self._evict()
+
+    def _read_frame(self, video_device):
+        '''
+        queue a frame from video_device to be saved
+        '''
+        captured = get_capture_session(video_device).get_frame(min(self.interval / 2, max_frame_age))
+        try:
+            self._queue.put_nowait(captured)
+        except queue.Full:
+            emit_event(log_file, 'timelapse writer is behind, dropped frame from device {}'.format(video_device))
+
+    def _write_frames(self):
+        while True:
+            captured = self._queue.get()
+            try:
+                self._save(captured)
+            except Exception as e:
+                emit_event(log_file, 'saving timelapse frame from device {} failed with {}'.format(captured.video_device, e))
+
+    def _save(self, captured):
+        '''
+        encode and write a frame, add it to its day's index and keep 
+        within the budget
+        '''
+        when = datetime.datetime.fromtimestamp(captured.when, datetime.timezone.utc)
+        day_path = os.path.join(self.directory, 'device-{}'.format(captured.video_device),
+                                when.strftime(TIMELAPSE_DAY_FORMAT))
+        name = '{}{:03d}{}'.format(when.strftime('%H%M%S'), when.microsecond // 1000,
+                                   IMAGE_FORMATS[TIMELAPSE_FORMAT][0])
+        image = captured.image(TIMELAPSE_FORMAT, TIMELAPSE_QUALITY)
+        os.makedirs(day_path, exist_ok=True)
+        path = os.path.join(day_path, name)
+        write_file_atomically(path, image)
+        with open(os.path.join(day_path, TIMELAPSE_INDEX_FILE_NAME), 'a') as index:
+            index.write('{}\n'.format(json.dumps({'file': name, 'when': when.isoformat(), 'length': len(image)})))
+        self._files.append((day_path, path, len(image)))
+        self._used += len(image)
+        self._evict()
+
+    def _evict(self):
+        '''
+        once past the budget remove the oldest images, and days left empty,
+        until within TIMELAPSE_TRIM_FRACTION of it and take the removed 
+        images out of their day's index
+        '''
+        if self._used <= self.budget:
+            return
+        # day directory: names of the images removed from it
+        removed = collections.defaultdict(set)
+        while self._used > self.budget * TIMELAPSE_TRIM_FRACTION and len(self._files) > 1:
+            day_path, path, length = self._files.popleft()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._used -= length
+            removed[day_path].add(os.path.basename(path))
+        count = sum(len(names) for names in removed.values())
+        for day_path, names in removed.items():
+            if set(os.listdir(day_path)) <= {TIMELAPSE_INDEX_FILE_NAME}:
+                # those were the last images of the day, the index goes too
+                shutil.rmtree(day_path, ignore_errors=True)
+            else:
+                self._trim_index(day_path, names)
+        if count:
+            emit_event(log_file, 'timelapse removed {} oldest images, {} bytes used'.format(count, self._used))
+
+    def _trim_index(self, day_path, names):
+        '''
+        rewrite the index of day_path without the images in names
+        '''
+        index_path = os.path.join(day_path, TIMELAPSE_INDEX_FILE_NAME)
+        try:
+            with open(index_path) as index:
+                kept = [line for line in index if json.loads(line)['file'] not in names]
+            write_file_atomically(index_path, ''.join(kept).encode('utf-8'))
+        except Exception as e:
+            emit_event(log_file, 'unable to trim timelapse index {} because {}'.format(index_path, e))
+
+def write_file_atomically(path, data):
+    '''
+    write data to a temporary file and rename it to path so path is 
+    never seen partly written
+    '''
+    temporary = path + '.tmp'
+    with open(temporary, 'wb') as output:
+        output.write(data)
+        output.flush()
+        os.fsync(output.fileno())
+    os.replace(temporary, path)
+
+class StreamGrabber():
+    '''
+    Read frames from one capture device at a steady rate and hand the JPEG
+    of each frame to every attached stream client.
+
+    Each client has a short queue of its own.  When a client falls behind
+    the oldest frame in its queue is dropped so it never holds up the 
+    grabber or the other clients.  The grabber thread runs only while at
+    least one client is attached.
+
+    Once the device is removed the grabber stops and each client is sent
+    None to end its stream.
+    '''
+    def __init__(self, video_device, fps):
+        self.video_device = video_device
+        self.fps = fps
+        self._lock = threading.Lock()
+        self._clients = set()
+        self._thread = None
+        self._stopped = False
+
+    def attach(self):
+        '''
+        return a queue which will receive JPEG images from the device
+
+        Raise LookupError if the grabber has stopped.
+        '''
+        client = queue.Queue(maxsize=CameraRequestHandler.STREAM_CLIENT_QUEUE_FRAMES)
+        with self._lock:
+            if self._stopped:
+                raise LookupError('no device {}'.format(self.video_device))
+            self._clients.add(client)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+        return client
+
+    def detach(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def stop(self):
+        '''
+        stop grabbing, the streams end once the grabber thread sees this
+        '''
+        with self._lock:
+            self._stopped = True
+
+    def is_stopped(self):
+        return self._stopped
+
+    @staticmethod
+    def _put(client, image):
+        '''
+        queue image for client, replacing its oldest if it is behind
+        '''
+        try:
+            client.put_nowait(image)
+        except queue.Full:
+            # slow client, replace its oldest frame
+            try:
+                client.get_nowait()
+            except queue.Empty:
+                pass
+            client.put_nowait(image)
+
+    def _run(self):
+        interval = 1.0 / self.fps
+        next_frame_time = time.time()
+        while True:
+            with self._lock:
+                stopped = self._stopped
+                clients = list(self._clients)
+                if stopped:
+                    self._clients.clear()
+                if stopped or not clients:
+                    self._thread = None
+            if stopped:
+                for client in clients:
+                    self._put(client, None)
+                emit_event(log_file, 'stream of device {} ended, the device was removed'.format(self.video_device))
+                return
+            if not clients:
+                return
+            try:
+                image = get_capture_session(self.video_device).get_frame().jpeg()
+                for client in clients:
+                    self._put(client, image)
+            except LookupError:
+                # the device is gone
+                self.stop()
+                continue
+            except Exception as e:
+                emit_event(log_file, 'stream of device {} failed with {}'.format(self.video_device, e))
+                time.sleep(STREAM_RETRY_DELAY_IN_SECONDS)
+                next_frame_time = time.time()
+            next_frame_time += interval
+            delay_time = next_frame_time - time.time()
+            if 0 < delay_time:
+                time.sleep(delay_time)
+            else:
+                next_frame_time = time.time()
+
+_stream_grabbers = dict()
+_stream_grabbers_lock = threading.Lock()
+def get_stream_grabber(video_device):
+    '''
+    return the StreamGrabber for video_device, creating it if needed
+    '''
+    with _stream_grabbers_lock:
+        grabber = _stream_grabbers.get(video_device)
+        if grabber is None or grabber.is_stopped():
+            grabber = StreamGrabber(video_device, stream_fps)
+            _stream_grabbers[video_device] = grabber
+        return grabber
+
+def stop_stream_grabber(video_device):
+    '''
+    stop the StreamGrabber for video_device, if there is one, ending its 
+    streams
+    '''
+    with _stream_grabbers_lock:
+        grabber = _stream_grabbers.pop(video_device, None)
+    if grabber is not None:
+        grabber.stop()
+
+def remove_capture_session(video_device):
+    '''
+    close and forget the CaptureSession for video_device, if there is one
+    '''
+    with _capture_sessions_lock:
+        session = _capture_sessions.pop(video_device, None)
+    if session is not None:
+        with session.lock:
+            session.close()
+
+class CaptureDeviceRegistry():
+    '''
+    Keep AVAILABLE_CAPTURE_DEVICES up to date as cameras are plugged in and 
+    removed.
+
+    /dev is watched for video nodes coming and going.  Only the device 
+    which changed is looked at, after a short wait for udev to finish
+    setting it up, and only its session is closed when it goes away.
+    '''
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._pending = dict()  # device number: time to look at it
+
+    def start(self):
+        threading.Thread(target=FindCaptureDevices.watch_video_nodes,
+                         args=(self._node_changed,),
+                         daemon=True).start()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _node_changed(self, dev, present):
+        if DEBUG:
+            print('video node {} changed, present = {}'.format(dev, present),
+                  file=sys.stderr, flush=True)
+        with self._condition:
+            self._pending[dev] = time.time() + DEVICE_SETTLE_TIME_IN_SECONDS
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    now = time.time()
+                    due = [d for d, t in self._pending.items() if t <= now]
+                    if due:
+                        break
+                    wait_time = min(self._pending.values()) - now if self._pending else None
+                    self._condition.wait(wait_time)
+                for d in due:
+                    del self._pending[d]
+            for d in sorted(due):
+                try:
+                    self.update_device(d)
+                except Exception as e:
+                    emit_event(log_file, 'checking capture device {} failed with {}'.format(d, e))
+
+    def update_device(self, dev):
+        '''
+        look at one device and add it to, or remove it from, 
+        AVAILABLE_CAPTURE_DEVICES
+        '''
+        global AVAILABLE_CAPTURE_DEVICES
+        details = None
+        if os.path.exists(os.path.join(FindCaptureDevices.DEV_DIR, 'video{}'.format(dev))):
+            with _capture_sessions_lock:
+                session = _capture_sessions.get(dev)
+            is_open = session is not None and session.is_open()
+            details = FindCaptureDevices.describe_capture_device(dev, probe=not is_open)
+
+        with _capture_devices_lock:
+            if details is not None:
+                CAPTURE_DEVICE_DETAILS[dev] = details
+                if dev in AVAILABLE_CAPTURE_DEVICES:
+                    return
+                AVAILABLE_CAPTURE_DEVICES = sorted(AVAILABLE_CAPTURE_DEVICES + [dev])
+            else:
+                CAPTURE_DEVICE_DETAILS.pop(dev, None)
+                if dev not in AVAILABLE_CAPTURE_DEVICES:
+                    return
+                AVAILABLE_CAPTURE_DEVICES = [d for d in AVAILABLE_CAPTURE_DEVICES if d != dev]
+        if details is not None:
+            emit_json_map(log_file, {'capture_device_added': details})
+        else:
+            stop_stream_grabber(dev)
+            remove_capture_session(dev)
+            emit_event(log_file, 'capture device {} removed'.format(dev))
 
-LAST_DEVICE_TO_TRY = 99
 def find_capture_devices():
     '''
     return a list of the available capture devices
     
-    Also update AVAILABLE_CAPTURE_DEVICES
+    Also update AVAILABLE_CAPTURE_DEVICES and CAPTURE_DEVICE_DETAILS
     '''
-    result = list()
-    with _capture_lock:
-        for dev in range(0,LAST_DEVICE_TO_TRY+1):
-            try:
-                cap = cv2.VideoCapture(dev)
-                if cap.isOpened():
-                    result.append(dev)
-            finally:
-                cap.release()
+    global AVAILABLE_CAPTURE_DEVICES
+    # a device held open by a session is not opened again
+    with _capture_sessions_lock:
+        open_devices = [d for d, s in _capture_sessions.items() if s.is_open()]
+    if capture_backend == 'opencv':
+        details = FindCaptureDevices.describe_capture_devices(open_devices)
+    else:
+        details = CaptureBackends.describe_devices(capture_backend)
+    result = [d['device'] for d in details]
+    with _capture_devices_lock:
+        CAPTURE_DEVICE_DETAILS.clear()
+        for d in details:
+            CAPTURE_DEVICE_DETAILS[d['device']] = d
         AVAILABLE_CAPTURE_DEVICES = result
-        if DEBUG:
-            print('Found available capture devices of {}'.format(result),
-                  file=sys.stderr, flush=True)
-        return result        
+    if DEBUG:
+        print('Found available capture devices of {}'.format(result),
+              file=sys.stderr, flush=True)
+    return result        
         
 
-class Camera_HTTPServer_RequestHandler(BaseHTTPRequestHandler):
+class Camera_HTTPServer_RequestHandler(CameraRequestHandler.CameraRequestHandler):
     '''
     A subclass of BaseHTTPRequestHandler to provide camera output.
     '''
+    metrics = metrics
+
+    @staticmethod
+    def is_long_running(path):
+        '''
+        return True if the request for path may run for a long time, the
+        asyncio front end runs these outside its pool of workers
+        '''
+        parts = urllib.parse.urlsplit(path)
+        return (parts.path.endswith('/stream') or parts.path.endswith('/events')
+                or 'wait_newer_than' in urllib.parse.parse_qs(parts.query))
+
+    def send_cache_headers(self, captured):
+        '''
+        send the headers that let a client ask if it has this frame already
+        '''
+        super().send_cache_headers(captured)
+        self.send_header('Vary', 'Accept')
+
+    def send_image(self, image, image_format, captured):
+        '''
+        send an image in one of the IMAGE_FORMATS encoded from captured
+        '''
+        self.send_response(200)
+        self.send_header('Content-type', IMAGE_FORMATS[image_format][1])
+        self.send_header('Content-Length', len(image))
+        self.send_cache_headers(captured)
+        self.end_headers()
+        self.write_body(image, captured.video_device)
+
+    def send_captured_image(self, d, max_age, image_format, quality, width, height, at, newer_than, timeout):
+        '''
+        send an image from device d unless the client already has it
+
+        With newer_than, the sequence from ?wait_newer_than=, wait up to 
+        timeout seconds for a newer frame and answer 304 if none comes.
+        LookupError is raised if there is no such frame.
+        '''
+        if newer_than is None:
+            captured = get_captured_frame(video_device=d, max_age=max_age, at=at)
+        else:
+            captured = get_capture_session(d).wait_for_newer_frame(newer_than, max_age, timeout)
+            if captured is None:
+                self.send_not_modified(None)
+                return
+        if HttpCaching.is_not_modified(self.headers, captured.etag, captured.modified):
+            self.send_not_modified(captured)
+            return
+        image = captured.image(image_format, quality, width, height)
+        self.send_image(image, image_format, captured)
+        emit_event(log_file, 'done sending {} image of length {} from device {}'.format(image_format, len(image), d))
+
+    def send_snapshot_headers(self, frames, errors):
+        '''
+        send the capture time of each frame, the skew between them and any
+        devices which failed
+        '''
+        times = [captured.when for captured in frames]
+        self.send_header('X-Capture-Times',
+                         ', '.join('{}={:.6f}'.format(c.video_device, c.when) for c in frames))
+        self.send_header('X-Capture-Skew', '{:.6f}'.format(max(times) - min(times)))
+        if errors:
+            self.send_header('X-Capture-Errors',
+                             ', '.join('{}={}'.format(d, e) for d, e in errors.items()))
+        self.send_header('Last-Modified', HttpCaching.http_date(max(times)))
+        self.send_header('Cache-Control', 'no-cache')
+
+    def send_snapshot(self, layout, image_format, quality, width, height):
+        '''
+        send images from every capture device grabbed at the same moment,
+        tiled into one image or as the parts of a multipart/mixed response
+        '''
+        devices = list(AVAILABLE_CAPTURE_DEVICES)
+        if not devices:
+            self.send_text(404, '404 NOT FOUND: no capture devices')
+            return
+        frames, errors = capture_snapshot(devices)
+        if not frames:
+            self.send_text(503, '503 SERVICE UNAVAILABLE: no capture device could be read')
+            return
+        skew = max(c.when for c in frames) - min(c.when for c in frames)
+        if layout == 'tile':
+            tiled = CapturedFrame('all', tile_frames([c.frame for c in frames]),
+                                  min(c.when for c in frames), HttpCaching.next_sequence())
+            image = tiled.image(image_format, quality, width, height)
+            self.send_response(200)
+            self.send_header('Content-type', IMAGE_FORMATS[image_format][1])
+            self.send_header('Content-Length', len(image))
+            self.send_snapshot_headers(frames, errors)
+            self.end_headers()
+            self.write_body(image, tiled.video_device)
+            length = len(image)
+        else:
+            content_type = IMAGE_FORMATS[image_format][1]
+            parts = [(c, c.image(image_format, quality, width, height)) for c in frames]
+            self.send_response(200)
+            self.send_header('Content-type', 'multipart/mixed; boundary={}'.format(SNAPSHOT_BOUNDARY))
+            self.send_snapshot_headers(frames, errors)
+            self.end_headers()
+            length = 0
+            for captured, image in parts:
+                part_header = '--{}\r\nContent-type: {}\r\nContent-Length: {}\r\nX-Capture-Device: {}\r\nX-Capture-Time: {:.6f}\r\n\r\n'.format(
+                    SNAPSHOT_BOUNDARY, content_type, len(image), captured.video_device, captured.when)
+                self.write_body(part_header.encode('utf-8'))
+                self.write_body(image, captured.video_device)
+                self.write_body(b'\r\n')
+                length += len(image)
+            self.write_body('--{}--\r\n'.format(SNAPSHOT_BOUNDARY).encode('utf-8'))
+        emit_event(log_file, 'done sending {} snapshot of {} devices, length {}, skew {:.6f} seconds'.format(layout, len(frames),
+                                                                                                          length, skew))
+
+    def send_events(self, d, query):
+        '''
+        send the motion events of device d after ?since=<id> as JSON, 
+        waiting up to ?timeout= seconds for one if there are none yet
+        '''
+        session = get_capture_session(d)
+        if session.motion is None:
+            self.send_text(404, '404 NOT FOUND: motion detection is off, turn it on with -M')
+            return
+        try:
+            since = int(query['since'][0]) if 'since' in query else 0
+            timeout = HttpCaching.long_poll_timeout(query) if 'since' in query else 0
+        except ValueError as e:
+            self.send_text(400, '400 BAD REQUEST: {}'.format(e))
+            return
+        events, in_motion = session.motion.events_after(since, timeout)
+        next_id = events[-1]['id'] if events else since
+        text = json.dumps({'events': events, 'motion': in_motion, 'next': next_id}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-type','text/json')
+        self.send_header('Content-Length', len(text))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.write_body(text)
+        emit_event(log_file, 'done sending {} events from device {}'.format(len(events), d))
+
     def do_GET(self):
+        '''
+        handle the HTTP GET request, counting it while it is in flight
+        '''
+        metrics.inc(ServerMetrics.REQUESTS_IN_FLIGHT)
+        try:
+            self.handle_get()
+        finally:
+            metrics.inc(ServerMetrics.REQUESTS_IN_FLIGHT, -1)
+
+    def handle_get(self):
         '''
         handle the HTTP GET request
         '''
@@ -160,82 +1676,146 @@ class Camera_HTTPServer_RequestHandler(BaseHTTPRequestHandler):
         
         emit_event(log_file, 'request of "{}," from {}'.format(self.path,
                                                                self.client_address))
+        url = urllib.parse.urlsplit(self.path)
+        path = url.path
+        query = urllib.parse.parse_qs(url.query)
+
         if ALLOW_REMOTE_KILL:
             # allow an external entity to remotely kill the daemon so it can be restarted 
-            if self.path == '/kill':
+            if path == '/kill':
                 self.send_response(200)
                 self.send_header('Content-type','text/text')
                 self.end_headers()
-                self.wfile.write('killing server'.encode('utf-8'))
+                self.write_body('killing server'.encode('utf-8'))
                 emit_event(log_file, 'killing server')
                 log_file.flush()
                 exit(10)
                 return
 
         # deal with site ICON 
-        if self.path == '/favicon.ico':
+        if path == '/favicon.ico':
             self.send_response(200)
             self.send_header('Content-type','image/x-icon')
+            self.send_header('Content-Length', len(FAVICON))
             self.end_headers()
-            self.wfile.write(FAVICON)
+            self.write_body(FAVICON)
             emit_event(log_file, 'done sending favicon.ico of length {}'.format(len(FAVICON)))
             return
 
+        # counters and latency histograms
+        if path == '/metrics':
+            text = metrics.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-type', ServerMetrics.CONTENT_TYPE)
+            self.send_header('Content-Length', len(text))
+            self.end_headers()
+            self.write_body(text)
+            return
+
         # return JSON list of valid capture URLs 
-        if self.path == '/capture-devices':
-            # find_capture_devices()  # seems OpenCV only updates devices at startup
+        if path == '/capture-devices':
+            # kept up to date by CaptureDeviceRegistry
             url_list = list()
             for d in AVAILABLE_CAPTURE_DEVICES:
                 url_list.append('/capture-devices/{}'.format(d))
+            text = json.dumps(url_list).encode('utf-8')
             self.send_response(200)
             self.send_header('Content-type','text/json')
+            self.send_header('Content-Length', len(text))
             self.end_headers()
-            self.wfile.write(json.dumps(url_list).encode('utf-8'))
+            self.write_body(text)
             emit_event(log_file, 'done sending list with {} valid capture-device URLs'.format(len(url_list)))
             return
+
+        # how old a cached image the client will accept
+        try:
+            max_age = float(query['max_age'][0]) if 'max_age' in query else max_frame_age
+        except ValueError:
+            self.send_text(400, '400 BAD REQUEST: max_age of "{}" is not a number'.format(query['max_age'][0]))
+            return
         
-        # return JSON list of valid capture URLs 
-        if '/capture-devices/' in self.path:
+        # which image format the client wants
+        try:
+            image_format, quality = choose_image_format(query, self.headers.get('Accept'))
+            width, height = choose_image_size(query)
+            at = parse_frame_time(query)
+            newer_than = None
+            if 'wait_newer_than' in query:
+                newer_than = HttpCaching.parse_etag(query['wait_newer_than'][0])
+                if at is not None:
+                    raise ValueError('can not use wait_newer_than with at or ago')
+            timeout = HttpCaching.long_poll_timeout(query)
+        except ValueError as e:
+            self.send_text(400, '400 BAD REQUEST: {}'.format(e))
+            return
+
+        # return images from all capture devices taken at the same moment
+        if path == '/capture-devices/all':
+            layout = query['layout'][0].lower() if 'layout' in query else SNAPSHOT_LAYOUTS[0]
+            if layout not in SNAPSHOT_LAYOUTS:
+                self.send_text(400, '400 BAD REQUEST: layout of "{}" is not one of {}'.format(layout, SNAPSHOT_LAYOUTS))
+                return
+            self.send_snapshot(layout, image_format, quality, width, height)
+            return
+
+        # return motion events from the given capture device
+        if path.startswith('/capture-devices/') and path.endswith('/events'):
             try:
-                d = int(self.path.split('/capture-devices/')[1])
-                try:
-                    image = capture_image(video_device=d)
-                    self.send_response(200)
-                    self.send_header('Content-type','image/png')
-                    self.end_headers()
-                    self.wfile.write(image)
-                    emit_event(log_file, 'done sending image of length {} from device {}'.format(len(image), d))
-                    return
-                except:
-                    self.send_response(404)
-                    self.send_header('Content-type','text/text')
-                    self.end_headers()
-                    self.wfile.write('404 NOT FOUND: no device {}'.format(d).encode('utf-8'))
-                    emit_event(log_file, '404 NOT FOUND: no device {}'.format(d))
-                    return
+                d = int(path[len('/capture-devices/'):-len('/events')])
+            except ValueError:
+                self.send_text(400, '400 BAD REQUEST: expect URL of form /capture-devices/#/events?since=#')
+                return
+            if d not in AVAILABLE_CAPTURE_DEVICES:
+                self.send_text(404, '404 NOT FOUND: no device {}'.format(d))
+                return
+            self.send_events(d, query)
+            return
+
+        # return MJPEG stream from the given capture device
+        if path.startswith('/capture-devices/') and path.endswith('/stream'):
+            try:
+                d = int(path[len('/capture-devices/'):-len('/stream')])
+                fps = float(query['fps'][0]) if 'fps' in query else stream_fps
             except:
-                self.send_response(400)
-                self.send_header('Content-type','text/text')
-                self.end_headers()
-                self.wfile.write('400 BAD REQUEST: expect URL of form /capture-devices/#'.encode('utf-8'))
-                emit_event(log_file, '400 BAD REQUEST: expect URL of form /capture-devices/#')
+                self.send_text(400, '400 BAD REQUEST: expect URL of form /capture-devices/#/stream?fps=#')
                 return
+            if d not in AVAILABLE_CAPTURE_DEVICES:
+                self.send_text(404, '404 NOT FOUND: no device {}'.format(d))
+                return
+            self.send_stream(get_stream_grabber(d), d, min(max(fps, MINIMUM_STREAM_FPS), stream_fps))
+            return
 
-        if self.path == '/':
-            self.send_response(200)
-            self.send_header('Content-type','image/png')
-            self.end_headers()
-            image = capture_image(video_device=video_device)
-            self.wfile.write(image)
-            emit_event(log_file, 'done sending image of length {}'.format(len(image)))
+        # return image from the given capture device
+        if path.startswith('/capture-devices/'):
+            try:
+                d = int(path.split('/capture-devices/')[1])
+            except ValueError:
+                self.send_text(400, '400 BAD REQUEST: expect URL of form /capture-devices/#')
+                return
+            if d not in AVAILABLE_CAPTURE_DEVICES:
+                self.send_text(404, '404 NOT FOUND: no device {}'.format(d))
+                return
+            try:
+                self.send_captured_image(d, max_age, image_format, quality,
+                                         width, height, at, newer_than, timeout)
+            except LookupError as e:
+                self.send_text(404, '404 NOT FOUND: {}'.format(e))
+            except:
+                self.send_text(404, '404 NOT FOUND: no device {}'.format(d))
+            return
+
+        if path == '/':
+            try:
+                self.send_captured_image(video_device, max_age, image_format, quality,
+                                         width, height, at, newer_than, timeout)
+            except LookupError as e:
+                self.send_text(404, '404 NOT FOUND: {}'.format(e))
+            except:
+                self.send_text(404, '404 NOT FOUND: no device {}'.format(video_device))
             return
 
         # if none of the known patterns are matched, it is an error
-        self.send_response(400)
-        self.send_header('Content-type','text/text')
-        self.end_headers()
-        self.wfile.write('400 BAD REQUEST: expect URL of "{}" is not recognized'.format(self.path).encode('utf-8'))
-        emit_event(log_file, '400 BAD REQUEST: expect URL of "{}" is not recognized'.format(self.path))
+        self.send_text(400, '400 BAD REQUEST: expect URL of "{}" is not recognized'.format(self.path))
         return
 
     def log_message(self, format, *args):
@@ -254,7 +1834,10 @@ def periodic_capture_sample(video_device=0):
             if DEBUG:
                 print('about to take a periodic image sample for device {}'.format(d),
                       file=sys.stderr, flush=True)
-            discard_image = capture_image(video_device=d)
+            try:
+                get_capture_session(d).get_frame()
+            except Exception as e:
+                emit_event(log_file, 'periodic sample of device {} failed with {}'.format(d, e))
             if DEBUG:
                 print('done taking a periodic image sample for device {}'.format(d),
                       file=sys.stderr, flush=True)
@@ -278,9 +1861,56 @@ if __name__ == '__main__':
     parser.add_argument('-v', '--video_device', 
                         help='video device to use', 
                         default=DEFAULT_VIDEO_DEVICE)
+    parser.add_argument('-B', '--backend', 
+                        help='where frames come from, opencv for USB cameras, picamera or synthetic test frames', 
+                        choices=CaptureBackends.BACKENDS,
+                        default=CaptureBackends.DEFAULT_BACKEND)
     parser.add_argument("-l", "--log_filename", 
                         help="file to log data, create or append", 
                         default=DEFAULT_LOG_FILE_NAME)
+    parser.add_argument("-i", "--icon_filename", 
+                        help="favicon.ico file to serve", 
+                        default=DEFAULT_ICON_FILE_NAME)
+    JsonLogWriter.add_rotation_arguments(parser)
+    parser.add_argument('-f', '--stream_fps', 
+                        help='frames per second for MJPEG streams', 
+                        default=CameraRequestHandler.DEFAULT_STREAM_FPS)
+    parser.add_argument('-s', '--max_streams', 
+                        help='maximum number of MJPEG streams at one time', 
+                        default=CameraRequestHandler.DEFAULT_MAX_STREAMS)
+    parser.add_argument('-e', '--encode_processes', 
+                        help='processes used to encode images, 0 to encode in request threads', 
+                        default=DEFAULT_ENCODE_PROCESSES)
+    parser.add_argument('-n', '--ring_frames', 
+                        help='frames to keep in memory per device, or seconds to keep such as 60s', 
+                        default=DEFAULT_RING_FRAMES)
+    parser.add_argument('-t', '--ring_interval', 
+                        help='seconds between frames kept in memory', 
+                        default=DEFAULT_RING_INTERVAL_IN_SECONDS)
+    parser.add_argument('-M', '--motion', 
+                        help='fraction of the frame, such as 0.01, which must change for motion, 0 for off', 
+                        default=DEFAULT_MOTION_THRESHOLD)
+    parser.add_argument('-T', '--timelapse_dir', 
+                        help='directory to save a frame from each device every timelapse_interval seconds', 
+                        default=DEFAULT_TIMELAPSE_DIRECTORY)
+    parser.add_argument('-k', '--timelapse_interval', 
+                        help='seconds between timelapse frames', 
+                        default=DEFAULT_TIMELAPSE_INTERVAL_IN_SECONDS)
+    parser.add_argument('-b', '--timelapse_budget', 
+                        help='disk space for timelapse images, e.g. 500M or 4G, the oldest are removed', 
+                        default=DEFAULT_TIMELAPSE_BUDGET)
+    parser.add_argument('-m', '--max_age', 
+                        help='seconds a captured image may be reused for other requests', 
+                        default=SharedCapture.DEFAULT_MAX_AGE_IN_SECONDS)
+    parser.add_argument('-A', '--asyncio', 
+                        help='serve with asyncio, HTTP/1.1 keep-alive and a bounded thread pool', 
+                        action='store_true')
+    parser.add_argument('-w', '--workers', 
+                        help='threads running requests when using asyncio', 
+                        default=AsyncHttpServer.DEFAULT_MAX_WORKERS)
+    parser.add_argument('-r', '--max_requests', 
+                        help='requests accepted at one time when using asyncio, more get a 503', 
+                        default=AsyncHttpServer.DEFAULT_MAX_IN_FLIGHT)
     args = parser.parse_args()
 
     if (args.debug):
@@ -289,20 +1919,55 @@ if __name__ == '__main__':
               file=sys.stderr, flush=True)
 
     log_filename = args.log_filename
+    try:
+        log_rotation = JsonLogWriter.rotation_settings(args)
+    except ValueError as e:
+        parser.error('log rotation: {}'.format(e))
     given_address = args.address
     given_port = int(args.port)
+    use_asyncio = args.asyncio
+    max_workers = int(args.workers)
+    max_in_flight = int(args.max_requests)
     video_device = int(args.video_device)
+    capture_backend = args.backend
+    max_frame_age = float(args.max_age)
+    stream_fps = max(float(args.stream_fps), MINIMUM_STREAM_FPS)
+    max_streams = int(args.max_streams)
+    encode_processes = int(args.encode_processes)
+    ring_interval = float(args.ring_interval)
+    if args.ring_frames.lower().endswith('s'):
+        ring_frames = int(float(args.ring_frames[:-1]) / ring_interval + 0.5)
+    else:
+        ring_frames = int(args.ring_frames)
+    if use_asyncio and max_streams >= max_in_flight:
+        parser.error('max_streams must be less than max_requests so other requests can be served')
+    Camera_HTTPServer_RequestHandler.stream_slots = threading.BoundedSemaphore(max_streams)
+    motion_threshold = float(args.motion)
+    timelapse_dir = args.timelapse_dir
+    timelapse_interval = float(args.timelapse_interval)
+    timelapse_budget = LogArchive.parse_size(args.timelapse_budget)
 
     server_address = (given_address, given_port)
 
-    # open file to log pressure over time
-    log_file = open(log_filename, 'a')
+    # log is written by a background thread
+    log_file = JsonLogWriter.JsonLogWriter(log_filename,
+                                           echo=DEBUG,
+                                           **log_rotation)
+    Camera_HTTPServer_RequestHandler.log_file = log_file
     emit_event(log_file, 'STARTING UsbCameraServer')
     emit_event(log_file, 'address: {}'.format(server_address))
-    emit_event(log_file, 'video_device: {}'.format(video_device))
+    emit_event(log_file, 'video_device: {}  backend: {}'.format(video_device, capture_backend))
+    emit_event(log_file, 'max_age: {}'.format(max_frame_age))
+    emit_event(log_file, 'stream_fps: {}  max_streams: {}'.format(stream_fps, max_streams))
+    emit_event(log_file, 'encode_processes: {}'.format(encode_processes))
+    emit_event(log_file, 'ring_frames: {}  ring_interval: {}'.format(ring_frames, ring_interval))
+    emit_event(log_file, 'motion: {}'.format(motion_threshold))
+    emit_event(log_file, 'timelapse_dir: "{}"  timelapse_interval: {}  timelapse_budget: {}'.format(timelapse_dir,
+                                                                                                  timelapse_interval,
+                                                                                                  timelapse_budget))
 
-    with open(DEFAULT_ICON_FILE_NAME, 'rb') as icon_file:
-        FAVICON = bytearray(icon_file.read())
+    with open(args.icon_filename, 'rb') as icon_file:
+        FAVICON = icon_file.read()
     emit_event(log_file, 'read icon file of length = {}'.format(len(FAVICON)))
     if DEBUG:
         print('read icon file of length = {}'.format(len(FAVICON)),
@@ -313,9 +1978,27 @@ if __name__ == '__main__':
               file=sys.stderr, flush=True)
         print('video_device = {}'.format(video_device),
               file=sys.stderr, flush=True)
+        print('max_frame_age = {}'.format(max_frame_age),
+              file=sys.stderr, flush=True)
+        print('stream_fps = {}'.format(stream_fps),
+              file=sys.stderr, flush=True)
+        print('max_streams = {}'.format(max_streams),
+              file=sys.stderr, flush=True)
+        print('encode_processes = {}'.format(encode_processes),
+              file=sys.stderr, flush=True)
+        print('ring_frames = {}'.format(ring_frames),
+              file=sys.stderr, flush=True)
+        print('ring_interval = {}'.format(ring_interval),
+              file=sys.stderr, flush=True)
 
+    if use_asyncio:
+        httpd_server = AsyncHttpServer.AsyncHTTPServer(server_address,
+                                                       Camera_HTTPServer_RequestHandler,
+                                                       max_workers=max_workers,
+                                                       max_in_flight=max_in_flight)
+        emit_event(log_file, 'using asyncio with {} workers and at most {} requests in flight'.format(max_workers, max_in_flight))
     # use newer, threading version, if available
-    if (sys.version_info[0] >= 3 and sys.version_info[1] >= 7):
+    elif (sys.version_info[0] >= 3 and sys.version_info[1] >= 7):
         httpd_server = ThreadingHTTPServer(server_address,
                                            Camera_HTTPServer_RequestHandler)
     else:
@@ -323,8 +2006,16 @@ if __name__ == '__main__':
         httpd_server = HTTPServer(server_address,
                                   Camera_HTTPServer_RequestHandler)
 
+    if encode_processes > 0:
+        _encode_pool = start_encode_pool(encode_processes)
+
     AVAILABLE_CAPTURE_DEVICES = find_capture_devices()
+    if capture_backend == 'opencv':
+        # only V4L2 devices come and go
+        CaptureDeviceRegistry().start()
     emit_event(log_file, 'found available capture devices of "{}"'.format(AVAILABLE_CAPTURE_DEVICES))
+    for d in AVAILABLE_CAPTURE_DEVICES:
+        emit_json_map(log_file, {'capture_device': CAPTURE_DEVICE_DETAILS[d]})
     
     periodic_sample_thread = threading.Thread(target=periodic_capture_sample, args=(video_device,), daemon=True)
     if DEBUG:
@@ -335,6 +2026,19 @@ if __name__ == '__main__':
         print('periodic_sample_thread started',
               file=sys.stderr, flush=True)
 
+    if ring_frames > 0:
+        threading.Thread(target=run_per_device, args=(ring_interval, record_frame, 'recording frames'), 
+                         daemon=True).start()
+
+    if motion_threshold > 0:
+        threading.Thread(target=run_per_device, 
+                         args=(MOTION_SAMPLE_INTERVAL_IN_SECONDS, read_for_motion, 'watching for motion'), 
+                         daemon=True).start()
+
+    if timelapse_dir:
+        _timelapse_recorder = TimelapseRecorder(timelapse_dir, timelapse_interval, timelapse_budget)
+        _timelapse_recorder.start()
+
     if DEBUG:
         print('running server listening on {}...'.format(server_address),
               file=sys.stderr, flush=True)